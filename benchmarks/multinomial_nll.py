@@ -0,0 +1,79 @@
+"""
+Parity of the closed form losses.multinomial_nll with the previous
+tensorflow_probability based implementation (loss and gradient w.r.t. the
+logits), and forward+backward time per batch of both. Requires
+tensorflow_probability, which chrombpnet itself no longer depends on.
+
+python benchmarks/multinomial_nll.py --batch-size 64 --outputlen 1000
+"""
+
+import os
+os.environ.setdefault("TF_USE_LEGACY_KERAS", "1")
+
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+from chrombpnet.training.utils.losses import multinomial_nll
+
+def multinomial_nll_tfp(true_counts, logits):
+    # previous implementation of losses.multinomial_nll
+    counts_per_example = tf.reduce_sum(true_counts, axis=-1)
+    dist = tfp.distributions.Multinomial(total_count=counts_per_example,
+                                         logits=logits)
+    return (-tf.reduce_sum(dist.log_prob(true_counts)) /
+            tf.cast(tf.shape(true_counts)[0], dtype=tf.float32))
+
+def get_batch(batch_size, outputlen, rng):
+    logits = rng.normal(0, 2, size=(batch_size, outputlen)).astype(np.float32)
+    # sparse low coverage examples (mostly 0s) and deep ones, plus an all 0 example
+    depth = rng.choice([10, 1000, 100000], size=(batch_size, 1))
+    probs = rng.dirichlet(np.ones(outputlen), size=batch_size)
+    true_counts = rng.poisson(depth * probs).astype(np.float32)
+    true_counts[0] = 0
+    return tf.constant(true_counts), tf.constant(logits)
+
+def loss_and_grad(loss_fn):
+    @tf.function
+    def step(true_counts, logits):
+        with tf.GradientTape() as tape:
+            tape.watch(logits)
+            loss = loss_fn(true_counts, logits)
+        return loss, tape.gradient(loss, logits)
+    return step
+
+def time_per_batch(step, true_counts, logits, repeats):
+    step(true_counts, logits) # trace
+    start = time.perf_counter()
+    for _ in range(repeats):
+        loss, grad = step(true_counts, logits)
+    grad.numpy()
+    return (time.perf_counter() - start) / repeats
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    closed_form = loss_and_grad(multinomial_nll)
+    reference = loss_and_grad(multinomial_nll_tfp)
+
+    for _ in range(args.num_checks):
+        true_counts, logits = get_batch(args.batch_size, args.outputlen, rng)
+        loss, grad = closed_form(true_counts, logits)
+        ref_loss, ref_grad = reference(true_counts, logits)
+        np.testing.assert_allclose(loss.numpy(), ref_loss.numpy(), rtol=1e-5)
+        np.testing.assert_allclose(grad.numpy(), ref_grad.numpy(), rtol=1e-4, atol=1e-6)
+    print("loss and gradients match tfp on {} batches".format(args.num_checks))
+
+    true_counts, logits = get_batch(args.batch_size, args.outputlen, rng)
+    for name, step in [("tfp.distributions.Multinomial", reference), ("closed form", closed_form)]:
+        seconds = time_per_batch(step, true_counts, logits, args.repeats)
+        print("{:<32s} {:8.1f} us per batch (forward+backward)".format(name, seconds * 1e6))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--outputlen", type=int, default=1000)
+    parser.add_argument("--num-checks", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1234)
+    main(parser.parse_args())
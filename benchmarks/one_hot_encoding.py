@@ -0,0 +1,88 @@
+"""
+Throughput (bases per second) of the lookup table one-hot encoder/decoder in
+chrombpnet.training.utils.one_hot against the previous np.unique based
+implementation, on random sequences with some lower-case and N bases.
+
+python benchmarks/one_hot_encoding.py --num-seqs 20000 --seq-len 2114
+"""
+
+import argparse
+import tempfile
+import time
+import os
+import numpy as np
+from chrombpnet.training.utils import one_hot
+
+def dna_to_one_hot_unique(seqs):
+    # previous implementation of one_hot.dna_to_one_hot
+    seq_len = len(seqs[0])
+    assert np.all(np.array([len(s) for s in seqs]) == seq_len)
+
+    seq_concat = "".join(seqs).upper() + "ACGT"
+    one_hot_map = np.identity(5)[:, :-1].astype(np.int8)
+    base_vals = np.frombuffer(bytearray(seq_concat, "utf8"), dtype=np.int8).copy()
+    base_vals[~np.isin(base_vals, np.array([65, 67, 71, 84]))] = 85
+    _, base_inds = np.unique(base_vals, return_inverse=True)
+    return one_hot_map[base_inds[:-4]].reshape((len(seqs), seq_len, 4))
+
+def one_hot_to_dna_where(one_hot_seqs):
+    # previous implementation of one_hot.one_hot_to_dna
+    bases = np.array(["A", "C", "G", "T", "N"])
+    one_hot_inds = np.tile(one_hot_seqs.shape[2], one_hot_seqs.shape[:2])
+    batch_inds, seq_inds, base_inds = np.where(one_hot_seqs)
+    one_hot_inds[batch_inds, seq_inds] = base_inds
+    seq_array = bases[one_hot_inds]
+    return ["".join(seq) for seq in seq_array]
+
+def get_random_seqs(num_seqs, seq_len, seed=1234):
+    rng = np.random.default_rng(seed)
+    alphabet = np.frombuffer(b"ACGTacgtN", dtype=np.uint8)
+    probs = np.array([0.2, 0.2, 0.2, 0.2, 0.04, 0.04, 0.04, 0.04, 0.04])
+    base_vals = rng.choice(alphabet, size=(num_seqs, seq_len), p=probs).astype(np.uint8)
+    return base_vals, [row.tobytes().decode("ascii") for row in base_vals]
+
+def time_it(fn, repeats):
+    # best of repeats, in seconds
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def report(name, seconds, num_bases):
+    print("{:<40s} {:8.3f} s {:10.1f} Mbases/s".format(name, seconds, num_bases / seconds / 1e6))
+
+def main(args):
+    base_vals, seqs = get_random_seqs(args.num_seqs, args.seq_len)
+    num_bases = base_vals.size
+    print("{} sequences x {} bases".format(args.num_seqs, args.seq_len))
+
+    # both encoders and decoders agree before timing anything
+    expected = dna_to_one_hot_unique(seqs)
+    assert np.array_equal(one_hot.dna_to_one_hot(seqs), expected)
+    assert np.array_equal(one_hot.ascii_to_one_hot(base_vals), expected)
+    assert one_hot.one_hot_to_dna(expected) == one_hot_to_dna_where(expected)
+
+    out = np.empty(base_vals.shape + (4,), dtype=np.int8)
+    report("encode, np.unique (strings)", time_it(lambda: dna_to_one_hot_unique(seqs), args.repeats), num_bases)
+    report("encode, lookup table (strings)", time_it(lambda: one_hot.dna_to_one_hot(seqs), args.repeats), num_bases)
+    report("encode, lookup table (bytes, out=)", time_it(lambda: one_hot.ascii_to_one_hot(base_vals, out=out), args.repeats), num_bases)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src = np.memmap(os.path.join(tmp_dir, "seqs.u8"), dtype=np.uint8, mode="w+", shape=base_vals.shape)
+        src[:] = base_vals
+        dst = np.memmap(os.path.join(tmp_dir, "one_hot.i1"), dtype=np.int8, mode="w+", shape=out.shape)
+        report("encode, lookup table (memmap batched)", time_it(lambda: one_hot.ascii_to_one_hot_batched(src, out=dst), args.repeats), num_bases)
+        assert np.array_equal(dst, expected)
+        del src, dst
+
+    report("decode, np.where", time_it(lambda: one_hot_to_dna_where(expected), args.repeats), num_bases)
+    report("decode, lookup table", time_it(lambda: one_hot.one_hot_to_dna(expected), args.repeats), num_bases)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-seqs", type=int, default=10000)
+    parser.add_argument("--seq-len", type=int, default=2114)
+    parser.add_argument("--repeats", type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,77 @@
+"""
+Parity of the vectorized metrics.profile_metrics with the previous per region
+scipy loop (jsd and normalized jsd) and with metrics_utils.mnll and
+metrics_utils.mnll_min_max_bounds (mnll and normalized mnll, on a sample of
+regions, as scipy.stats.multinomial is slow), and time of both for N regions.
+The shuffled label baselines draw other permutations than the loop and are
+not compared.
+
+python benchmarks/profile_metrics.py --num-regions 100000 --outputlen 1000 --threads 1 4
+"""
+
+import argparse
+import time
+import numpy as np
+from scipy.spatial.distance import jensenshannon
+import chrombpnet.training.metrics as metrics
+import chrombpnet.training.utils.metrics_utils as metrics_utils
+
+def profile_metrics_loop(true_counts, pred_probs, pseudocount=0.001):
+    # previous implementation of metrics.profile_metrics, without mnll
+    jsd_pw, jsd_norm, jsd_rnd, jsd_rnd_norm = [], [], [], []
+    for idx in range(true_counts.shape[0]):
+        cur_jsd = jensenshannon(true_counts[idx,:]/(pseudocount+np.nansum(true_counts[idx,:])), pred_probs[idx,:])
+        jsd_pw.append(cur_jsd)
+        min_jsd, max_jsd = metrics_utils.jsd_min_max_bounds(true_counts[idx,:])
+        jsd_norm.append(metrics_utils.get_min_max_normalized_value(cur_jsd, min_jsd, max_jsd))
+        shuffled_labels = np.random.permutation(true_counts[idx,:])
+        shuffled_labels_prob = shuffled_labels/(pseudocount+np.nansum(shuffled_labels))
+        curr_jsd_rnd = jensenshannon(true_counts[idx,:]/(pseudocount+np.nansum(true_counts[idx,:])), shuffled_labels_prob)
+        jsd_rnd.append(curr_jsd_rnd)
+        jsd_rnd_norm.append(metrics_utils.get_min_max_normalized_value(curr_jsd_rnd, min_jsd, max_jsd))
+    return np.array(jsd_pw), np.array(jsd_norm), np.array(jsd_rnd), np.array(jsd_rnd_norm)
+
+def get_regions(num_regions, outputlen, rng):
+    # sparse (mostly 0s) and deep regions, plus a region without counts
+    depth = rng.choice([10, 1000, 100000], size=(num_regions, 1))
+    true_counts = rng.poisson(depth * rng.dirichlet(np.ones(outputlen), size=num_regions)).astype(np.float64)
+    true_counts[0] = 0
+    logits = rng.normal(0, 2, size=(num_regions, outputlen)).astype(np.float32)
+    pred_probs = np.exp(logits) / np.exp(logits).sum(-1, keepdims=True)
+    return true_counts, pred_probs
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    true_counts, pred_probs = get_regions(args.num_regions, args.outputlen, rng)
+
+    start = time.perf_counter()
+    jsd_pw, jsd_norm, _, _ = profile_metrics_loop(true_counts, pred_probs)
+    loop_seconds = time.perf_counter() - start
+
+    for num_threads in args.threads:
+        start = time.perf_counter()
+        mnll_pw, mnll_norm, new_jsd_pw, new_jsd_norm, _, _, _, _ = metrics.profile_metrics(true_counts, pred_probs, num_threads=num_threads)
+        seconds = time.perf_counter() - start
+        np.testing.assert_allclose(new_jsd_pw, jsd_pw, rtol=1e-5, atol=1e-7)
+        np.testing.assert_allclose(new_jsd_norm, jsd_norm, rtol=1e-5, atol=1e-7)
+        print("{:<36s} {:8.2f} s".format("vectorized, {} threads (with mnll)".format(num_threads), seconds))
+    print("{:<36s} {:8.2f} s".format("per region loop (jsd only)", loop_seconds))
+    print("jsd and normalized jsd match the loop on {} regions".format(args.num_regions))
+
+    # the region without counts has no normalized values
+    for idx in range(1, min(args.num_mnll_checks+1, args.num_regions)):
+        probs = pred_probs[idx].astype(np.float64)
+        ref_mnll = metrics_utils.mnll(true_counts[idx], probs=probs/probs.sum())
+        min_mnll, max_mnll = metrics_utils.mnll_min_max_bounds(true_counts[idx])
+        np.testing.assert_allclose(mnll_pw[idx], ref_mnll, rtol=1e-6)
+        np.testing.assert_allclose(mnll_norm[idx], metrics_utils.get_min_max_normalized_value(ref_mnll, min_mnll, max_mnll), rtol=1e-5, atol=1e-7)
+    print("mnll and normalized mnll match metrics_utils on {} regions".format(args.num_mnll_checks))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-regions", type=int, default=20000)
+    parser.add_argument("--outputlen", type=int, default=1000)
+    parser.add_argument("--num-mnll-checks", type=int, default=100)
+    parser.add_argument("--threads", nargs="*", type=int, default=[1, 4])
+    parser.add_argument("--seed", type=int, default=1234)
+    main(parser.parse_args())
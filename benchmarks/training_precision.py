@@ -0,0 +1,78 @@
+"""
+Training throughput (steps per second) and final validation loss of the bpnet
+architecture under every --precision, with and without --jit, on a synthetic
+dataset (random sequences, Poisson counts from a fixed random profile).
+
+python benchmarks/training_precision.py --inputlen 2114 --outputlen 1000 --filters 64
+"""
+
+import os
+os.environ.setdefault("TF_USE_LEGACY_KERAS", "1")
+
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+import chrombpnet.training.models.bpnet_model as bpnet_model
+from chrombpnet.training.train import PRECISION_POLICIES
+
+class StepTimer(tf.keras.callbacks.Callback):
+    # times every step after the first epoch, which includes tracing and compilation
+    def on_train_begin(self, logs=None):
+        self.times = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.times.append(time.perf_counter() - self.start)
+
+def get_synthetic_data(num_examples, inputlen, outputlen, seed):
+    rng = np.random.default_rng(seed)
+    seqs = np.eye(4, dtype=np.float32)[rng.integers(0, 4, size=(num_examples, inputlen))]
+    profile = rng.dirichlet(np.ones(outputlen))
+    total = rng.lognormal(5, 1, size=(num_examples, 1))
+    cts = rng.poisson(total * profile).astype(np.float32)
+    return seqs, [cts, np.log(1 + cts.sum(-1, keepdims=True))]
+
+def run(args, precision, jit, train_data, valid_data):
+    tf.keras.mixed_precision.set_global_policy(PRECISION_POLICIES[precision])
+    model_args = argparse.Namespace(seed=args.seed, learning_rate=args.learning_rate)
+    params = {"filters": args.filters, "n_dil_layers": args.n_dil_layers, "counts_loss_weight": 1.0,
+              "inputlen": args.inputlen, "outputlen": args.outputlen}
+    model = bpnet_model.getModelGivenModelOptionsAndWeightInits(model_args, params)
+    model.jit_compile = jit
+
+    timer = StepTimer()
+    steps_per_epoch = int(np.ceil(train_data[0].shape[0] / args.batch_size))
+    history = model.fit(train_data[0], train_data[1], validation_data=valid_data, batch_size=args.batch_size,
+                        epochs=args.epochs, verbose=0, callbacks=[timer])
+    tf.keras.mixed_precision.set_global_policy("float32")
+
+    step_times = np.array(timer.times[steps_per_epoch:])
+    return 1 / step_times.mean(), history.history["val_loss"][-1]
+
+def main(args):
+    train_data = get_synthetic_data(args.num_train, args.inputlen, args.outputlen, args.seed)
+    valid_data = get_synthetic_data(args.num_valid, args.inputlen, args.outputlen, args.seed + 1)
+
+    print("{:<9s} {:<5s} {:>10s} {:>10s}".format("precision", "jit", "steps/s", "val_loss"))
+    for precision in args.precisions:
+        for jit in [False, True]:
+            steps_per_sec, val_loss = run(args, precision, jit, train_data, valid_data)
+            print("{:<9s} {:<5s} {:>10.2f} {:>10.3f}".format(precision, str(jit), steps_per_sec, val_loss))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inputlen", type=int, default=2114)
+    parser.add_argument("--outputlen", type=int, default=1000)
+    parser.add_argument("--filters", type=int, default=64)
+    parser.add_argument("--n-dil-layers", type=int, default=8)
+    parser.add_argument("--num-train", type=int, default=1024)
+    parser.add_argument("--num-valid", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--learning-rate", type=float, default=0.001)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--precisions", nargs="*", default=list(PRECISION_POLICIES.keys()), choices=list(PRECISION_POLICIES.keys()))
+    main(parser.parse_args())
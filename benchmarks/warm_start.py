@@ -0,0 +1,102 @@
+"""
+Epochs to reach the same validation loss when training the bpnet architecture
+from scratch and when warm starting (train.init_from_model) from a model trained
+on another replicate, with and without freezing early convolutions
+(train.freeze_layers). The replicates are synthetic: random sequences with a
+planted motif, whose positions shape the profile and whose count sets the total
+counts, sequenced at a different depth in each replicate. The target is the best
+validation loss of the model trained from scratch.
+
+python benchmarks/warm_start.py --inputlen 2114 --outputlen 1000 --filters 64 --freeze-layers 0 3
+"""
+
+import os
+os.environ.setdefault("TF_USE_LEGACY_KERAS", "1")
+
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+import chrombpnet.training.models.bpnet_model as bpnet_model
+import chrombpnet.training.train as train
+
+MOTIF = "GATAAG"
+
+def get_synthetic_replicate(num_examples, inputlen, outputlen, depth, seed):
+    rng = np.random.default_rng(seed)
+    seqs = rng.integers(0, 4, size=(num_examples, inputlen))
+    motif = np.array(["ACGT".index(base) for base in MOTIF])
+    offset = (inputlen - outputlen) // 2
+    signal = np.full((num_examples, outputlen), 0.1)
+    for i in range(num_examples):
+        for _ in range(rng.integers(0, 4)):
+            start = rng.integers(0, outputlen - len(motif))
+            seqs[i, offset + start:offset + start + len(motif)] = motif
+            center = start + len(motif) // 2
+            signal[i] += np.exp(-0.5 * ((np.arange(outputlen) - center) / 5) ** 2)
+    # total counts grow with the number of motifs, the profile follows their positions
+    total = depth * signal.sum(-1, keepdims=True) / outputlen
+    cts = rng.poisson(total * signal / signal.sum(-1, keepdims=True)).astype(np.float32)
+    return np.eye(4, dtype=np.float32)[seqs], [cts, np.log(1 + cts.sum(-1, keepdims=True))]
+
+def get_params(args):
+    return {"filters": args.filters, "n_dil_layers": args.n_dil_layers, "counts_loss_weight": args.counts_loss_weight,
+            "inputlen": args.inputlen, "outputlen": args.outputlen}
+
+def get_model(args):
+    tf.keras.utils.set_random_seed(args.seed)
+    model_args = argparse.Namespace(seed=args.seed, learning_rate=args.learning_rate)
+    return bpnet_model.getModelGivenModelOptionsAndWeightInits(model_args, get_params(args))
+
+def fit(model, args, train_data, valid_data):
+    history = model.fit(train_data[0], train_data[1], validation_data=valid_data, batch_size=args.batch_size,
+                        epochs=args.epochs, verbose=0)
+    return np.array(history.history["val_loss"])
+
+def epochs_to_reach(val_losses, target):
+    reached = np.nonzero(val_losses <= target)[0]
+    return reached[0] + 1 if len(reached) > 0 else np.nan
+
+def main(args):
+    # the replicate the warm start model is trained on, and the new replicate at another depth
+    first_replicate = get_synthetic_replicate(args.num_train, args.inputlen, args.outputlen, args.depth, args.seed)
+    train_data = get_synthetic_replicate(args.num_train, args.inputlen, args.outputlen, args.new_depth, args.seed + 1)
+    valid_data = get_synthetic_replicate(args.num_valid, args.inputlen, args.outputlen, args.new_depth, args.seed + 2)
+
+    init_from = os.path.join(tempfile.mkdtemp(), "init_from.h5")
+    model = get_model(args)
+    model.fit(first_replicate[0], first_replicate[1], batch_size=args.batch_size, epochs=args.epochs, verbose=0)
+    model.save(init_from)
+
+    scratch = fit(get_model(args), args, train_data, valid_data)
+    target = scratch.min()
+    runs = [("from scratch", scratch)]
+    for num_layers in args.freeze_layers:
+        model = get_model(args)
+        train.init_from_model(model, init_from)
+        if num_layers > 0:
+            train.freeze_layers(model, num_layers, get_params(args))
+        runs.append(("warm start, {} frozen".format(num_layers), fit(model, args, train_data, valid_data)))
+
+    print("target val_loss (best from scratch in {} epochs): {:.3f}".format(args.epochs, target))
+    print("{:<24s} {:>16s} {:>14s} {:>14s}".format("run", "epochs to target", "val_loss ep 1", "best val_loss"))
+    for name, val_losses in runs:
+        print("{:<24s} {:>16} {:>14.3f} {:>14.3f}".format(name, epochs_to_reach(val_losses, target), val_losses[0], val_losses.min()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inputlen", type=int, default=2114)
+    parser.add_argument("--outputlen", type=int, default=1000)
+    parser.add_argument("--filters", type=int, default=64)
+    parser.add_argument("--n-dil-layers", type=int, default=8)
+    parser.add_argument("--counts-loss-weight", type=float, default=10.0)
+    parser.add_argument("--num-train", type=int, default=2048)
+    parser.add_argument("--num-valid", type=int, default=256)
+    parser.add_argument("--depth", type=float, default=200)
+    parser.add_argument("--new-depth", type=float, default=500)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--learning-rate", type=float, default=0.001)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--freeze-layers", nargs="*", type=int, default=[0, 3])
+    main(parser.parse_args())
@@ -22,6 +22,15 @@ def main():
 
 		pipelines.chrombpnet_train_pipeline(args)
 	
+	elif args.cmd == "train-folds":
+		assert((args.peaks.lower() != "none") or (args.nonpeaks.lower() != "none")) # both peaks and nonpeaks are empty
+		import chrombpnet.training.train_folds as train_folds
+		train_folds.main(args)
+	
+	elif args.cmd == "schedule":
+		import chrombpnet.training.schedule as schedule
+		schedule.main(args)
+	
 	elif args.cmd == "qc":
 		os.makedirs(os.path.join(args.output_dir,"auxiliary"), exist_ok=False)
 		os.makedirs(os.path.join(args.output_dir,"evaluation"), exist_ok=False)
@@ -165,6 +174,14 @@ def main():
 		elif args.cmd_prep == "splits":
 			import chrombpnet.helpers.make_chr_splits.splits as splits
 			splits.main(args)
+
+		elif args.cmd_prep == "genome-index":
+			import chrombpnet.training.utils.genome_index as genome_index
+			genome_index.main(args)
+
+		elif args.cmd_prep == "signal-index":
+			import chrombpnet.training.utils.signal_index as signal_index
+			signal_index.main(args)
 			
 		else:
 			print("Command not found")
@@ -1,30 +1,19 @@
-import os
-import sys
-import os
-import sys
 import tensorflow as tf
-import numpy as np
 import chrombpnet.training.utils.losses as losses
-from chrombpnet.training.utils.data_utils import one_hot
+from chrombpnet.training.utils import data_utils
 from tensorflow.keras.utils import get_custom_objects
 from tensorflow.keras.models import load_model
 
 
 def get_seq(peaks_df, genome, width):
     """
-    Same as get_cts, but fetches sequence from a given genome.
+    Same as get_cts, but fetches sequence from a given genome (see genome_index.open_genome).
+    Regions whose window extends beyond the chromosome are skipped.
     """
-    vals = []
-    peaks_used = []
-    for i, r in peaks_df.iterrows():
-        sequence = str(genome[r['chr']][(r['start']+r['summit'] - width//2):(r['start'] + r['summit'] + width//2)])
-        if len(sequence) == width:
-            vals.append(sequence)
-            peaks_used.append(True)
-        else:
-            peaks_used.append(False)
+    chroms, starts = data_utils.get_window_starts(peaks_df, width)
+    peaks_used = data_utils.get_in_bounds(genome, chroms, starts, width)
 
-    return one_hot.dna_to_one_hot(vals), np.array(peaks_used)
+    return data_utils.fetch_seqs(genome, chroms[peaks_used], starts[peaks_used], width), peaks_used
 
 
 def load_model_wrapper(args):
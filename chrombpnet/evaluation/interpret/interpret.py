@@ -6,7 +6,7 @@ import numpy as np
 import tensorflow as tf
 import pandas as pd
 import shap
-import pyfaidx
+import chrombpnet.training.utils.genome_index as genome_index
 import shutil
 import errno
 import os
@@ -123,7 +123,7 @@ def main(args):
     # NOTE: it will pull out sequences of length inputlen
     #       centered at the summit (start + 10th column) and peaks used after filtering
 
-    genome = pyfaidx.Fasta(args.genome)
+    genome = genome_index.open_genome(args.genome)
     seqs, peaks_used = input_utils.get_seq(regions_df, genome, inputlen)
     genome.close()
 
@@ -1,21 +1,23 @@
 import argparse
-import pyBigWig
 import numpy as np
 import pandas as pd
-import pyfaidx
 from tensorflow.keras.utils import get_custom_objects
 from tensorflow.keras.models import load_model
 import tensorflow as tf
 import chrombpnet.evaluation.make_bigwigs.bigwig_helper as bigwig_helper
 import chrombpnet.training.utils.losses as losses
 import chrombpnet.training.utils.data_utils as data_utils 
+import chrombpnet.training.utils.genome_index as genome_index
+import chrombpnet.training.utils.signal_index as signal_index
 import chrombpnet.training.utils.one_hot as one_hot
+import pyBigWig
 import h5py
 import json
+import os
 
 NARROWPEAK_SCHEMA = ["chr", "start", "end", "1", "2", "3", "4", "5", "6", "summit"]
 
-def write_predictions_h5py(output_prefix, profile, logcts, coords):
+def write_predictions_h5py(output_prefix, profile, logcts, coords, chrom_names):
     # open h5 file for writing predictions
     output_h5_fname = "{}_predictions.h5".format(output_prefix)
     h5_file = h5py.File(output_h5_fname, "w")
@@ -23,10 +25,9 @@ def write_predictions_h5py(output_prefix, profile, logcts, coords):
     coord_group = h5_file.create_group("coords")
     pred_group = h5_file.create_group("predictions")
 
-    num_examples=len(coords)
-
-    coords_chrom_dset =  [str(coords[i][0]) for i in range(num_examples)]
-    coords_center_dset =  [int(coords[i][1]) for i in range(num_examples)]
+    # coords is a structured array (see data_utils.COORDS_DTYPE), chromosomes index chrom_names
+    coords_chrom_dset =  chrom_names[coords["chrom"]]
+    coords_center_dset =  coords["pos"]
 
     dt = h5py.special_dtype(vlen=str)
 
@@ -49,23 +50,24 @@ def write_predictions_h5py(output_prefix, profile, logcts, coords):
     # close hdf5 file
     h5_file.close()
 
-def compare_with_observed(bigwig, regions_df, regions, outputlen, pred_logits, pred_logcts, output_prefix):
+def compare_with_observed(bigwig, regions_df, regions, outputlen, pred_logits, pred_logcts, output_prefix, num_threads=1):
 
 	import chrombpnet.training.metrics as metrics 
 	
-	obs_bw = pyBigWig.open(bigwig)
+	obs_bw = signal_index.open_signal(bigwig)
 	obs_data = data_utils.get_cts(regions_df,obs_bw,outputlen)
 	
 	true_counts = obs_data
 	true_counts_sum = np.log(np.sum(true_counts, axis=-1)+1)
 	profile_probs_predictions = softmax(pred_logits) ##
 	counts_sum_predictions = np.squeeze(pred_logcts) ##
-	coordinates =  [[r[0], r[-1]] for r in regions]
+	chrom_names = data_utils.get_chrom_table(regions_df)
+	coordinates = data_utils.get_coords(regions_df, peaks_bool=0, chrom_names=chrom_names)
 	
-	write_predictions_h5py(output_prefix, profile_probs_predictions, counts_sum_predictions, coordinates)
+	write_predictions_h5py(output_prefix, profile_probs_predictions, counts_sum_predictions, coordinates, chrom_names)
 	
 	# store regions, their predictions and corresponding pointwise metrics
-	mnll_pw, mnll_norm, jsd_pw, jsd_norm, jsd_rnd, jsd_rnd_norm, mnll_rnd, mnll_rnd_norm =  metrics.profile_metrics(true_counts,profile_probs_predictions)
+	mnll_pw, mnll_norm, jsd_pw, jsd_norm, jsd_rnd, jsd_rnd_norm, mnll_rnd, mnll_rnd_norm =  metrics.profile_metrics(true_counts,profile_probs_predictions,num_threads=num_threads)
 
 	spearman_cor, pearson_cor, mse = metrics.counts_metrics(true_counts_sum, counts_sum_predictions, output_prefix, "All regions provided")
 	
@@ -80,6 +82,8 @@ def compare_with_observed(bigwig, regions_df, regions, outputlen, pred_logits, p
 	metrics_dictionary["profile_metrics"]["regions"] = {}
 	metrics_dictionary["profile_metrics"]["regions"]["median_jsd"] = np.nanmedian(jsd_pw)
 	metrics_dictionary["profile_metrics"]["regions"]["median_norm_jsd"] = np.nanmedian(jsd_norm)
+	metrics_dictionary["profile_metrics"]["regions"]["median_mnll"] = np.nanmedian(mnll_pw)
+	metrics_dictionary["profile_metrics"]["regions"]["median_norm_mnll"] = np.nanmedian(mnll_norm)
 	
 	metrics.plot_histogram(jsd_pw, jsd_rnd, output_prefix, "All regions provided")
 	
@@ -93,7 +97,7 @@ def parse_args():
     parser.add_argument("-bm", "--bias-model", type=str, default=None, required=False, help="Path to bias model h5")
     parser.add_argument("-cm", "--chrombpnet-model", type=str, default=None, required=False, help="Path to chrombpnet model h5")
     parser.add_argument("-cmb", "--chrombpnet-model-nb", type=str, default=None, required=False, help="Path to chrombpnet model h5")
-    parser.add_argument("-r", "--regions", type=str, required=True, help="10 column BED file of length = N which matches f['projected_shap']['seq'].shape[0]. The ith region in the BED file corresponds to ith entry in importance matrix. If start=2nd col, summit=10th col, then the input regions are assumed to be for [start+summit-(inputlen/2):start+summit+(inputlen/2)]. Should not be piped since it is read twice!")
+    parser.add_argument("-r", "--regions", type=str, default=None, required=False, help="Required unless --tile is given. 10 column BED file of length = N which matches f['projected_shap']['seq'].shape[0]. The ith region in the BED file corresponds to ith entry in importance matrix. If start=2nd col, summit=10th col, then the input regions are assumed to be for [start+summit-(inputlen/2):start+summit+(inputlen/2)]. Should not be piped since it is read twice!")
     parser.add_argument("-g", "--genome", type=str, required=True, help="Genome fasta")
     parser.add_argument("-c", "--chrom-sizes", type=str, required=True, help="Chromosome sizes 2 column tab-separated file")
     parser.add_argument("-op", "--output-prefix", type=str, required=True, help="Output bigwig file")
@@ -102,6 +106,11 @@ def parse_args():
     parser.add_argument("-t", "--tqdm", type=int,default=0, help="Use tqdm. If yes then you need to have it installed.")
     parser.add_argument("-d", "--debug-chr", nargs="+", type=str, default=None, help="Run for specific chromosomes only (e.g. chr1 chr2) for debugging")
     parser.add_argument("-bw", "--bigwig", type=str, default=None, help="If provided .h5 with predictions are output along with calculated metrics considering bigwig as groundtruth.")
+    parser.add_argument("--metrics-threads", type=int, default=1, help="Threads to compute profile metrics with")
+    parser.add_argument("--tile", action="store_true", default=False, help="Predict genome-wide instead of around the regions: every chromosome in --chrom-sizes (or --debug-chr) is tiled with windows of the model output length, edges padded with Ns")
+    parser.add_argument("--tile-chunk", type=int, default=4096, help="Windows fetched and predicted at a time with --tile")
+    parser.add_argument("--checkpoint-dir", type=str, default=None, help="With --tile, save the predictions of every chromosome to this directory and skip chromosomes already saved there when resuming. Directories holding predictions of another model, genome or input/output length are refused")
+    parser.add_argument("--all-heads", action="store_true", default=False, help="Write the chrombpnet, chrombpnet_nobias and bias bigwigs from one pass of the chrombpnet model, using the no bias and bias models it contains")
     args = parser.parse_args()
     assert (args.bias_model is None) + (args.chrombpnet_model is None) + (args.chrombpnet_model_nb is None) < 3, "No input model provided!"
     print(args)
@@ -121,126 +130,218 @@ def load_model_wrapper(model_hdf5):
     model.summary()
     return model
 
-def main(args):
-
-
-    if args.chrombpnet_model_nb:
-        model_chrombpnet_nb = load_model_wrapper(model_hdf5=args.chrombpnet_model_nb)
-        inputlen = int(model_chrombpnet_nb.input_shape[1])
-        outputlen = int(model_chrombpnet_nb.output_shape[0][1])
-
-        # load data
-        regions_df = pd.read_csv(args.regions, sep='\t', names=NARROWPEAK_SCHEMA)
-        print(regions_df.head())
-        gs = bigwig_helper.read_chrom_sizes(args.chrom_sizes)
-        regions = bigwig_helper.get_regions(args.regions, outputlen) # output regions
-
-        if args.debug_chr is not None:
-            regions_df = regions_df[regions_df['chr'].isin(args.debug_chr)]
-            regions = [x for x in regions if x[0]==args.debug_chr]
-
-        with pyfaidx.Fasta(args.genome) as g:
-            seqs = data_utils.get_seq(regions_df, g, inputlen)
-
-        pred_logits_wo_bias, pred_logcts_wo_bias = model_chrombpnet_nb.predict([seqs],
-                                          batch_size = args.batch_size,
-                                          verbose=True)
-
-        pred_logits_wo_bias = np.squeeze(pred_logits_wo_bias)
-
+def get_all_heads_model(model_chrombpnet):
+    """
+    Model with the profile logits and log counts of the chrombpnet model, of the
+    model without bias and of the bias model it contains as outputs, predicting
+    all three from one forward pass.
+    """
+    model_wo_bias = model_chrombpnet.get_layer("model_wo_bias")
+    bias_models = [layer for layer in model_chrombpnet.layers if isinstance(layer, tf.keras.Model) and layer.name != "model_wo_bias"]
+    assert(len(bias_models)==1) # chrombpnet model does not contain model_wo_bias and a bias model
+    # outputs of the submodels as called on the chrombpnet model input
+    outputs = model_chrombpnet.outputs + model_wo_bias.get_output_at(-1) + bias_models[0].get_output_at(-1)
+    return tf.keras.Model(inputs=model_chrombpnet.inputs, outputs=outputs)
+
+def load_regions(args, outputlen):
+    regions_df = pd.read_csv(args.regions, sep='\t', names=NARROWPEAK_SCHEMA)
+    print(regions_df.head())
+    gs = bigwig_helper.read_chrom_sizes(args.chrom_sizes)
+    regions = bigwig_helper.get_regions(args.regions, outputlen) # output regions
+
+    if args.debug_chr is not None:
+        regions_df = regions_df[regions_df['chr'].isin(args.debug_chr)]
+        regions = [x for x in regions if x[0] in args.debug_chr]
+    return regions_df, regions, gs
+
+def write_predictions(args, pred_logits, pred_logcts, regions_df, regions, gs, outputlen, suffix):
+    # predicted bigwig, and predictions and metrics against the observed bigwig if given
+    pred_logits = np.squeeze(pred_logits)
+
+    bigwig_helper.write_bigwig(softmax(pred_logits) * (np.expand_dims(np.exp(pred_logcts)[:,0],axis=1)), 
+                           regions, 
+                           gs, 
+                           args.output_prefix + "_" + suffix + ".bw", 
+                           outstats_file=args.output_prefix_stats, 
+                           debug_chr=args.debug_chr, 
+                           use_tqdm=args.tqdm)
+
+    if args.bigwig:
+    	compare_with_observed(args.bigwig, regions_df, regions, outputlen, 
+    				pred_logits, pred_logcts, args.output_prefix+"_"+suffix, args.metrics_threads)
+
+def predict_tiles(model, genome, chrom, chrom_len, inputlen, outputlen, batch_size, tile_chunk):
+    """
+    Predicts windows of outputlen tiling [0, chrom_len), each from the inputlen
+    sequence centered on it (padded with Ns beyond the chromosome edges). Windows
+    are fetched and predicted tile_chunk at a time. Yields the start and, for every
+    profile logits and log counts pair of model outputs, the predicted counts of
+    the contiguous stretch [start, start+len) the windows of the chunk cover.
+    """
+    assert((inputlen - outputlen) % 2 == 0) # Necessary for windows centered on the tiles
+    flank = (inputlen - outputlen) // 2
+    num_tiles = -(-chrom_len // outputlen)
+
+    for first in range(0, num_tiles, tile_chunk):
+        last = min(first + tile_chunk, num_tiles)
+        lo = first*outputlen - flank
+        hi = last*outputlen + flank
+
+        # sequence under the windows of the chunk, Ns outside of the chromosome
+        codes = np.full(hi - lo, 4, dtype=np.uint8)
+        codes[max(lo, 0)-lo:min(hi, chrom_len)-lo] = genome.fetch_codes(chrom, max(lo, 0), min(hi, chrom_len))
+        seqs = one_hot.codes_to_one_hot(np.lib.stride_tricks.sliding_window_view(codes, inputlen)[::outputlen])
+
+        preds = model.predict(seqs, batch_size=batch_size, verbose=0)
+        end = min(last*outputlen, chrom_len) - first*outputlen
+        tracks = []
+        for pred_logits, pred_logcts in zip(preds[0::2], preds[1::2]):
+            pred_logits = np.asarray(pred_logits).reshape(-1, outputlen)
+            pred_cts = softmax(pred_logits) * np.exp(np.asarray(pred_logcts)[:, :1])
+            tracks.append(pred_cts.reshape(-1)[:end])
+        yield first*outputlen, tracks
+
+def get_checkpoint_signature(args, model_hdf5, inputlen, outputlen):
+    # what the tiled predictions saved to a checkpoint directory were predicted with
+    genome = os.path.join(args.genome, genome_index.INDEX_FILE) if os.path.isdir(args.genome) else args.genome
+    return {"model": data_utils.get_file_signature(model_hdf5),
+            "genome": data_utils.get_file_signature(genome),
+            "inputlen": inputlen,
+            "outputlen": outputlen}
+
+def write_tiled_bigwigs(args, model, model_hdf5, inputlen, outputlen, suffixes):
+    """
+    Tiles every chromosome of the chromosome sizes (or of --debug-chr) with model
+    predictions and writes one bigwig per pair of model outputs, in contiguous
+    intervals streamed chunk by chunk. With a checkpoint directory, the predictions
+    of every chromosome are first saved there, and chromosomes already saved (e.g.
+    by an interrupted run) are not predicted again. The model, genome and lengths
+    are saved with them, and a checkpoint directory holding predictions of another
+    model, genome or lengths is refused.
+    """
+    gs = bigwig_helper.read_chrom_sizes(args.chrom_sizes)
+    chroms = [x for x in gs if (args.debug_chr is None) or (x[0] in args.debug_chr)]
+
+    def get_checkpoint(suffix, chrom):
+        return os.path.join(args.checkpoint_dir, "{}.{}.npy".format(suffix, chrom))
+
+    def has_checkpoint(suffix, chrom, chrom_len):
+        # chromosomes saved with another length in the chromosome sizes are predicted again
+        return os.path.exists(get_checkpoint(suffix, chrom)) and (np.load(get_checkpoint(suffix, chrom), mmap_mode="r").shape == (chrom_len,))
+
+    with genome_index.open_genome(args.genome) as g:
+        if args.checkpoint_dir is not None:
+            os.makedirs(args.checkpoint_dir, exist_ok=True)
+            signature = get_checkpoint_signature(args, model_hdf5, inputlen, outputlen)
+            for suffix in suffixes:
+                signature_path = os.path.join(args.checkpoint_dir, "{}.signature.json".format(suffix))
+                if os.path.exists(signature_path):
+                    assert(json.load(open(signature_path)) == signature) # checkpoint directory holds predictions of another model, genome or input/output length, use another directory
+                else:
+                    with open(signature_path, "w") as fp:
+                        json.dump(signature, fp, indent=4)
+            for chrom, chrom_len in chroms:
+                if all(has_checkpoint(suffix, chrom, chrom_len) for suffix in suffixes):
+                    print("{}: found predictions in checkpoint directory, skipping".format(chrom))
+                    continue
+                # written under a temporary name, so that only complete chromosomes are picked up
+                tracks = [np.lib.format.open_memmap(get_checkpoint(suffix, chrom)+".tmp", mode="w+", dtype=np.float32, shape=(chrom_len,)) for suffix in suffixes]
+                for start, chunk_tracks in predict_tiles(model, g, chrom, chrom_len, inputlen, outputlen, args.batch_size, args.tile_chunk):
+                    for track, chunk_track in zip(tracks, chunk_tracks):
+                        track[start:start+len(chunk_track)] = chunk_track
+                for track in tracks:
+                    track.flush()
+                del tracks
+                for suffix in suffixes:
+                    os.replace(get_checkpoint(suffix, chrom)+".tmp", get_checkpoint(suffix, chrom))
+                print("{}: predicted {} bases, saved to checkpoint directory".format(chrom, chrom_len))
+
+        bws = []
+        for suffix in suffixes:
+            bw = pyBigWig.open(args.output_prefix + "_" + suffix + ".bw", "w")
+            bw.addHeader(gs)
+            bws.append(bw)
+
+        for chrom, chrom_len in chroms:
+            if args.checkpoint_dir is not None:
+                checkpoints = [np.load(get_checkpoint(suffix, chrom), mmap_mode="r") for suffix in suffixes]
+                chunk_len = args.tile_chunk*outputlen
+                chunks = ((start, [track[start:start+chunk_len] for track in checkpoints]) for start in range(0, chrom_len, chunk_len))
+            else:
+                chunks = predict_tiles(model, g, chrom, chrom_len, inputlen, outputlen, args.batch_size, args.tile_chunk)
+            for start, chunk_tracks in chunks:
+                for bw, chunk_track in zip(bws, chunk_tracks):
+                    bw.addEntries(chrom, start, values=np.asarray(chunk_track, dtype=np.float64).tolist(), span=1, step=1)
+            print("{}: wrote {} bases".format(chrom, chrom_len))
+
+        for bw in bws:
+            bw.close()
 
-        bigwig_helper.write_bigwig(softmax(pred_logits_wo_bias) * (np.expand_dims(np.exp(pred_logcts_wo_bias)[:,0],axis=1)), 
-                               regions, 
-                               gs, 
-                               args.output_prefix + "_chrombpnet_nobias.bw", 
-                               outstats_file=args.output_prefix_stats, 
-                               debug_chr=args.debug_chr, 
-                               use_tqdm=args.tqdm)
+def main(args):
 
-        if args.bigwig:
-        	compare_with_observed(args.bigwig, regions_df, regions, outputlen, 
-        				pred_logits_wo_bias, pred_logcts_wo_bias, args.output_prefix+"_chrombpnet_nobias")
-        	
+    if args.regions is None:
+        assert(args.tile) # either a regions file or --tile is required
+    if args.tile:
+        assert(args.bigwig is None) # metrics against the observed bigwig need a regions file
+        assert(args.output_prefix_stats is None) # bigwig stats need a regions file
 
-    if args.chrombpnet_model:
+    if args.all_heads:
+        # chrombpnet, no bias and bias predictions from one pass of the chrombpnet model
+        assert(args.chrombpnet_model is not None) # --all-heads predicts with the submodels of the chrombpnet model
+        assert((args.bias_model is None) and (args.chrombpnet_model_nb is None)) # --all-heads writes the bias and no bias bigwigs of the chrombpnet model
         model_chrombpnet = load_model_wrapper(model_hdf5=args.chrombpnet_model)
         inputlen = int(model_chrombpnet.input_shape[1])
         outputlen = int(model_chrombpnet.output_shape[0][1])
+        model_all_heads = get_all_heads_model(model_chrombpnet)
+        suffixes = ["chrombpnet", "chrombpnet_nobias", "bias"]
 
+        if args.tile:
+            write_tiled_bigwigs(args, model_all_heads, args.chrombpnet_model, inputlen, outputlen, suffixes)
+            return
 
         # load data
-        regions_df = pd.read_csv(args.regions, sep='\t', names=NARROWPEAK_SCHEMA)
-        print(regions_df.head())
-        gs = bigwig_helper.read_chrom_sizes(args.chrom_sizes)
-        regions = bigwig_helper.get_regions(args.regions, outputlen) # output regions
-
-        if args.debug_chr is not None:
-            regions_df = regions_df[regions_df['chr'].isin(args.debug_chr)]
-            regions = [x for x in regions if x[0]==args.debug_chr]
-
-        with pyfaidx.Fasta(args.genome) as g:
+        regions_df, regions, gs = load_regions(args, outputlen)
+        with genome_index.open_genome(args.genome) as g:
             seqs = data_utils.get_seq(regions_df, g, inputlen)
 
-        pred_logits, pred_logcts = model_chrombpnet.predict([seqs],
+        preds = model_all_heads.predict([seqs],
                                           batch_size = args.batch_size,
                                           verbose=True)
 
+        for i, suffix in enumerate(suffixes):
+            write_predictions(args, preds[2*i], preds[2*i+1], regions_df, regions, gs, outputlen, suffix)
+        return
 
-        pred_logits = np.squeeze(pred_logits)
-
-
-        bigwig_helper.write_bigwig(softmax(pred_logits) * (np.expand_dims(np.exp(pred_logcts)[:,0],axis=1)),
-                               regions,
-                               gs,
-                               args.output_prefix + "_chrombpnet.bw",
-                               outstats_file=args.output_prefix_stats, 
-                               debug_chr=args.debug_chr,
-                               use_tqdm=args.tqdm)
+    # regions and sequences are loaded once and shared by models of the same input and output lengths
+    loaded_regions = {}
+    loaded_seqs = {}
+    for model_hdf5, suffix in [(args.chrombpnet_model_nb, "chrombpnet_nobias"), (args.chrombpnet_model, "chrombpnet"), (args.bias_model, "bias")]:
+        if not model_hdf5:
+            continue
+        model = load_model_wrapper(model_hdf5=model_hdf5)
+        inputlen = int(model.input_shape[1])
+        outputlen = int(model.output_shape[0][1])
 
-        if args.bigwig:
-        	compare_with_observed(args.bigwig, regions_df, regions, outputlen, 
-        				pred_logits, pred_logcts, args.output_prefix+"_chrombpnet")
-        	
-
-    if args.bias_model:
-        model_bias = load_model_wrapper(model_hdf5=args.bias_model)
-        inputlen = int(model_bias.input_shape[1])
-        outputlen = int(model_bias.output_shape[0][1])
+        if args.tile:
+            write_tiled_bigwigs(args, model, model_hdf5, inputlen, outputlen, [suffix])
+            continue
 
         # load data
-        regions_df = pd.read_csv(args.regions, sep='\t', names=NARROWPEAK_SCHEMA)
-        print(regions_df.head())
-        gs = bigwig_helper.read_chrom_sizes(args.chrom_sizes)
-        regions = bigwig_helper.get_regions(args.regions, outputlen) # output regions
-
-        if args.debug_chr is not None:
-            regions_df = regions_df[regions_df['chr'].isin(args.debug_chr)]
-            regions = [x for x in regions if x[0]==args.debug_chr]
-
-        with pyfaidx.Fasta(args.genome) as g:
-            seqs = data_utils.get_seq(regions_df, g, inputlen)
-
-
-        pred_bias_logits, pred_bias_logcts = model_bias.predict(seqs,
+        if outputlen not in loaded_regions:
+            loaded_regions[outputlen] = load_regions(args, outputlen)
+        regions_df, regions, gs = loaded_regions[outputlen]
+        if (inputlen, outputlen) not in loaded_seqs:
+            with genome_index.open_genome(args.genome) as g:
+                loaded_seqs[(inputlen, outputlen)] = data_utils.get_seq(regions_df, g, inputlen)
+        seqs = loaded_seqs[(inputlen, outputlen)]
+
+        pred_logits, pred_logcts = model.predict([seqs],
                                           batch_size = args.batch_size,
                                           verbose=True)
 
-        pred_bias_logits = np.squeeze(pred_bias_logits)
-
-        bigwig_helper.write_bigwig(softmax(pred_bias_logits) * (np.expand_dims(np.exp(pred_bias_logcts)[:,0],axis=1)), 
-                               regions, 
-                               gs, 
-                               args.output_prefix + "_bias.bw", 
-                               outstats_file=args.output_prefix_stats, 
-                               debug_chr=args.debug_chr, 
-                               use_tqdm=args.tqdm)
+        write_predictions(args, pred_logits, pred_logcts, regions_df, regions, gs, outputlen, suffix)
 
-        if args.bigwig:
-        	compare_with_observed(args.bigwig, regions_df, regions, outputlen, 
-        				pred_bias_logits, pred_bias_logcts, args.output_prefix+"_bias")
-        
-    
 
 if __name__=="__main__":
-    args = parse_args
+    args = parse_args()
     main(args)
@@ -2,8 +2,8 @@ from tensorflow.keras.utils import Sequence
 import pandas as pd
 import numpy as np
 import math
-import pyfaidx
 from chrombpnet.training.utils import one_hot
+from chrombpnet.training.utils import genome_index
 
 class SNPGenerator(Sequence):
     def __init__(self,
@@ -17,7 +17,7 @@ class SNPGenerator(Sequence):
         self.num_snps=self.snp_regions.shape[0]
         self.inputlen=inputlen
         self.batch_size=batch_size
-        self.genome=pyfaidx.Fasta(genome_fasta)
+        self.genome=genome_index.open_genome(genome_fasta)
         self.debug_mode_on=debug_mode_on
 
     def __getitem__(self,idx):
@@ -42,21 +42,21 @@ class SNPGenerator(Sequence):
             # get all regions left of snp insert locus
             left_flank_start=max([0,cur_pos-flank_size])
             left_flank_end=cur_pos
-            left_flank=str(self.genome[cur_chrom][left_flank_start:left_flank_end])
+            left_flank=self.genome.fetch_codes(cur_chrom,left_flank_start,left_flank_end)
 
             # get all regions right of snp insert locus
             right_flank_start=cur_pos+1
             right_flank_end=cur_pos+flank_size
-            right_flank=str(self.genome[cur_chrom][right_flank_start:right_flank_end])
+            right_flank=self.genome.fetch_codes(cur_chrom,right_flank_start,right_flank_end)
 
             # insert snp
-            cur_ref_seq=left_flank+ref_snp+right_flank
-            cur_alt_seq=left_flank+alt_snp+right_flank
+            cur_ref_seq=np.concatenate([left_flank,self.to_codes(ref_snp),right_flank])
+            cur_alt_seq=np.concatenate([left_flank,self.to_codes(alt_snp),right_flank])
 
             if self.debug_mode_on:
                 print("CHR_POS_REF_ALT_META : " + cur_chrom+"_"+str(cur_pos)+"_"+ref_snp+"_"+alt_snp+"_"+meta + "\n")
-                print("reference/alternate allele right flank : " +  right_flank + "\n")
-                print("reference/alternate allele left flank : " + left_flank + "\n")
+                print("reference/alternate allele right flank : " +  one_hot.codes_to_dna(right_flank[None])[0] + "\n")
+                print("reference/alternate allele left flank : " + one_hot.codes_to_dna(left_flank[None])[0] + "\n")
            
             if len(cur_ref_seq) != self.inputlen or len(cur_alt_seq) != self.inputlen:
                 print("Exception input size is not 2114 - skipping snp")
@@ -67,7 +67,16 @@ class SNPGenerator(Sequence):
             alt_seqs.append(cur_alt_seq)
             rsids.append(rsid)
 
-        return rsids, one_hot.dna_to_one_hot(ref_seqs), one_hot.dna_to_one_hot(alt_seqs)
+        return rsids, self.to_one_hot(ref_seqs), self.to_one_hot(alt_seqs)
+
+    def to_codes(self, allele):
+        return one_hot.ascii_to_codes(np.frombuffer(allele.encode("ascii"), dtype=np.uint8))
+
+    def to_one_hot(self, seqs):
+        # sequences are base codes fetched from the genome with the alleles inserted
+        if len(seqs) == 0:
+            return np.zeros((0, self.inputlen, 4), dtype=np.int8)
+        return one_hot.codes_to_one_hot(np.stack(seqs))
 
     def __len__(self):
         return math.ceil(self.num_snps/self.batch_size)
@@ -1,6 +1,6 @@
 import argparse
-import pyfaidx
-import pyBigWig
+import chrombpnet.training.utils.genome_index as genome_index
+import chrombpnet.training.utils.signal_index as signal_index
 import pandas as pd
 import numpy as np
 import os
@@ -39,8 +39,8 @@ def main(args):
     print("evaluating hyperparameters on the following chromosomes",chroms_to_keep)
 
     # read from bigwigs and fasta file
-    bw = pyBigWig.open(args.bigwig) 
-    genome = pyfaidx.Fasta(args.genome)
+    bw = signal_index.open_signal(args.bigwig) 
+    genome = genome_index.open_genome(args.genome)
 
     # read peaks and non peaks    
     in_peaks =  pd.read_csv(args.peaks,
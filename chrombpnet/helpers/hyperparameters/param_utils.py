@@ -1,5 +1,5 @@
 import numpy as np
-import chrombpnet.training.utils.one_hot as one_hot
+import chrombpnet.training.utils.data_utils as data_utils
 import tensorflow as tf
 from tensorflow.keras.utils import get_custom_objects
 from tensorflow.keras.models import load_model
@@ -43,17 +43,11 @@ def get_seqs_cts(genome, bw, peaks_df, input_width=2114, output_width=1000):
     """
     Output counts (not log counts)
     Output one-hot encoded sequence
+    genome is opened with genome_index.open_genome, bw with signal_index.open_signal
     """
-    vals = []
-    seqs = []
-    for i, r in peaks_df.iterrows():
-        sequence = str(genome[r['chr']][(r['start']+r['summit'] - input_width//2):(r['start'] + r['summit'] + input_width//2)])
-        seqs.append(sequence)
-        bigwig_vals=np.nan_to_num(bw.values(r['chr'], 
-                            (r['start'] + r['summit']) - output_width//2,
-                            (r['start'] + r['summit']) + output_width//2))
-        vals.append(bigwig_vals)
-    return (np.sum(np.array(vals),axis=1), one_hot.dna_to_one_hot(seqs))
+    seqs = data_utils.get_seq(peaks_df, genome, input_width)
+    vals = data_utils.get_cts(peaks_df, bw, output_width)
+    return (np.sum(vals,axis=1), seqs)
 
 def load_model_wrapper(model_h5):
     # read .h5 model
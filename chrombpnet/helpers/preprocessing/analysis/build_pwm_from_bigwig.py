@@ -1,10 +1,10 @@
-import pyfaidx
 import numpy as np
 import pyBigWig
 from modisco.visualization import viz_sequence
 import matplotlib.pyplot as plt
 import argparse
 import chrombpnet.training.utils.one_hot as one_hot
+import chrombpnet.training.utils.genome_index as genome_index
 
 def parse_args():
     parser=argparse.ArgumentParser(description="build pwm matrix from bigwig")
@@ -42,7 +42,7 @@ def main(args):
     assert(args.pwm_width % 2 ==0)
 
     # access files
-    hg38 = pyfaidx.Fasta(args.genome)
+    hg38 = genome_index.open_genome(args.genome)
     bw = pyBigWig.open(args.bigwig) 
 
     ## find given chromosome size
@@ -51,8 +51,7 @@ def main(args):
     chr_size = chrom_sizes_dict[args.chr]
 
     # fetch values in the given chromsome and for the given chromsome region
-    seq = str(hg38[args.chr][0:chr_size])
-    one_hot_seq = one_hot.dna_to_one_hot(seq).squeeze()
+    one_hot_seq = one_hot.codes_to_one_hot(hg38.fetch_codes(args.chr, 0, chr_size))
     bigwig_vals = np.nan_to_num(bw.values(args.chr,0,chr_size ))
     print("non zero bigwig entries in the given chromosome: ", np.sum(bigwig_vals>0))
 
@@ -1,13 +1,13 @@
 import argparse
 import pyBigWig
-import pyfaidx
 import subprocess
 import pandas as pd
 import numpy as np
 import itertools
 import os
 from modisco.visualization import viz_sequence
-import chrombpnet.training.utils.one_hot as one_hot
+import chrombpnet.training.utils.data_utils as data_utils
+import chrombpnet.training.utils.genome_index as genome_index
 from chrombpnet.data import DefaultDataFile, get_default_data_path
 
 def parse_args():
@@ -87,22 +87,20 @@ def sample_reads(bam_path, fragment_file_path, tagalign_file_path, num_samples):
     return plus_reads, minus_reads
 
 
+def get_cut_site_seqs(genome, chroms, cut_sites, width=40):
+    starts = cut_sites.astype(np.int64) - width//2
+    # observed edge cases in non-canonical chr e.g. chrEBV
+    in_bounds = data_utils.get_in_bounds(genome, chroms, starts, width)
+    return data_utils.fetch_seqs(genome, chroms[in_bounds], starts[in_bounds], width)
+
 def get_pwms(plus_reads, minus_reads, genome_file):
-    plus_seqs = []
-    minus_seqs = []
-    with pyfaidx.Fasta(genome_file) as g:
-        for _, x in plus_reads.iterrows():
-            cur = str(g[x['chr']][int(x['start'])-20:int(x['start'])+20])
-            if len(cur)==40: # observed edge cases in non-canonical chr e.g. chrEBV
-                plus_seqs.append(cur)
-        for _, x in minus_reads.iterrows():
-            cur = str(g[x['chr']][int(x['end'])-20:int(x['end'])+20])
-            if len(cur)==40:
-                minus_seqs.append(cur)
+    with genome_index.open_genome(genome_file) as g:
+        plus_seqs = get_cut_site_seqs(g, plus_reads['chr'].values, plus_reads['start'].astype(int).values)
+        minus_seqs = get_cut_site_seqs(g, minus_reads['chr'].values, minus_reads['end'].astype(int).values)
     
-    plus_pwm = one_hot.dna_to_one_hot(plus_seqs).mean(0)
+    plus_pwm = plus_seqs.mean(0)
     plus_pwm = (plus_pwm/np.sum(plus_pwm, axis=-1, keepdims=True))
-    minus_pwm = one_hot.dna_to_one_hot(minus_seqs).mean(0)
+    minus_pwm = minus_seqs.mean(0)
     minus_pwm = (minus_pwm/np.sum(minus_pwm, axis=-1, keepdims=True))
 
     return plus_pwm, minus_pwm
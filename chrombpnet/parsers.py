@@ -1,5 +1,6 @@
 import argparse
 from argparse import RawTextHelpFormatter
+import chrombpnet.training.utils.argmanager as argmanager
 
 
 desc = """==================================================================================================
@@ -10,12 +11,14 @@ desc = """======================================================================
 def read_parser():
 
         parser = argparse.ArgumentParser(description=desc,formatter_class=RawTextHelpFormatter)
-        subparsers = parser.add_subparsers(help="Must be eithier 'pipeline', 'train', 'qc', 'bias', 'prep', 'pred_bw', 'contribs_bw', 'modisco_motifs' ,'footprints', or 'snp_score'.", required=True, dest='cmd')
+        subparsers = parser.add_subparsers(help="Must be eithier 'pipeline', 'train', 'train-folds', 'schedule', 'qc', 'bias', 'prep', 'pred_bw', 'contribs_bw', 'modisco_motifs' ,'footprints', or 'snp_score'.", required=True, dest='cmd')
         
         # main parsers
         
         pipeline_parser = subparsers.add_parser("pipeline", help="End-to-end pipline with train, quality check and test for bias factorized ChromBPNet model")
         train_parser = subparsers.add_parser("train", help="Train bias factorized ChromBPNet model")
+        train_folds_parser = subparsers.add_parser("train-folds", help="Train models of several folds from a bigwig, extracting the data of all folds once")
+        schedule_parser = subparsers.add_parser("schedule", help="Run a manifest of training jobs in parallel processes on one host, with per job thread limits, core pinning and a memory budget")
         qc_parser = subparsers.add_parser("qc", help="Do quality checks and get test metrics for bias factorized ChromBPNet model")
 
         # bias parsers
@@ -29,9 +32,11 @@ def read_parser():
         # helper parsers
 
         prep_parser_full = subparsers.add_parser("prep", help="Tools to generate preprocessing data for chrombpnet")
-        prep_parser_sub = prep_parser_full.add_subparsers(help="Must be eithier 'nonpeaks' or 'splits'.", required=True, dest='cmd_prep')
+        prep_parser_sub = prep_parser_full.add_subparsers(help="Must be eithier 'nonpeaks', 'splits', 'genome-index' or 'signal-index'.", required=True, dest='cmd_prep')
         nonpeaks_parser = prep_parser_sub.add_parser("nonpeaks", help="Generate non-peak background regions given peaks")
         splits_parser = prep_parser_sub.add_parser("splits", help="Generate chromosome splits")   
+        genome_index_parser = prep_parser_sub.add_parser("genome-index", help="Convert a genome fasta once into a memory mapped index for fast sequence extraction")
+        signal_index_parser = prep_parser_sub.add_parser("signal-index", help="Convert a bigwig once into a memory mapped index for fast label extraction")
         
         # downstream tool parsers
         preds_parser = subparsers.add_parser("pred_bw", help="Get model prediction bigwigs (Metrics calculated if observed bigwig provided)")
@@ -42,6 +47,16 @@ def read_parser():
         footprints_parser = subparsers.add_parser("footprints", help="Get marginal footprinting for given model and given motifs")
         variants_parser = subparsers.add_parser("snp_score", help="Score SNPs with model")
 
+        def data_loading_args(optional_parser):
+
+                optional_parser.add_argument("--cache-dir", type=str, default=None, help="Directory to cache extracted sequences and counts in. Repeated runs on the same regions, genome and bigwig memory map the cached arrays instead of re-extracting them")
+                optional_parser.add_argument("--streaming", action="store_true", default=False, help="Keep only region co-ordinates in memory and read the sequences and counts of every batch from the genome and bigwig. Use when the extracted data does not fit in memory")
+                optional_parser.add_argument("--pack-seqs", action="store_true", default=False, help="Keep training sequences packed at 2 bits per base (instead of 1 byte per base) and unpack them per batch")
+                optional_parser.add_argument("--metrics-threads", type=int, default=1, help="Threads to compute test set profile metrics with")
+                optional_parser.add_argument("--stream-predictions", action="store_true", default=False, help="Write predicted test set profiles to the predictions .h5 (and labels to a temporary .h5) batch by batch and compute metrics from them in chunks, instead of holding all profiles in memory")
+
+                return optional_parser
+
         def general_training_args(required_train, optional_train):
 		
         	required_train.add_argument('-g','--genome', required=True, type=str, help="reference genome fasta file")
@@ -68,10 +83,26 @@ def read_parser():
       	 	optional_train.add_argument("-e", "--epochs", type=int, default=50, help="Maximum epochs to train")
         	optional_train.add_argument("-es", "--early-stop", type=int, default=5, help="Early stop limit, corresponds to 'patience' in callback")
         	optional_train.add_argument("-l", "--learning-rate", type=float, default=0.001, help="Learning rate for model training")
+        	optional_train.add_argument("--tf-data", action="store_true", default=False, help="Feed training with a tf.data pipeline that jitters, revcomps and batches examples in parallel and prefetches batches, instead of a keras Sequence")
+        	optional_train.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16", "mixed"], help="Training precision: fp32, bf16 (bfloat16 compute, e.g. CPUs with AMX/AVX512-BF16) or mixed (float16 compute with loss scaling, GPUs). Variables, output heads and losses stay float32, and the saved model is float32")
+        	optional_train.add_argument("--jit", action="store_true", default=False, help="XLA compile the training step")
+        	optional_train.add_argument("--precompute-bias", action="store_true", default=False, help="Run the frozen bias model once per region (over the jitter window, both strands) and feed its outputs to the model instead of running it on every batch. The outputs are held in memory as float32, (outputlen+4*max_jitter+1) values per peak and strand, e.g. ~5.6GB for 250k peaks at the defaults (outputlen 1000, max_jitter 500). Only used when training chrombpnet with a bias model")
+        	optional_train.add_argument("--distribution", type=str, default="none", choices=["none", "mirrored", "multi-worker"], help="Data parallel training with tf.distribute: mirrored (all local GPUs) or multi-worker (one process per worker, cluster given by the TF_CONFIG environment variable, only the chief writes outputs). Every worker trains on its shard of each epoch and --batch-size is the global batch size")
+        	optional_train.add_argument("--checkpoint-dir", type=str, default=None, help="Save the full training state (model weights, optimizer state, epoch, early stopping and checkpoint callbacks, log sizes, random states) to this directory at the end of every epoch, for --resume. The directory must not hold the state of another run (continue that run with --resume instead)")
+        	optional_train.add_argument("--resume", type=str, default=None, help="Continue an interrupted run from the last training state saved to this --checkpoint-dir (and keep saving to it), with the same results as an uninterrupted run. Trains from scratch if the directory has no saved state yet. Augmentations drawn by --tf-data pipelines are not restored")
+        	optional_train.add_argument("--profile", action="store_true", default=False, help="Write per step timings (model step, batch generator __getitem__, examples/sec, host RSS) and the time of the generator rebuild at every epoch end to <output prefix>.profile.tsv, to tell whether training is bound by the input pipeline or by compute")
+        	optional_train.add_argument("--profile-steps", type=str, default=None, help="Write a tensorflow profiler trace (for tensorboard) of the training steps start,end (e.g. 10,20, counted over all epochs) to <output prefix>.profile_trace. Implies --profile")
+        	optional_train.add_argument("--intra-op-threads", type=int, default=0, help="Threads tensorflow runs a single op with (0 lets tensorflow decide)")
+        	optional_train.add_argument("--inter-op-threads", type=int, default=0, help="Threads tensorflow runs independent ops in parallel with (0 lets tensorflow decide)")
+        	optional_train.add_argument("--init-from", type=str, default=None, help="Warm start from a trained model .h5 (e.g. chrombpnet.h5 or chrombpnet_nobias.h5 of another replicate, or bias.h5 for bias models): trainable layers of the same name and shape start from its weights, frozen bias model layers are kept")
+        	optional_train.add_argument("--freeze-layers", type=int, default=0, help="Freeze the first convolution and the following (N-1) dilated convolutions of the trained model, e.g. when fine-tuning with --init-from")
+        	optional_train.add_argument("--cache-valid", action="store_true", default=False, help="Extract the validation examples once into tensors and validate every epoch on a tf.data pipeline of them, instead of the batch generator")
+        	optional_train.add_argument("--valid-subset", type=int, default=None, help="Validate every epoch (val_loss for checkpointing and early stopping) on a fixed sample of this many validation examples, stratified by peak/nonpeak and total counts, and on all validation examples once after training")
         	optional_train.add_argument("-track","--trackables",nargs="*",default=['logcount_predictions_loss', 'loss', 'logits_profile_predictions_loss', 'val_logcount_predictions_loss', 'val_loss', 'val_logits_profile_predictions_loss'], help="list of things to track per batch, such as logcount_predictions_loss,loss,profile_predictions_loss,val_logcount_predictions_loss,val_loss,val_profile_predictions_loss")
         	optional_train.add_argument("-a","--architecture-from-file",type=str,required=False, default=None, help="Model to use for training")
         	optional_train.add_argument("-fp","--file-prefix",type=str,required=False, default=None, help="File prefix for output to use. All the files will be prefixed with this string if provided.")
         	optional_train.add_argument('-hp', '--html-prefix', required=False, default="./", help="The html prefix to use for the html file output.")
+        	optional_train = data_loading_args(optional_train)
 
         	return required_train, optional_train
 
@@ -102,6 +133,23 @@ def read_parser():
         required_splits_parser.add_argument("-tcr", "--test-chroms", nargs="*", type=str, required=True, help="Chromosomes to use for test")
         required_splits_parser.add_argument("-vcr", "--valid-chroms", nargs="*", type=str, required=True, help="Chromosomes to use for validation")
 
+        # Generate genome index
+        genome_index_parser._action_groups.pop()
+        required_genome_index_parser = genome_index_parser.add_argument_group('required arguments')
+        optional_genome_index_parser = genome_index_parser.add_argument_group('optional arguments')
+
+        required_genome_index_parser.add_argument("-g", "--genome", type=str, required=True, help="reference genome fasta file")
+        optional_genome_index_parser.add_argument("-o", "--output-dir", type=str, default=None, help="Directory to write the genome index to. Defaults to <genome>.index, where it is used automatically whenever the fasta is passed with -g")
+
+        # Generate signal index
+        signal_index_parser._action_groups.pop()
+        required_signal_index_parser = signal_index_parser.add_argument_group('required arguments')
+        optional_signal_index_parser = signal_index_parser.add_argument_group('optional arguments')
+
+        required_signal_index_parser.add_argument("-i", "--bigwig", type=str, required=True, help="unstranded bigwig of counts")
+        optional_signal_index_parser.add_argument("-o", "--output-dir", type=str, default=None, help="Directory to write the signal index to. Defaults to <bigwig>.index, where it is used automatically whenever the bigwig is passed with -bw")
+        optional_signal_index_parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "uint16"], help="dtype to store values as, uint16 halves the index size and requires integer counts")
+
         # train chrombpnet arguments
 		
         train_parser._action_groups.pop()
@@ -153,6 +201,7 @@ def read_parser():
         optional_qc_parser.add_argument("-fp","--file-prefix",type=str,required=False, default=None, help="File prefix for output to use. All the files will be prefixed with this string if provided.")
         optional_qc_parser.add_argument("-bs", "--batch-size", type=int, default=64, help="batch size to use for model training")
         optional_qc_parser.add_argument('-hp', '--html-prefix', required=False, default="./", help="The html prefix to use for the html file output.")
+        optional_qc_parser = data_loading_args(optional_qc_parser)
  
 
         # bias model pipeline arguments
@@ -201,6 +250,7 @@ def read_parser():
         optional_bqc_parser.add_argument("-fp","--file-prefix",type=str,required=False, default=None, help="File prefix for output to use. All the files will be prefixed with this string if provided.")
         optional_bqc_parser.add_argument("-bs", "--batch-size", type=int, default=64, help="batch size to use for model training")
         optional_bqc_parser.add_argument('-hp', '--html-prefix', required=False, default="./", help="The html prefix to use for the html file output.")
+        optional_bqc_parser = data_loading_args(optional_bqc_parser)
  
 
         # Make prediction bigwigs
@@ -212,7 +262,7 @@ def read_parser():
         required_preds.add_argument("-bm", "--bias-model", type=str, required=False, help="Path to bias model h5 (atleast one of -bm, -cm, -cmb  is reqd)")
         required_preds.add_argument("-cm", "--chrombpnet-model", type=str, required=False, help="Path to chrombpnet model h5 (atleast one of -bm, -cm, -cmb is reqd)")
         required_preds.add_argument("-cmb", "--chrombpnet-model-nb", type=str, required=False, help="Path to chrombpnet no bias model h5 (atleast one of -bm, -cm, -cmb  is reqd)")
-        required_preds.add_argument("-r", "--regions", type=str, required=True, help="10 column bed file of regions for prediction")
+        required_preds.add_argument("-r", "--regions", type=str, required=False, help="10 column bed file of regions for prediction (reqd unless --tile is given)")
         required_preds.add_argument("-g", "--genome", type=str, required=True, help="Genome fasta")
         required_preds.add_argument("-c", "--chrom-sizes", type=str, required=True, help="Chromosome sizes 2 column tab-separated file")
         required_preds.add_argument("-op", "--output-prefix", type=str, required=True, help="Output prefix for bigwig files")
@@ -221,6 +271,11 @@ def read_parser():
         optional_preds.add_argument("-t", "--tqdm", type=int,default=1, help="Use tqdm. If yes then you need to have it installed.")
         optional_preds.add_argument("-d", "--debug-chr", nargs="+", type=str, default=None, help="Run for specific chromosomes only (e.g. chr1 chr2) for debugging")
         optional_preds.add_argument("-bw", "--bigwig", type=str, default=None, help="If provided .h5 with predictions are output along with calculated metrics considering bigwig as groundtruth.")
+        optional_preds.add_argument("--metrics-threads", type=int, default=1, help="Threads to compute profile metrics with")
+        optional_preds.add_argument("--tile", action="store_true", default=False, help="Predict genome-wide instead of in regions: every chromosome in --chrom-sizes (or --debug-chr) is tiled with windows of the model output length, edges padded with Ns")
+        optional_preds.add_argument("--tile-chunk", type=int, default=4096, help="Windows fetched and predicted at a time with --tile")
+        optional_preds.add_argument("--checkpoint-dir", type=str, default=None, help="With --tile, save the predictions of every chromosome to this directory and skip chromosomes already saved there when resuming. Directories holding predictions of another model, genome or input/output length are refused")
+        optional_preds.add_argument("--all-heads", action="store_true", default=False, help="Write the chrombpnet, chrombpnet_nobias and bias bigwigs from one pass of the chrombpnet model (-cm), using the no bias and bias models it contains, instead of -cmb and -bm")
        
         # Make contribution score bigwigs
         
@@ -286,6 +341,16 @@ def read_parser():
         optional_tfm.add_argument("-v", "--verbose", action="store_true", default=False, help="Controls the amount of output from the code.")
 
         
+        # Train folds from a single data extraction (same arguments as chrombpnet.training.train_folds)
+
+        argmanager.update_data_args(train_folds_parser, multiple_folds=True)
+        argmanager.update_train_args(train_folds_parser, multiple_folds=True)
+        argmanager.update_model_args(train_folds_parser)
+
+        # Schedule training jobs (same arguments as chrombpnet.training.schedule)
+
+        argmanager.update_schedule_args(schedule_parser)
+
         # Pull the arguments
         
         args = parser.parse_args()
@@ -70,6 +70,9 @@ def chrombpnet_train_pipeline(args):
 	args_copy.output_prefix = os.path.join(args.output_dir,"models/{}chrombpnet".format(fpx))
 	args_copy.params = os.path.join(args.output_dir,"logs/{}chrombpnet_model_params.tsv".format(fpx))
 	train.main(args_copy)
+	if not train.is_chief():
+		# the other workers of a multi-worker run stop after training
+		return
 	
 	# separating models from logs
 	os.rename(os.path.join(args.output_dir,"models/{}chrombpnet.log".format(fpx)),os.path.join(args.output_dir,"logs/{}chrombpnet.log".format(fpx)))
@@ -303,7 +306,11 @@ def train_bias_pipeline(args):
 	args_copy.nonpeaks = os.path.join(args_copy.output_dir,"auxiliary/{}filtered.bias_nonpeaks.bed".format(fpx))
 	args_copy.output_prefix = os.path.join(args_copy.output_dir,"models/{}bias".format(fpx))
 	args_copy.params = os.path.join(args_copy.output_dir,"logs/{}bias_model_params.tsv".format(fpx))
+	args_copy.precompute_bias = False # the bias model has no frozen bias model to precompute
 	train.main(args_copy)
+	if not train.is_chief():
+		# the other workers of a multi-worker run stop after training
+		return
 	
 	# separating models from logs
 	os.rename(os.path.join(args.output_dir,"models/{}bias.args.json".format(fpx)),os.path.join(args.output_dir,"logs/{}bias.args.json".format(fpx)))
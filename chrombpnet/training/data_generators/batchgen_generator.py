@@ -1,111 +1,426 @@
 from tensorflow import keras
 from chrombpnet.training.utils import augment
 from chrombpnet.training.utils import data_utils
+from chrombpnet.training.utils import one_hot
+from chrombpnet.training.utils import genome_index
+from chrombpnet.training.utils import signal_index
 import tensorflow as tf
 import numpy as np
 import random
 import string
+import copy
 import math
 import os
 import json
 
-def subsample_nonpeak_data(nonpeak_seqs, nonpeak_cts, nonpeak_coords, peak_data_size, negative_sampling_ratio):
-    #Randomly samples a portion of the non-peak data to use in training
-    num_nonpeak_samples = int(negative_sampling_ratio * peak_data_size)
-    nonpeak_indices_to_keep = np.random.choice(len(nonpeak_seqs), size=num_nonpeak_samples, replace=False)
-    nonpeak_seqs = nonpeak_seqs[nonpeak_indices_to_keep]
-    nonpeak_cts = nonpeak_cts[nonpeak_indices_to_keep]
-    nonpeak_coords = nonpeak_coords[nonpeak_indices_to_keep]
-    return nonpeak_seqs, nonpeak_cts, nonpeak_coords
+# examples run through the bias model at a time by precompute_bias
+BIAS_CHUNK_SIZE = 1024
+
+# quantiles of total counts stratified by get_subset
+SUBSET_COUNT_BINS = 10
+
+def get_free_memory():
+    # free physical memory in bytes, None where the platform does not report it
+    try:
+        return os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def is_augmented(num_peaks, num_nonpeaks, max_jitter, negative_sampling_ratio, add_revcomp, shuffle_at_epoch_start):
+    # whether epochs differ, i.e. whether crop_revcomp_data draws anything (e.g. not for validation)
+    subsample = (num_peaks > 0) and (num_nonpeaks > 0) and (negative_sampling_ratio < 1.0)
+    return (max_jitter > 0) or add_revcomp or shuffle_at_epoch_start or subsample
 
 class ChromBPNetBatchGenerator(keras.utils.Sequence):
     """
     This generator randomly crops (=jitter) and revcomps training examples for 
     every epoch, and calls bias model on it, whose outputs (bias profile logits 
     and bias logcounts) are fed as input to the chrombpnet model.
+
+    Augmentation is lazy: every epoch only draws the examples, crop starts, revcomp
+    flags and order (see augment.get_epoch_indices), and batches are cropped and
+    revcomped when they are requested.
     """
-    def __init__(self, peak_regions, nonpeak_regions, genome_fasta, batch_size, inputlen, outputlen, max_jitter, negative_sampling_ratio, cts_bw_file, add_revcomp, return_coords, shuffle_at_epoch_start):
+    def __init__(self, peak_regions, nonpeak_regions, genome_fasta, batch_size, inputlen, outputlen, max_jitter, negative_sampling_ratio, cts_bw_file, add_revcomp, return_coords, shuffle_at_epoch_start, cache_dir=None, pack_seqs=False, data=None):
         """
-        seqs: B x L' x 4
+        seqs: B x L' base codes (see one_hot.BASE_CODES), expanded to B x L x 4 one-hot per batch
         cts: B x M'
         inputlen: int (L <= L'), L' is greater to allow for cropping (= jittering)
         outputlen: int (M <= M'), M' is greater to allow for cropping (= jittering)
         batch_size: int (B)
+        cache_dir: directory to cache extracted data in (see data_utils.load_data), None disables caching
+        pack_seqs: keep sequences packed at 2 bits per base (see one_hot.pack_codes) instead of 1 byte per base
+        data: arrays of the regions as returned by data_utils.load_data (e.g. views from
+              data_utils.get_region_views), used instead of extracting them
         """
 
-        peak_seqs, peak_cts, peak_coords, nonpeak_seqs, nonpeak_cts, nonpeak_coords, = data_utils.load_data(peak_regions, nonpeak_regions, genome_fasta, cts_bw_file, inputlen, outputlen, max_jitter)
-        self.peak_seqs, self.nonpeak_seqs = peak_seqs, nonpeak_seqs
+        if data is None:
+            data = data_utils.load_data(peak_regions, nonpeak_regions, genome_fasta, cts_bw_file, inputlen, outputlen, max_jitter, cache_dir=cache_dir)
+        peak_seqs, peak_cts, peak_coords, nonpeak_seqs, nonpeak_cts, nonpeak_coords, = data
+        self.pack_seqs = pack_seqs
+        self.peak_seqs, self.nonpeak_seqs = self.pack(peak_seqs), self.pack(nonpeak_seqs)
         self.peak_cts, self.nonpeak_cts = peak_cts, nonpeak_cts
         self.peak_coords, self.nonpeak_coords = peak_coords, nonpeak_coords
+        # chromosome names of the chrom indices in coords
+        self.chrom_names = data_utils.get_chrom_table(peak_regions, nonpeak_regions)
 
         self.negative_sampling_ratio = negative_sampling_ratio
         self.inputlen = inputlen
         self.outputlen = outputlen
+        self.max_jitter = max_jitter
         self.batch_size = batch_size
         self.add_revcomp = add_revcomp
         self.return_coords = return_coords
         self.shuffle_at_epoch_start = shuffle_at_epoch_start
 
+        self.num_peaks = 0 if peak_cts is None else peak_cts.shape[0]
+        self.num_nonpeaks = 0 if nonpeak_cts is None else nonpeak_cts.shape[0]
+        self.augmented = is_augmented(self.num_peaks, self.num_nonpeaks, max_jitter, negative_sampling_ratio, add_revcomp, shuffle_at_epoch_start)
+
+        # bias outputs, set by precompute_bias
+        self.peak_bias = None
+        self.nonpeak_bias = None
+
+        # slice of every epoch used by this worker, set by shard
+        self.num_shards = 1
+        self.shard_index = 0
 
         # random crop training data to the desired sizes, revcomp augmentation
         self.crop_revcomp_data()
 
     def __len__(self):
 
-        return math.ceil(self.seqs.shape[0]/self.batch_size)
+        return math.ceil(self.cur_idx.shape[0]/self.batch_size)
+
+    def precompute_bias(self, get_bias_window_model, chunk_size=BIAS_CHUNK_SIZE):
+        """
+        Runs the frozen bias model once on every example, after which batches are
+        returned as ([seq, bias_logits, bias_logcounts], targets), the inputs of a
+        model built with precompute_bias (see chrombpnet_with_bias_model).
 
+        get_bias_window_model(max_jitter) returns a model mapping (inputlen+2*max_jitter)
+        sequences to the bias profile logits and log counts of all 2*max_jitter+1
+        crops of inputlen. Peaks are run on their extended (jitter) window, so every
+        crop of an epoch is a slice of these outputs. When revcomp augmentation is
+        used, the revcomped windows are run as well, since the bias model is not
+        strand symmetric.
+
+        The outputs are held in memory as float32: for every peak and strand the
+        profile logits of all crops (outputlen+2*max_jitter) and the log counts
+        (2*max_jitter+1), e.g. ~5.6GB for 250k peaks at outputlen 1000 and max_jitter
+        500 with revcomps, several times the base codes of the sequences. The size
+        is checked against the free memory before the outputs are allocated.
+        """
+        bias_bytes = self.get_bias_bytes()
+        print("precomputed bias outputs take {:.2f} GB".format(bias_bytes/2**30))
+        free_bytes = get_free_memory()
+        assert((free_bytes is None) or (bias_bytes < free_bytes)) # precomputed bias outputs do not fit in free memory, train without --precompute-bias
+        if self.num_peaks > 0:
+            self.peak_bias = self.predict_bias(get_bias_window_model(self.max_jitter), self.peak_seqs, self.num_peaks, self.inputlen+2*self.max_jitter, chunk_size)
+        if self.num_nonpeaks > 0:
+            self.nonpeak_bias = self.predict_bias(get_bias_window_model(0), self.nonpeak_seqs, self.num_nonpeaks, self.inputlen, chunk_size)
+
+    def get_bias_bytes(self):
+        # bytes of the outputs precompute_bias holds: float32 profile logits and log counts of every crop, per strand
+        num_strands = 2 if self.add_revcomp else 1
+        peak_bytes = self.num_peaks*((self.outputlen+2*self.max_jitter) + (2*self.max_jitter+1))
+        nonpeak_bytes = self.num_nonpeaks*(self.outputlen + 1)
+        return 4*num_strands*(peak_bytes + nonpeak_bytes)
+
+    def predict_bias(self, window_model, seqs, num_seqs, seq_len, chunk_size):
+        # (profile logits, log counts) of the forward windows, and of the revcomped windows if revcomps are used
+        strands = [False, True] if self.add_revcomp else [False]
+        bias = {}
+        for rc in strands:
+            # written chunk by chunk into preallocated arrays, so the outputs are not held twice
+            profs = np.empty((num_seqs, window_model.output_shape[0][1]), dtype=np.float32)
+            logcts = np.empty((num_seqs, window_model.output_shape[1][1]), dtype=np.float32)
+            for start in range(0, num_seqs, chunk_size):
+                rows = slice(start, min(start+chunk_size, num_seqs))
+                chunk = self.get_seq_rows(seqs, np.arange(rows.start, rows.stop), seq_len)
+                if rc:
+                    chunk = one_hot.revcomp_codes(chunk)
+                prof, logct = window_model.predict_on_batch(one_hot.codes_to_one_hot(chunk))
+                profs[rows] = prof
+                logcts[rows] = logct
+            bias[rc] = (profs, logcts)
+        return bias
+
+    def get_bias_rows(self, bias, rows, starts, rc, max_jitter):
+        # crop at start of a window is the crop at 2*max_jitter-start of the revcomped window
+        batch_prof = np.empty((rows.shape[0], self.outputlen), dtype=np.float32)
+        batch_logcts = np.empty((rows.shape[0], 1), dtype=np.float32)
+        for strand in bias:
+            sel = (rc == strand)
+            strand_starts = 2*max_jitter - starts[sel] if strand else starts[sel]
+            batch_prof[sel] = augment.take_per_row(bias[strand][0][rows[sel]], strand_starts, self.outputlen)
+            batch_logcts[sel, 0] = bias[strand][1][rows[sel], strand_starts]
+        return batch_prof, batch_logcts
+
+    def pack(self, seqs):
+        if (seqs is None) or (not self.pack_seqs):
+            return seqs
+        return one_hot.pack_codes(np.asarray(seqs))
+
+    def get_seq_rows(self, seqs, rows, seq_len):
+        if self.pack_seqs:
+            return one_hot.unpack_codes(seqs[0][rows], seqs[1][rows], seq_len)
+        return seqs[rows]
 
     def crop_revcomp_data(self):
         # random crop training data to inputlen and outputlen (with corresponding offsets), revcomp augmentation
         # shuffle required since otherwise peaks and nonpeaks will be together
         #Sample a fraction of the negative samples according to the specified ratio
-        if (self.peak_seqs is not None) and (self.nonpeak_seqs is not None):
-            # crop peak data before stacking
-            cropped_peaks, cropped_cnts, cropped_coords = augment.random_crop(self.peak_seqs, self.peak_cts, self.inputlen, self.outputlen, self.peak_coords)
-            #print(cropped_peaks.shape)
-            #print(self.nonpeak_seqs.shape)
-            if self.negative_sampling_ratio < 1.0:
-                self.sampled_nonpeak_seqs, self.sampled_nonpeak_cts, self.sampled_nonpeak_coords = subsample_nonpeak_data(self.nonpeak_seqs, self.nonpeak_cts, self.nonpeak_coords, len(self.peak_seqs), self.negative_sampling_ratio)
-                self.seqs = np.vstack([cropped_peaks, self.sampled_nonpeak_seqs])
-                self.cts = np.vstack([cropped_cnts, self.sampled_nonpeak_cts])
-                self.coords = np.vstack([cropped_coords, self.sampled_nonpeak_coords])
-            else:
-                self.seqs = np.vstack([cropped_peaks, self.nonpeak_seqs])
-                self.cts = np.vstack([cropped_cnts, self.nonpeak_cts])
-                self.coords = np.vstack([cropped_coords, self.nonpeak_coords])
-
-        elif self.peak_seqs is not None:
-            # crop peak data before stacking
-            cropped_peaks, cropped_cnts, cropped_coords = augment.random_crop(self.peak_seqs, self.peak_cts, self.inputlen, self.outputlen, self.peak_coords)
-
-            self.seqs = cropped_peaks
-            self.cts = cropped_cnts
-            self.coords = cropped_coords
-
-        elif self.nonpeak_seqs is not None:
-            #print(self.nonpeak_seqs.shape)
-
-            self.seqs = self.nonpeak_seqs
-            self.cts = self.nonpeak_cts
-            self.coords = self.nonpeak_coords
-        else :
+        if (self.num_peaks == 0) and (self.num_nonpeaks == 0):
             print("Both peak and non-peak arrays are empty")
 
-        self.cur_seqs, self.cur_cts, self.cur_coords = augment.crop_revcomp_augment(
-                                            self.seqs, self.cts, self.coords, self.inputlen, self.outputlen, 
-                                            self.add_revcomp, shuffle=self.shuffle_at_epoch_start
+        self.epoch = augment.get_epoch_indices(
+                                            self.num_peaks, self.num_nonpeaks, 2*self.max_jitter,
+                                            self.negative_sampling_ratio, self.add_revcomp,
+                                            shuffle=self.shuffle_at_epoch_start
                                           )
+        self.shard_epoch()
+
+    def shard(self, num_shards, shard_index):
+        """
+        Restricts every epoch to one of num_shards equal, disjoint slices of its examples,
+        for data parallel training where every worker holds a generator. Workers draw the
+        same epochs (same numpy seed), so together they cover an epoch once; the last
+        (< num_shards) examples of an epoch are dropped so that all shards have the same
+        number of batches.
+        """
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.shard_epoch()
+
+    def shard_epoch(self):
+        shard_len = self.epoch[1].shape[0] // self.num_shards
+        shard = slice(self.shard_index*shard_len, (self.shard_index+1)*shard_len)
+        self.cur_is_peak, self.cur_idx, self.cur_starts, self.cur_rc = [a[shard] for a in self.epoch]
+
+    def get_subset(self, num_examples, seed, num_count_bins=SUBSET_COUNT_BINS):
+        """
+        Copy of a generator without augmentation (e.g. validation) restricted to a fixed
+        sample of num_examples of its examples, stratified by peak/nonpeak and, within
+        each, by quantile of total counts: every stratum is sampled in proportion to its
+        share of the examples. The order of the examples is kept. seed only seeds the
+        sample, the numpy global random state is not used.
+        """
+        assert(not self.augmented) # the examples of an augmented generator change every epoch
+        num_total = self.cur_idx.shape[0]
+        if num_examples >= num_total:
+            return self
+
+        log_cts = np.concatenate([np.log1p(self.get_examples(slice(start, start+self.batch_size))[1].sum(-1)) for start in range(0, num_total, self.batch_size)])
+        strata = np.empty(num_total, dtype=np.int64)
+        for is_peak in [False, True]:
+            sel = (self.cur_is_peak == is_peak)
+            if sel.sum() > 0:
+                edges = np.quantile(log_cts[sel], np.linspace(0, 1, num_count_bins+1)[1:-1])
+                strata[sel] = is_peak*num_count_bins + np.searchsorted(edges, log_cts[sel], side="right")
+
+        # examples per stratum in proportion to its size, largest remainders get the rounded off examples
+        labels, sizes = np.unique(strata, return_counts=True)
+        quotas = num_examples*sizes/num_total
+        counts = np.floor(quotas).astype(np.int64)
+        counts[np.argsort(counts-quotas)[:num_examples-counts.sum()]] += 1
+
+        rng = np.random.RandomState(seed)
+        keep = np.concatenate([rng.choice(np.nonzero(strata==label)[0], size=count, replace=False) for label, count in zip(labels, counts)])
+        keep = np.sort(keep)
+
+        subset = copy.copy(self)
+        subset.epoch = tuple(a[keep] for a in [self.cur_is_peak, self.cur_idx, self.cur_starts, self.cur_rc])
+        subset.num_shards, subset.shard_index = 1, 0
+        subset.shard_epoch()
+        return subset
+
+    def get_examples(self, batch):
+        """
+        Examples of the current epoch in slice batch, before one-hot encoding: base codes
+        (B x L, see one_hot.BASE_CODES), counts (B x M) and the bias profile logits and
+        log counts (B x M, B x 1) set by precompute_bias (None without precompute_bias).
+        """
+        batch_is_peak = self.cur_is_peak[batch]
+        batch_idx = self.cur_idx[batch]
+        batch_rc = self.cur_rc[batch]
+        peak_rows = batch_idx[batch_is_peak]
+        nonpeak_rows = batch_idx[~batch_is_peak]
+
+        batch_seq = np.empty((batch_idx.shape[0], self.inputlen), dtype=np.uint8)
+        batch_cts = np.empty((batch_idx.shape[0], self.outputlen), dtype=np.float64)
+
+        if peak_rows.shape[0] > 0:
+            peak_starts = self.cur_starts[batch][batch_is_peak]
+            batch_seq[batch_is_peak] = augment.take_per_row(self.get_seq_rows(self.peak_seqs, peak_rows, self.inputlen+2*self.max_jitter), peak_starts, self.inputlen)
+            batch_cts[batch_is_peak] = augment.take_per_row(self.peak_cts[peak_rows], peak_starts, self.outputlen)
+        if nonpeak_rows.shape[0] > 0:
+            batch_seq[~batch_is_peak] = self.get_seq_rows(self.nonpeak_seqs, nonpeak_rows, self.inputlen)
+            batch_cts[~batch_is_peak] = self.nonpeak_cts[nonpeak_rows]
+
+        batch_seq[batch_rc] = one_hot.revcomp_codes(batch_seq[batch_rc])
+        batch_cts[batch_rc] = batch_cts[batch_rc, ::-1]
+
+        batch_bias = None
+        if (self.peak_bias is not None) or (self.nonpeak_bias is not None):
+            batch_bias_prof = np.empty((batch_idx.shape[0], self.outputlen), dtype=np.float32)
+            batch_bias_logcts = np.empty((batch_idx.shape[0], 1), dtype=np.float32)
+            if peak_rows.shape[0] > 0:
+                batch_bias_prof[batch_is_peak], batch_bias_logcts[batch_is_peak] = self.get_bias_rows(self.peak_bias, peak_rows, peak_starts, batch_rc[batch_is_peak], self.max_jitter)
+            if nonpeak_rows.shape[0] > 0:
+                batch_bias_prof[~batch_is_peak], batch_bias_logcts[~batch_is_peak] = self.get_bias_rows(self.nonpeak_bias, nonpeak_rows, np.zeros(nonpeak_rows.shape[0], dtype=np.int64), batch_rc[~batch_is_peak], 0)
+            batch_bias = [batch_bias_prof, batch_bias_logcts]
+
+        return batch_seq, batch_cts, batch_bias
+
+    def get_coords(self, batch):
+        batch_is_peak = self.cur_is_peak[batch]
+        batch_idx = self.cur_idx[batch]
+        peak_rows = batch_idx[batch_is_peak]
+        nonpeak_rows = batch_idx[~batch_is_peak]
+
+        batch_coords = np.empty(batch_idx.shape[0], dtype=data_utils.COORDS_DTYPE)
+        if peak_rows.shape[0] > 0:
+            # same co-ordinates as reported by augment.random_crop
+            peak_coords = self.peak_coords[peak_rows]
+            peak_coords["pos"] += self.cur_starts[batch][batch_is_peak] - (self.inputlen+2*self.max_jitter)//2
+            batch_coords[batch_is_peak] = peak_coords
+        if nonpeak_rows.shape[0] > 0:
+            batch_coords[~batch_is_peak] = self.nonpeak_coords[nonpeak_rows]
+        batch_coords["rc"] = self.cur_rc[batch]
+        return batch_coords
 
     def __getitem__(self, idx):
-        batch_seq = self.cur_seqs[idx*self.batch_size:(idx+1)*self.batch_size]
-        batch_cts = self.cur_cts[idx*self.batch_size:(idx+1)*self.batch_size]
-        batch_coords = self.cur_coords[idx*self.batch_size:(idx+1)*self.batch_size]
+        batch = slice(idx*self.batch_size, (idx+1)*self.batch_size)
+        batch_seq, batch_cts, batch_bias = self.get_examples(batch)
+        batch_seq = one_hot.codes_to_one_hot(batch_seq)
+        if batch_bias is not None:
+            batch_seq = [batch_seq] + batch_bias
 
         if self.return_coords:
-            return (batch_seq, [batch_cts, np.log(1+batch_cts.sum(-1, keepdims=True))], batch_coords)
+            return (batch_seq, [batch_cts, np.log(1+batch_cts.sum(-1, keepdims=True))], self.get_coords(batch))
         else:
             return (batch_seq, [batch_cts, np.log(1+batch_cts.sum(-1, keepdims=True))])
 
     def on_epoch_end(self):
+        # epochs without augmentation are all the same, no need to draw them again
+        if self.augmented:
+            self.crop_revcomp_data()
+
+
+class ChromBPNetStreamingBatchGenerator(keras.utils.Sequence):
+    """
+    Out-of-core version of ChromBPNetBatchGenerator. Only the region co-ordinates
+    are held in memory, every epoch draws the jitter offsets, revcomp flags and
+    example order, and the sequences and counts of a batch are fetched from the
+    genome fasta and bigwig when the batch is requested. Memory use therefore does
+    not grow with the number of regions, at the cost of reading every batch from disk.
+
+    Random draws are made in the same order as ChromBPNetBatchGenerator, so with the
+    same numpy seed both generators yield the same batches.
+    """
+    def __init__(self, peak_regions, nonpeak_regions, genome_fasta, batch_size, inputlen, outputlen, max_jitter, negative_sampling_ratio, cts_bw_file, add_revcomp, return_coords, shuffle_at_epoch_start):
+        """
+        peak_regions, nonpeak_regions: dataframes with minimally chr, start and summit columns (or None)
+        inputlen: int (L)
+        outputlen: int (M)
+        max_jitter: int, peaks are jittered by up to +/- max_jitter around the summit
+        batch_size: int (B)
+        """
+
+        self.genome_fasta = genome_fasta
+        self.cts_bw_file = cts_bw_file
+        # file handles are opened on first use, so that the generator can be copied
+        # to worker processes before any file is opened
+        self.genome = None
+        self.cts_bw = None
+
+        # chromosome names of the chrom indices in coords
+        self.chrom_names = data_utils.get_chrom_table(peak_regions, nonpeak_regions)
+        self.peak_chroms, self.peak_summits = self.get_summits(peak_regions)
+        self.nonpeak_chroms, self.nonpeak_summits = self.get_summits(nonpeak_regions)
+
+        self.negative_sampling_ratio = negative_sampling_ratio
+        self.inputlen = inputlen
+        self.outputlen = outputlen
+        self.max_jitter = max_jitter
+        self.batch_size = batch_size
+        self.add_revcomp = add_revcomp
+        self.return_coords = return_coords
+        self.shuffle_at_epoch_start = shuffle_at_epoch_start
+
+        num_peaks = 0 if self.peak_summits is None else self.peak_summits.shape[0]
+        num_nonpeaks = 0 if self.nonpeak_summits is None else self.nonpeak_summits.shape[0]
+        self.augmented = is_augmented(num_peaks, num_nonpeaks, max_jitter, negative_sampling_ratio, add_revcomp, shuffle_at_epoch_start)
+
+        # random crop training data to the desired sizes, revcomp augmentation
         self.crop_revcomp_data()
 
+    def get_summits(self, regions):
+        if regions is None:
+            return None, None
+        return data_utils.get_chrom_ids(regions['chr'].values, self.chrom_names), (regions['start'].values + regions['summit'].values).astype(np.int64)
+
+    def __len__(self):
+
+        return math.ceil(self.cur_summits.shape[0]/self.batch_size)
+
+    def crop_revcomp_data(self):
+        # draw jitter offsets for peaks, subsample nonpeaks and pick the examples to
+        # revcomp and the order of examples. cur_summits are the jittered centers.
+        num_peaks = 0 if self.peak_summits is None else self.peak_summits.shape[0]
+        num_nonpeaks = 0 if self.nonpeak_summits is None else self.nonpeak_summits.shape[0]
+        if (num_peaks == 0) and (num_nonpeaks == 0):
+            print("Both peak and non-peak arrays are empty")
+
+        is_peak, idx, starts, self.cur_rc = augment.get_epoch_indices(
+                                            num_peaks, num_nonpeaks, 2*self.max_jitter,
+                                            self.negative_sampling_ratio, self.add_revcomp,
+                                            shuffle=self.shuffle_at_epoch_start
+                                          )
+
+        self.cur_chroms = np.empty(idx.shape[0], dtype=np.int32)
+        self.cur_summits = np.empty(idx.shape[0], dtype=np.int64)
+        self.cur_coord_pos = np.empty(idx.shape[0], dtype=np.int64)
+        if num_peaks > 0:
+            self.cur_chroms[is_peak] = self.peak_chroms[idx[is_peak]]
+            self.cur_summits[is_peak] = self.peak_summits[idx[is_peak]] - self.max_jitter + starts[is_peak]
+            # same co-ordinates as reported by augment.random_crop
+            self.cur_coord_pos[is_peak] = self.peak_summits[idx[is_peak]] - (self.inputlen+2*self.max_jitter)//2 + starts[is_peak]
+        if num_nonpeaks > 0:
+            self.cur_chroms[~is_peak] = self.nonpeak_chroms[idx[~is_peak]]
+            self.cur_summits[~is_peak] = self.nonpeak_summits[idx[~is_peak]]
+            self.cur_coord_pos[~is_peak] = self.nonpeak_summits[idx[~is_peak]]
+        self.cur_is_peak = is_peak
+
+    def __getitem__(self, idx):
+        if self.genome is None:
+            self.genome = genome_index.open_genome(self.genome_fasta)
+            self.cts_bw = signal_index.open_signal(self.cts_bw_file)
+
+        batch = slice(idx*self.batch_size, (idx+1)*self.batch_size)
+        batch_chroms = self.chrom_names[self.cur_chroms[batch]]
+        batch_summits = self.cur_summits[batch]
+        batch_rc = self.cur_rc[batch]
+
+        batch_seq = data_utils.fetch_codes(self.genome, batch_chroms, batch_summits - self.inputlen//2, self.inputlen)
+        batch_cts = data_utils.fetch_cts(self.cts_bw, batch_chroms, batch_summits - self.outputlen//2, self.outputlen)
+
+        batch_seq[batch_rc] = one_hot.revcomp_codes(batch_seq[batch_rc])
+        batch_cts[batch_rc] = batch_cts[batch_rc, ::-1]
+        batch_seq = one_hot.codes_to_one_hot(batch_seq)
+
+        if self.return_coords:
+            batch_coords = np.empty(batch_summits.shape[0], dtype=data_utils.COORDS_DTYPE)
+            batch_coords["chrom"] = self.cur_chroms[batch]
+            batch_coords["pos"] = self.cur_coord_pos[batch]
+            batch_coords["rc"] = batch_rc
+            batch_coords["peak"] = self.cur_is_peak[batch]
+            return (batch_seq, [batch_cts, np.log(1+batch_cts.sum(-1, keepdims=True))], batch_coords)
+        else:
+            return (batch_seq, [batch_cts, np.log(1+batch_cts.sum(-1, keepdims=True))])
+
+    def on_epoch_end(self):
+        # epochs without augmentation are all the same, no need to draw them again
+        if self.augmented:
+            self.crop_revcomp_data()
@@ -1,4 +1,5 @@
 import chrombpnet.training.data_generators.batchgen_generator as batchgen_generator
+import chrombpnet.training.data_generators.tf_dataset as tf_dataset
 from chrombpnet.training.utils import data_utils
 import pandas as pd
 import json
@@ -55,28 +56,65 @@ def get_bed_regions_for_fold_split(bed_regions, mode, splits_dict):
     print("got split:"+str(mode)+" for bed regions:"+str(bed_regions_to_keep.shape))
     return bed_regions_to_keep, chroms_to_keep
 
-def initialize_generators(args, mode, parameters, return_coords):
+def read_regions(args):
 
     # defaults
     peak_regions=None
     nonpeak_regions=None
 
-    # get only those peak/non peak regions corresponding to train/valid/test set
-    splits_dict=json.load(open(args.chr_fold_path))
-
     if args.peaks.lower() != "none":
         print("loading peaks...")
         peak_regions=pd.read_csv(args.peaks,header=None,sep='\t',names=NARROWPEAK_SCHEMA)
-        peak_regions, chroms=get_bed_regions_for_fold_split(peak_regions, mode, splits_dict)
 
     if args.nonpeaks.lower() != "none":
         print("loading nonpeaks...")
         nonpeak_regions=pd.read_csv(args.nonpeaks,header=None,sep='\t',names=NARROWPEAK_SCHEMA)
+
+    return peak_regions, nonpeak_regions
+
+def get_fold_regions(peak_regions, nonpeak_regions, mode, splits_dict):
+
+    if peak_regions is not None:
+        peak_regions, chroms=get_bed_regions_for_fold_split(peak_regions, mode, splits_dict)
+
+    if nonpeak_regions is not None:
         nonpeak_regions, chroms=get_bed_regions_for_fold_split(nonpeak_regions, mode, splits_dict) 
 
+    return peak_regions, nonpeak_regions
+
+def get_regions_for_mode(args, mode):
+
+    # get only those peak/non peak regions corresponding to train/valid/test set
+    splits_dict=json.load(open(args.chr_fold_path))
+    peak_regions, nonpeak_regions = read_regions(args)
+    return get_fold_regions(peak_regions, nonpeak_regions, mode, splits_dict)
+
+def initialize_generators(args, mode, parameters, return_coords):
+
+    peak_regions, nonpeak_regions = get_regions_for_mode(args, mode)
+
     inputlen, outputlen, \
     nonpeak_regions, negative_sampling_ratio, \
     max_jitter, add_revcomp, shuffle_at_epoch_start  =  fetch_data_and_model_params_based_on_mode(mode, args, parameters, nonpeak_regions, peak_regions)
+
+    if args.streaming:
+        # only co-ordinates are held in memory, batches are read from disk
+        generator=batchgen_generator.ChromBPNetStreamingBatchGenerator(
+                                    peak_regions=peak_regions,
+                                    nonpeak_regions=nonpeak_regions,
+                                    genome_fasta=args.genome,
+                                    batch_size=args.batch_size,
+                                    inputlen=inputlen,
+                                    outputlen=outputlen,
+                                    max_jitter=max_jitter,
+                                    negative_sampling_ratio=negative_sampling_ratio,
+                                    cts_bw_file=args.bigwig,
+                                    add_revcomp=add_revcomp,
+                                    return_coords=return_coords,
+                                    shuffle_at_epoch_start=shuffle_at_epoch_start
+                                    )
+        return generator
+
     generator=batchgen_generator.ChromBPNetBatchGenerator(
                                     peak_regions=peak_regions,
                                     nonpeak_regions=nonpeak_regions,
@@ -89,7 +127,93 @@ def initialize_generators(args, mode, parameters, return_coords):
                                     cts_bw_file=args.bigwig,
                                     add_revcomp=add_revcomp,
                                     return_coords=return_coords,
-                                    shuffle_at_epoch_start=shuffle_at_epoch_start
+                                    shuffle_at_epoch_start=shuffle_at_epoch_start,
+                                    cache_dir=args.cache_dir,
+                                    pack_seqs=args.pack_seqs
                                     )
     
     return generator
+
+def load_fold_data(args, parameters):
+    """
+    Extracts sequences and counts of all peaks and nonpeaks once (peaks with the jitter
+    of training), for initialize_fold_generators to build the generators of any fold of
+    these regions from. Folds must share inputlen, outputlen and max_jitter.
+    Returns the regions, the extracted arrays (see data_utils.load_data) and max_jitter.
+    """
+    peak_regions, nonpeak_regions = read_regions(args)
+    max_jitter=int(parameters["max_jitter"])
+    data=data_utils.load_data(peak_regions, nonpeak_regions, args.genome, args.bigwig, int(parameters["inputlen"]), int(parameters["outputlen"]), max_jitter, cache_dir=args.cache_dir)
+    return peak_regions, nonpeak_regions, data, max_jitter
+
+def initialize_fold_generators(args, mode, parameters, fold_data, return_coords):
+    """
+    Same as initialize_generators, but the generator reads views (see
+    data_utils.get_region_views) of the fold's regions from the arrays extracted
+    by load_fold_data, instead of extracting the data of the fold.
+    """
+
+    all_peak_regions, all_nonpeak_regions, data, data_max_jitter = fold_data
+    splits_dict=json.load(open(args.chr_fold_path))
+    peak_regions, nonpeak_regions = get_fold_regions(all_peak_regions, all_nonpeak_regions, mode, splits_dict)
+
+    inputlen, outputlen, \
+    nonpeak_regions, negative_sampling_ratio, \
+    max_jitter, add_revcomp, shuffle_at_epoch_start  =  fetch_data_and_model_params_based_on_mode(mode, args, parameters, nonpeak_regions, peak_regions)
+
+    # regions were read with the default index, so index labels are rows of the extracted arrays
+    peak_rows = None if peak_regions is None else peak_regions.index.values
+    nonpeak_rows = None if nonpeak_regions is None else nonpeak_regions.index.values
+    views = data_utils.get_region_views(data, data_utils.get_chrom_table(all_peak_regions, all_nonpeak_regions),
+                                        peak_rows, nonpeak_rows, data_max_jitter, max_jitter,
+                                        data_utils.get_chrom_table(peak_regions, nonpeak_regions))
+
+    generator=batchgen_generator.ChromBPNetBatchGenerator(
+                                    peak_regions=peak_regions,
+                                    nonpeak_regions=nonpeak_regions,
+                                    genome_fasta=args.genome,
+                                    batch_size=args.batch_size,
+                                    inputlen=inputlen,
+                                    outputlen=outputlen,
+                                    max_jitter=max_jitter,
+                                    negative_sampling_ratio=negative_sampling_ratio,
+                                    cts_bw_file=args.bigwig,
+                                    add_revcomp=add_revcomp,
+                                    return_coords=return_coords,
+                                    shuffle_at_epoch_start=shuffle_at_epoch_start,
+                                    pack_seqs=args.pack_seqs,
+                                    data=views
+                                    )
+
+    return generator
+
+def initialize_datasets(args, mode, parameters):
+    """
+    Same as initialize_generators, but returns a tf.data.Dataset (see tf_dataset.get_dataset)
+    with the same train/valid/test semantics. Co-ordinates are not returned.
+    """
+
+    assert(not args.streaming) # tf.data pipeline holds the extracted data in memory, can not be used with --streaming
+
+    peak_regions, nonpeak_regions = get_regions_for_mode(args, mode)
+
+    inputlen, outputlen, \
+    nonpeak_regions, negative_sampling_ratio, \
+    max_jitter, add_revcomp, shuffle_at_epoch_start  =  fetch_data_and_model_params_based_on_mode(mode, args, parameters, nonpeak_regions, peak_regions)
+
+    dataset=tf_dataset.get_dataset(
+                                    peak_regions=peak_regions,
+                                    nonpeak_regions=nonpeak_regions,
+                                    genome_fasta=args.genome,
+                                    batch_size=args.batch_size,
+                                    inputlen=inputlen,
+                                    outputlen=outputlen,
+                                    max_jitter=max_jitter,
+                                    negative_sampling_ratio=negative_sampling_ratio,
+                                    cts_bw_file=args.bigwig,
+                                    add_revcomp=add_revcomp,
+                                    shuffle_at_epoch_start=shuffle_at_epoch_start,
+                                    cache_dir=args.cache_dir
+                                    )
+
+    return dataset
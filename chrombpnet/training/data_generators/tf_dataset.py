@@ -0,0 +1,145 @@
+from chrombpnet.training.utils import data_utils
+from chrombpnet.training.utils import one_hot
+import tensorflow as tf
+import numpy as np
+
+# index of the source array of an example
+PEAK = 0
+NONPEAK = 1
+
+def get_index_dataset(num_peaks, num_nonpeaks, negative_sampling_ratio, shuffle_at_epoch_start, shuffle_seeds=(None, None)):
+    """
+    Dataset of (source, index) pairs, one per example of an epoch. Negatives are
+    subsampled and examples shuffled again every time the dataset is iterated,
+    i.e. at the start of every epoch. shuffle_seeds seed the subsampling and the
+    shuffle (e.g. per epoch, see get_dataset).
+    """
+    peak_ds = tf.data.Dataset.from_tensor_slices((tf.fill([num_peaks], PEAK), tf.range(num_peaks)))
+    nonpeak_ds = tf.data.Dataset.from_tensor_slices((tf.fill([num_nonpeaks], NONPEAK), tf.range(num_nonpeaks)))
+
+    if (num_peaks > 0) and (num_nonpeaks > 0) and (negative_sampling_ratio < 1.0):
+        # randomly samples a portion of the non-peak data to use in this epoch
+        num_nonpeak_samples = int(negative_sampling_ratio * num_peaks)
+        nonpeak_ds = nonpeak_ds.shuffle(num_nonpeaks, seed=shuffle_seeds[0], reshuffle_each_iteration=True).take(num_nonpeak_samples)
+
+    ds = peak_ds.concatenate(nonpeak_ds)
+    if shuffle_at_epoch_start:
+        # shuffle required since otherwise peaks and nonpeaks will be together
+        ds = ds.shuffle(num_peaks + num_nonpeaks, seed=shuffle_seeds[1], reshuffle_each_iteration=True)
+    return ds
+
+def as_tensor(arr, shape, dtype):
+    # empty placeholder for missing peak/nonpeak arrays, so that a batch can always gather from both
+    if arr is None:
+        return tf.zeros(shape, dtype=dtype)
+    return tf.convert_to_tensor(np.asarray(arr), dtype=dtype)
+
+def get_dataset(peak_regions, nonpeak_regions, genome_fasta, batch_size, inputlen, outputlen, max_jitter, negative_sampling_ratio, cts_bw_file, add_revcomp, shuffle_at_epoch_start, cache_dir=None):
+    """
+    tf.data version of batchgen_generator.ChromBPNetBatchGenerator. Sequences and counts
+    are extracted once (see data_utils.load_data), after which batches of examples are
+    jittered (random crop of peaks), reverse complemented, and their count targets
+    computed in parallel map calls, and prefetched while the model trains on the previous batch.
+
+    Yields (seq, (cts, log(1+sum(cts)))) batches: B x L x 4, B x M and B x 1 float32.
+    Unlike the generator, each example is revcomped with probability 0.5 instead of
+    exactly half of the examples of an epoch.
+    """
+
+    peak_seqs, peak_cts, _, nonpeak_seqs, nonpeak_cts, _ = data_utils.load_data(peak_regions, nonpeak_regions, genome_fasta, cts_bw_file, inputlen, outputlen, max_jitter, cache_dir=cache_dir)
+    if (peak_seqs is None) and (nonpeak_seqs is None):
+        print("Both peak and non-peak arrays are empty")
+
+    num_peaks = 0 if peak_seqs is None else peak_seqs.shape[0]
+    num_nonpeaks = 0 if nonpeak_seqs is None else nonpeak_seqs.shape[0]
+
+    # peaks are extracted with 2*max_jitter flanks, nonpeaks are not jittered
+    peak_seqs = as_tensor(peak_seqs, (0, inputlen+2*max_jitter), tf.uint8)
+    peak_cts = as_tensor(peak_cts, (0, outputlen+2*max_jitter), tf.float32)
+    nonpeak_seqs = as_tensor(nonpeak_seqs, (0, inputlen), tf.uint8)
+    nonpeak_cts = as_tensor(nonpeak_cts, (0, outputlen), tf.float32)
+
+    # draws are stateless and seeded by (seed, epoch, batch index), so that they do not depend
+    # on the order the parallel map calls run in. The seed is drawn from numpy, so --seed applies,
+    # and the epoch is counted up every time the dataset is iterated.
+    seed = tf.constant(np.random.randint(2**31), dtype=tf.int64)
+    epoch = tf.Variable(-1, dtype=tf.int64, trainable=False)
+
+    rc_codes = tf.constant(one_hot.RC_CODES, dtype=tf.int32)
+    seq_window = tf.range(inputlen)
+    cts_window = tf.range(outputlen)
+
+    def crop_revcomp_batch(cur_epoch, batch, src, idx):
+        crop_seed, rc_seed = tf.unstack(tf.random.experimental.stateless_split(
+            tf.random.experimental.stateless_fold_in(tf.stack([seed, cur_epoch]), batch), 2))
+
+        batch_pos = tf.range(tf.shape(src)[0])
+        is_peak = tf.equal(src, PEAK)
+        peak_pos = tf.boolean_mask(batch_pos, is_peak)
+        nonpeak_pos = tf.boolean_mask(batch_pos, tf.logical_not(is_peak))
+        peak_idx = tf.boolean_mask(idx, is_peak)
+        nonpeak_idx = tf.boolean_mask(idx, tf.logical_not(is_peak))
+
+        # random crop peaks to inputlen and outputlen (with corresponding offsets)
+        starts = tf.random.stateless_uniform(tf.shape(peak_idx), crop_seed, minval=0, maxval=2*max_jitter+1, dtype=tf.int32)
+        batch_peak_seqs = tf.gather(tf.gather(peak_seqs, peak_idx), starts[:, None] + seq_window, batch_dims=1)
+        batch_peak_cts = tf.gather(tf.gather(peak_cts, peak_idx), starts[:, None] + cts_window, batch_dims=1)
+
+        # restore the order of the batch
+        seqs = tf.dynamic_stitch([peak_pos, nonpeak_pos], [batch_peak_seqs, tf.gather(nonpeak_seqs, nonpeak_idx)])
+        cts = tf.dynamic_stitch([peak_pos, nonpeak_pos], [batch_peak_cts, tf.gather(nonpeak_cts, nonpeak_idx)])
+        seqs = tf.cast(seqs, tf.int32)
+
+        if add_revcomp:
+            # seqs are base codes, revcomp is a lookup of the reversed codes
+            rc = tf.random.stateless_uniform(tf.shape(batch_pos), rc_seed) < 0.5
+            seqs = tf.where(rc[:, None], tf.gather(rc_codes, tf.reverse(seqs, axis=[1])), seqs)
+            cts = tf.where(rc[:, None], tf.reverse(cts, axis=[1]), cts)
+
+        # one-hot in ACGT order, the N code (4) is out of range and encoded as all 0s
+        seqs = tf.one_hot(seqs, depth=4, dtype=tf.float32)
+        return seqs, (cts, tf.math.log(1+tf.reduce_sum(cts, axis=-1, keepdims=True)))
+
+    def get_epoch_batches(cur_epoch):
+        # batches of the epoch with their epoch and batch index, subsampled and shuffled per epoch
+        shuffle_seeds = tf.unstack(tf.random.stateless_uniform([2], tf.stack([seed, cur_epoch]), minval=None, maxval=None, dtype=tf.int64))
+        batches = get_index_dataset(num_peaks, num_nonpeaks, negative_sampling_ratio, shuffle_at_epoch_start, shuffle_seeds)
+        batches = batches.batch(batch_size).enumerate()
+        return batches.map(lambda batch, examples: (cur_epoch, batch) + examples)
+
+    # the epoch is counted up sequentially, once at the start of every iteration
+    ds = tf.data.Dataset.from_tensors(0).map(lambda _: epoch.assign_add(1))
+    ds = ds.flat_map(get_epoch_batches)
+    ds = ds.map(crop_revcomp_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.prefetch(tf.data.AUTOTUNE)
+
+    return ds
+
+def get_cached_dataset(generator):
+    """
+    Dataset of the batches of a batchgen_generator.ChromBPNetBatchGenerator without
+    augmentation (e.g. validation), whose batches are the same every epoch. The examples
+    are extracted from the generator once and held as tensors of base codes, counts and
+    precomputed bias outputs, and batches are one-hot encoded in the graph, so iterating
+    the dataset again every epoch runs no python.
+    """
+    assert(not generator.augmented) # the batches of an augmented generator change every epoch
+
+    seqs, cts, bias = generator.get_examples(slice(None))
+    examples = [tf.constant(seqs), tf.constant(cts, dtype=tf.float32)]
+    if bias is not None:
+        examples += [tf.constant(b, dtype=tf.float32) for b in bias]
+
+    def to_model_batch(seqs, cts, *bias):
+        # one-hot in ACGT order, the N code (4) is out of range and encoded as all 0s
+        seqs = tf.one_hot(tf.cast(seqs, tf.int32), depth=4, dtype=tf.float32)
+        if len(bias) > 0:
+            seqs = (seqs,) + bias
+        return seqs, (cts, tf.math.log(1+tf.reduce_sum(cts, axis=-1, keepdims=True)))
+
+    ds = tf.data.Dataset.from_tensor_slices(tuple(examples))
+    ds = ds.batch(generator.batch_size)
+    ds = ds.map(to_model_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.prefetch(tf.data.AUTOTUNE)
+
+    return ds
@@ -1,7 +1,8 @@
 import numpy as np 
 import argparse
 from scipy.stats import spearmanr, pearsonr
-from scipy.spatial.distance import jensenshannon
+from scipy.special import gammaln
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
@@ -10,6 +11,10 @@ from matplotlib.colors import Normalize
 from scipy.interpolate import interpn
 from chrombpnet.training.utils.metrics_utils import * 
 
+# regions computed on at a time by profile_metrics, the temporary arrays of a chunk of
+# 1000bp profiles (2MB) stay in cache, larger chunks are up to 2x slower
+METRICS_CHUNK_ROWS = 256
+
 plt.rcParams["figure.figsize"]=10,5
 font = {'weight' : 'bold',
         'size'   : 10}
@@ -40,57 +45,103 @@ def counts_metrics(labels,preds,outf,title):
     
     return spearman_cor, pearson_cor, mse
 
-def profile_metrics(true_counts,pred_probs,pseudocount=0.001):
+# log(k!) of the integer counts below its size, gammaln is used for other counts
+LOG_FACTORIAL_TABLE = gammaln(np.arange(1, 2**16+1, dtype=np.float64))
+
+def xlogx(x):
+    # x*log(x) with 0*log(0) = 0
+    return x*np.log(x + (x == 0))
+
+def sum_log_factorial(counts):
+    # sum of log(count!) of every row
+    ints = counts.astype(np.int64)
+    in_table = (ints == counts) & (ints < LOG_FACTORIAL_TABLE.shape[0])
+    vals = LOG_FACTORIAL_TABLE[np.where(in_table, ints, 0)]
+    if not in_table.all():
+        vals[~in_table] = gammaln(counts[~in_table]+1)
+    return np.sum(vals, axis=1)
+
+def jsd_rows(p, q, p_entropy, q_entropy):
     '''
-    Get profile metrics
+    scipy.spatial.distance.jensenshannon of every row of the probabilities p and q,
+    given the sums of x*log(x) of their rows
     '''
-    mnll_pw = []
-    mnll_norm = []
-
-    jsd_pw = []
-    jsd_norm = []
-    jsd_rnd = []
-    jsd_rnd_norm = []
-    mnll_rnd = []
-    mnll_rnd_norm = []
+    js = p_entropy + q_entropy - 2*np.sum(xlogx((p + q)/2.0), axis=1)
+    return np.sqrt(np.maximum(js, 0) / 2.0)
 
-    num_regions = true_counts.shape[0]
-    for idx in range(num_regions):
-        # mnll
-        #curr_mnll = mnll(true_counts[idx,:],  probs=pred_probs[idx,:])
-        #mnll_pw.append(curr_mnll)
-        # normalized mnll
-        #min_mnll, max_mnll = mnll_min_max_bounds(true_counts[idx,:])
-        #curr_mnll_norm = get_min_max_normalized_value(curr_mnll, min_mnll, max_mnll)
-        #mnll_norm.append(curr_mnll_norm)
-
-        # jsd
-        cur_jsd=jensenshannon(true_counts[idx,:]/(pseudocount+np.nansum(true_counts[idx,:])),pred_probs[idx,:])
-        jsd_pw.append(cur_jsd)
-        # normalized jsd
-        min_jsd, max_jsd = jsd_min_max_bounds(true_counts[idx,:])
-        curr_jsd_norm = get_min_max_normalized_value(cur_jsd, min_jsd, max_jsd)
-        jsd_norm.append(curr_jsd_norm)
+def min_max_normalize(vals, minimum, maximum):
+    # metrics_utils.get_min_max_normalized_value of arrays
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.clip((vals - maximum) / (minimum - maximum), 0, 1)
 
+def profile_metrics_chunk(true_counts, pred_probs, seed, pseudocount):
+    '''
+    profile_metrics of a chunk of regions. jsd is computed from entropies and mnll
+    (metrics_utils.mnll, with the probabilities renormalized to sum to 1) from
+    log(k!) and k*log(p) terms, only with numpy logs, which are several times faster
+    than scipy's rel_entr, xlogy and gammaln.
+    '''
+    true_counts = np.asarray(true_counts, dtype=np.float64)
+    pred_probs = np.asarray(pred_probs, dtype=np.float64)
+    num_positions = true_counts.shape[1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        total = np.sum(true_counts, axis=1)
+        # jensenshannon normalizes its inputs, the pseudocount of the labels cancels out
+        true_probs = true_counts/total[:,None]
+        pred_probs = pred_probs/np.sum(pred_probs, axis=1, keepdims=True)
         # get random shuffling on labels for a worst case performance on metrics - labels versus shuffled labels
-        shuffled_labels=np.random.permutation(true_counts[idx,:])
-        shuffled_labels_prob=shuffled_labels/(pseudocount+np.nansum(shuffled_labels))
-
-        # mnll random
-        #curr_rnd_mnll = mnll(true_counts[idx,:],  probs=shuffled_labels_prob)
-        #mnll_rnd.append(curr_rnd_mnll)
-        # normalized mnll random
-        #curr_rnd_mnll_norm = get_min_max_normalized_value(curr_rnd_mnll, min_mnll, max_mnll)
-        #mnll_rnd_norm.append(curr_rnd_mnll_norm)   
-
-        # jsd random
-        curr_jsd_rnd=jensenshannon(true_counts[idx,:]/(pseudocount+np.nansum(true_counts[idx,:])),shuffled_labels_prob)
-        jsd_rnd.append(curr_jsd_rnd)
-        # normalized jsd random
-        curr_rnd_jsd_norm = get_min_max_normalized_value(curr_jsd_rnd, min_jsd, max_jsd)
-        jsd_rnd_norm.append(curr_rnd_jsd_norm)
-
-    return np.array(mnll_pw), np.array(mnll_norm), np.array(jsd_pw), np.array(jsd_norm), np.array(jsd_rnd), np.array(jsd_rnd_norm), np.array(mnll_rnd), np.array(mnll_rnd_norm)
+        shuffled_labels = np.random.default_rng(seed).permuted(true_counts, axis=1)
+        shuffled_labels_prob = shuffled_labels/total[:,None]
+
+        # jsd, normalized between the jsd of the profile with itself (0) and with a uniform profile.
+        # the shuffled profile has the entropy of the profile
+        true_entropy = np.sum(xlogx(true_probs), axis=1)
+        uniform_probs = np.full((1, num_positions), 1.0/num_positions)
+        max_jsd = jsd_rows(true_probs, uniform_probs, true_entropy, -np.log(num_positions))
+        jsd_pw = jsd_rows(true_probs, pred_probs, true_entropy, np.sum(xlogx(pred_probs), axis=1))
+        jsd_rnd = jsd_rows(true_probs, shuffled_labels_prob, true_entropy, true_entropy)
+
+        # mnll = -(log(N!) - sum(log(k!)) + sum(k*log(p)))/L, normalized between the mnll of the
+        # profile with itself (sum(k*log(k/N)) = N*entropy) and with a uniform profile
+        log_coef = gammaln(total+1) - sum_log_factorial(true_counts)
+        has_counts = (true_counts > 0)
+        mnll_pw = -(log_coef + np.sum(true_counts*np.log(np.where(has_counts, pred_probs, 1)), axis=1))/num_positions
+        mnll_rnd = -(log_coef + np.sum(true_counts*np.log(np.where(has_counts, shuffled_labels_prob, 1)), axis=1))/num_positions
+        min_mnll = -(log_coef + total*true_entropy)/num_positions
+        min_mnll[~np.isfinite(min_mnll)] = 0.0
+        max_mnll = -(log_coef - total*np.log(num_positions))/num_positions
+
+    return (mnll_pw, min_max_normalize(mnll_pw, min_mnll, max_mnll),
+            jsd_pw, min_max_normalize(jsd_pw, 0.0, max_jsd),
+            jsd_rnd, min_max_normalize(jsd_rnd, 0.0, max_jsd),
+            mnll_rnd, min_max_normalize(mnll_rnd, min_mnll, max_mnll))
+
+def profile_metrics(true_counts,pred_probs,pseudocount=0.001,chunk_rows=METRICS_CHUNK_ROWS,num_threads=1):
+    '''
+    Get profile metrics: per region jsd and mnll of the predictions and of the shuffled
+    labels (worst case), and their values normalized between the bounds of the region.
+    Computed on chunks of chunk_rows regions at a time (true_counts and pred_probs can be
+    e.g. h5py datasets, which are then read a chunk at a time) by num_threads threads.
+    '''
+    num_regions = true_counts.shape[0]
+    starts = range(0, num_regions, chunk_rows)
+    # a seed per chunk from the numpy random state, the shuffles do not depend on num_threads
+    seeds = np.random.randint(2**31, size=len(starts))
+
+    def chunk_metrics(start, seed):
+        return profile_metrics_chunk(true_counts[start:start+chunk_rows], pred_probs[start:start+chunk_rows], seed, pseudocount)
+
+    if num_threads > 1:
+        # numpy and scipy release the GIL on whole chunks
+        with ThreadPoolExecutor(num_threads) as pool:
+            chunks = list(pool.map(chunk_metrics, starts, seeds))
+    else:
+        chunks = list(map(chunk_metrics, starts, seeds))
+
+    if len(chunks) == 0:
+        return tuple(np.zeros(0) for _ in range(8))
+    return tuple(np.concatenate(values) for values in zip(*chunks))
 
 def plot_histogram(region_jsd, shuffled_labels_jsd, output_prefix, title):
 
@@ -65,9 +65,11 @@ def getModelGivenModelOptionsAndWeightInits(args, model_params):
 
     # Branch 1. Profile prediction
     # Step 1.1 - 1D convolution with a very large kernel
+    # (the profile and counts heads are kept in float32 under mixed precision policies)
     prof_out_precrop = Conv1D(filters=num_tasks,
                         kernel_size=profile_kernel_size,
                         padding='valid',
+                        dtype='float32',
                         name='prof_out_precrop')(x)
 
     # Step 1.2 - Crop to match size of the required output size
@@ -75,18 +77,19 @@ def getModelGivenModelOptionsAndWeightInits(args, model_params):
     assert cropsize>=0
     assert (int_shape(prof_out_precrop)[1] % 2 == 0) # Necessary for symmetric cropping
     prof = Cropping1D(cropsize,
+                dtype='float32',
                 name='logits_profile_predictions_preflatten')(prof_out_precrop)
 
     # Branch 2. Counts prediction
     # Step 2.1 - Global average pooling along the "length", the result
     #            size is same as "filters" parameter to the BPNet function
 
-    profile_out = Flatten(name="logits_profile_predictions")(prof)
+    profile_out = Flatten(dtype='float32', name="logits_profile_predictions")(prof)
 
-    gap_combined_conv = GlobalAvgPool1D(name='gap')(x) # acronym - gapcc
+    gap_combined_conv = GlobalAvgPool1D(dtype='float32', name='gap')(x) # acronym - gapcc
 
     # Step 2.3 Dense layer to predict final counts
-    count_out = Dense(num_tasks, name="logcount_predictions")(gap_combined_conv)
+    count_out = Dense(num_tasks, dtype='float32', name="logcount_predictions")(gap_combined_conv)
 
     # instantiate keras Model with inputs and outputs
     model=Model(inputs=[inp],outputs=[profile_out, count_out])
@@ -1,6 +1,6 @@
 import numpy as np ;
 from tensorflow.keras.backend import int_shape
-from tensorflow.keras.layers import Input, Cropping1D, add, Conv1D, GlobalAvgPool1D, Dense, Add, Concatenate, Lambda, Flatten
+from tensorflow.keras.layers import Input, Cropping1D, add, Conv1D, GlobalAvgPool1D, AveragePooling1D, Dense, Add, Concatenate, Lambda, Flatten
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.models import Model
 from chrombpnet.training.utils.losses import multinomial_nll
@@ -16,7 +16,8 @@ def load_pretrained_bias(model_hdf5):
     from tensorflow.keras.utils import get_custom_objects
     custom_objects={"multinomial_nll":multinomial_nll, "tf":tf}    
     get_custom_objects().update(custom_objects)
-    pretrained_bias_model=load_model(model_hdf5)
+    # not compiled, the frozen bias model is never trained on its own
+    pretrained_bias_model=load_model(model_hdf5, compile=False)
     #freeze the model
     num_layers=len(pretrained_bias_model.layers)
     for i in range(num_layers):
@@ -60,9 +61,11 @@ def bpnet_model(filters, n_dil_layers, sequence_len, out_pred_len):
 
     # Branch 1. Profile prediction
     # Step 1.1 - 1D convolution with a very large kernel
+    # (the profile and counts heads are kept in float32 under mixed precision policies)
     prof_out_precrop = Conv1D(filters=num_tasks,
                         kernel_size=profile_kernel_size,
                         padding='valid',
+                        dtype='float32',
                         name='wo_bias_bpnet_prof_out_precrop')(x)
 
     # Step 1.2 - Crop to match size of the required output size
@@ -71,17 +74,18 @@ def bpnet_model(filters, n_dil_layers, sequence_len, out_pred_len):
     assert (int_shape(prof_out_precrop)[1] % 2 == 0) # Necessary for symmetric cropping
 
     prof = Cropping1D(cropsize,
+                dtype='float32',
                 name='wo_bias_bpnet_logitt_before_flatten')(prof_out_precrop)
     
-    profile_out = Flatten(name="wo_bias_bpnet_logits_profile_predictions")(prof)
+    profile_out = Flatten(dtype='float32', name="wo_bias_bpnet_logits_profile_predictions")(prof)
 
     # Branch 2. Counts prediction
     # Step 2.1 - Global average pooling along the "length", the result
     #            size is same as "filters" parameter to the BPNet function
-    gap_combined_conv = GlobalAvgPool1D(name='gap')(x) # acronym - gapcc
+    gap_combined_conv = GlobalAvgPool1D(dtype='float32', name='gap')(x) # acronym - gapcc
 
     # Step 2.3 Dense layer to predict final counts
-    count_out = Dense(num_tasks, name="wo_bias_bpnet_logcount_predictions")(gap_combined_conv)
+    count_out = Dense(num_tasks, dtype='float32', name="wo_bias_bpnet_logcount_predictions")(gap_combined_conv)
 
     # instantiate keras Model with inputs and outputs
     model=Model(inputs=[inp],outputs=[profile_out, count_out], name="model_wo_bias")
@@ -111,8 +115,25 @@ def getModelGivenModelOptionsAndWeightInits(args, model_params):
     
     inp = Input(shape=(sequence_len, 4),name='sequence')    
 
-    ## get bias output
-    bias_output=bias_model(inp)
+    if getattr(args, "precompute_bias", False):
+        ## bias outputs are computed once per region and fed as inputs (see get_bias_window_model)
+        bias_output=[Input(shape=(out_pred_len,), name='bias_logits_profile'), Input(shape=(1,), name='bias_logcount')]
+        inputs=[inp]+bias_output
+    else:
+        ## get bias output
+        bias_output=bias_model(inp)
+        inputs=[inp]
+
+    model=combine_with_bias(inp, bpnet_model_wo_bias, bias_output, out_pred_len, inputs)
+
+    model.compile(optimizer=Adam(learning_rate=args.learning_rate),
+                    loss=[multinomial_nll,'mse'],
+                    loss_weights=[1,counts_loss_weight])
+
+    return model 
+
+
+def combine_with_bias(inp, bpnet_model_wo_bias, bias_output, out_pred_len, inputs):
     ## get wo bias output
     output_wo_bias=bpnet_model_wo_bias(inp)
     assert(len(bias_output[1].shape)==2) # bias model counts head is of incorrect shape (None,1) expected
@@ -123,19 +144,64 @@ def getModelGivenModelOptionsAndWeightInits(args, model_params):
     assert(bias_output[0].shape[1]==out_pred_len) # bias model profile head is of incorrect shape (None,out_pred_len) expected
 
 
-    profile_out = Add(name="logits_profile_predictions")([output_wo_bias[0],bias_output[0]])
-    concat_counts = Concatenate(axis=-1)([output_wo_bias[1], bias_output[1]])
+    profile_out = Add(dtype='float32', name="logits_profile_predictions")([output_wo_bias[0],bias_output[0]])
+    concat_counts = Concatenate(axis=-1, dtype='float32')([output_wo_bias[1], bias_output[1]])
     count_out = Lambda(lambda x: tf.math.reduce_logsumexp(x, axis=-1, keepdims=True),
+                        dtype='float32',
                         name="logcount_predictions")(concat_counts)
 
     # instantiate keras Model with inputs and outputs
-    model=Model(inputs=[inp],outputs=[profile_out, count_out])
+    model=Model(inputs=inputs,outputs=[profile_out, count_out])
 
-    model.compile(optimizer=Adam(learning_rate=args.learning_rate),
+    return model
+
+
+def get_bias_window_model(model_params, max_jitter):
+    """
+    Frozen bias model applied to sequences extended by max_jitter on both sides,
+    returning the bias outputs of all 2*max_jitter+1 crops of inputlen in a single
+    forward pass. The profile logits of a position only depend on the sequence
+    around it, so the logits of every crop are a window of the (outputlen+2*max_jitter)
+    profile logits of the extended sequence. The counts head is a dense layer on
+    globally averaged features, so the log counts of every crop are a moving
+    average (over the length the features are pooled over) of the dense layer
+    applied to the features of every position.
+    """
+    bias_model = load_pretrained_bias(model_params['bias_model_path'])
+    sequence_len = int(model_params['inputlen'])
+    assert(bias_model.input_shape[1]==sequence_len) # bias model input length does not match inputlen
+
+    gap_layers = [l for l in bias_model.layers if isinstance(l, GlobalAvgPool1D)]
+    dense_layers = [l for l in bias_model.layers if isinstance(l, Dense)]
+    assert(len(gap_layers)==1 and len(dense_layers)==1) # bias model counts head is not a dense layer on global average pooled features, bias outputs can not be precomputed
+    pool_len = gap_layers[0].input_shape[1]
+
+    inp = Input(shape=(sequence_len+2*max_jitter, 4),name='sequence')
+    window_model = tf.keras.models.clone_model(bias_model, input_tensors=inp)
+    window_model.set_weights(bias_model.get_weights())
+
+    features = window_model.get_layer(gap_layers[0].name).input
+    position_counts = window_model.get_layer(dense_layers[0].name)(features)
+    count_out = Flatten(dtype='float32')(AveragePooling1D(pool_size=pool_len, strides=1, dtype='float32')(position_counts))
+
+    return Model(inputs=[inp], outputs=[window_model.outputs[0], count_out])
+
+
+def attach_bias_model(model, model_params):
+    """
+    Replaces the precomputed bias inputs of a model trained with precompute_bias
+    by the frozen bias model, i.e. returns the sequence-only model that is trained
+    without precompute_bias, sharing the trained layers of model.
+    """
+    bias_model = load_pretrained_bias(model_params['bias_model_path'])
+    inp = Input(shape=(int(model_params['inputlen']), 4),name='sequence')
+    model_with_bias = combine_with_bias(inp, model.get_layer("model_wo_bias"), bias_model(inp), int(model_params['outputlen']), [inp])
+
+    model_with_bias.compile(optimizer=model.optimizer,
                     loss=[multinomial_nll,'mse'],
-                    loss_weights=[1,counts_loss_weight])
+                    loss_weights=[1,float(model_params['counts_loss_weight'])])
 
-    return model 
+    return model_with_bias
 
 
 def save_model_without_bias(model, output_prefix):
@@ -4,28 +4,53 @@ import scipy.stats
 import numpy as np
 import json
 import h5py
+import tempfile
 import tensorflow as tf
 import chrombpnet.training.utils.argmanager as argmanager
 import chrombpnet.training.utils.losses as losses
 import chrombpnet.training.metrics as metrics
 import chrombpnet.training.data_generators.initializers as initializers
+from chrombpnet.training.utils import data_utils
 from tensorflow.keras.utils import get_custom_objects
 from tensorflow.keras.models import load_model
 from scipy import nanmean, nanstd
 
-def write_predictions_h5py(output_prefix, profile, logcts, coords):
-    # open h5 file for writing predictions
-    output_h5_fname = "{}_predictions.h5".format(output_prefix)
-    h5_file = h5py.File(output_h5_fname, "w")
+def create_predictions_h5py(output_prefix, num_examples, outputlen, chunk_rows):
+    """
+    Opens the predictions file with an empty, chunked "predictions/profs" dataset for
+    predict_on_batch_wrapper to write profiles into batch by batch. The rest of the
+    file is written by write_predictions_h5py.
+    """
+    h5_file = h5py.File("{}_predictions.h5".format(output_prefix), "w")
+    pred_group = h5_file.create_group("predictions")
+    pred_group.create_dataset(
+        "profs", shape=(num_examples, outputlen), dtype=float,
+        chunks=(max(1, min(chunk_rows, num_examples)), outputlen), compression="gzip")
+    return h5_file
+
+def write_predictions_h5py(output_prefix, profile, logcts, coords, chrom_names, h5_file=None):
+    """
+    h5_file: predictions file already holding the predicted profiles (see
+    create_predictions_h5py), profile is then not written
+    """
+    if h5_file is None:
+        # open h5 file for writing predictions
+        output_h5_fname = "{}_predictions.h5".format(output_prefix)
+        h5_file = h5py.File(output_h5_fname, "w")
+        pred_group = h5_file.create_group("predictions")
+        profs_dset = pred_group.create_dataset(
+            "profs",
+            data=profile,
+            dtype=float, compression="gzip")
+    else:
+        pred_group = h5_file["predictions"]
     # create groups
     coord_group = h5_file.create_group("coords")
-    pred_group = h5_file.create_group("predictions")
-
-    num_examples=len(coords)
 
-    coords_chrom_dset =  [str(coords[i][0]) for i in range(num_examples)]
-    coords_center_dset =  [int(coords[i][1]) for i in range(num_examples)]
-    coords_peak_dset =  [int(coords[i][3]) for i in range(num_examples)]
+    # coords is a structured array (see data_utils.COORDS_DTYPE), chromosomes index chrom_names
+    coords_chrom_dset =  chrom_names[coords["chrom"]]
+    coords_center_dset =  coords["pos"]
+    coords_peak_dset =  coords["peak"].astype(int)
 
     dt = h5py.special_dtype(vlen=str)
 
@@ -39,10 +64,6 @@ def write_predictions_h5py(output_prefix, profile, logcts, coords):
         "coords_peak", data=coords_peak_dset, dtype=int, compression="gzip")
 
     # create the "predictions" group datasets
-    profs_dset = pred_group.create_dataset(
-        "profs",
-        data=profile,
-        dtype=float, compression="gzip")
     logcounts_dset = pred_group.create_dataset(
         "logcounts", data=logcts,
         dtype=float, compression="gzip")
@@ -51,11 +72,11 @@ def write_predictions_h5py(output_prefix, profile, logcts, coords):
     h5_file.close()
 
 
-def load_model_wrapper(args):
+def load_model_wrapper(model_h5):
     # read .h5 model
     custom_objects={"tf": tf, "multinomial_nll":losses.multinomial_nll}    
     get_custom_objects().update(custom_objects)    
-    model=load_model(args.model_h5)
+    model=load_model(model_h5)
     print("got the model")
     #model.summary()
     return model
@@ -64,57 +85,83 @@ def softmax(x, temp=1):
     norm_x = x - np.mean(x,axis=1, keepdims=True)
     return np.exp(temp*norm_x)/np.sum(np.exp(temp*norm_x), axis=1, keepdims=True)
 
-def predict_on_batch_wrapper(model,test_generator):
+def get_output_prefixes(args, model_h5s):
+    # one model keeps the output prefix, several are told apart by their file name
+    # (the pipelines call main without --output-prefixes)
+    output_prefixes = getattr(args, "output_prefixes", None)
+    if output_prefixes is not None:
+        assert(len(output_prefixes)==len(model_h5s)) # expected one output prefix per model
+        return output_prefixes
+    if len(model_h5s)==1:
+        return [args.output_prefix]
+    output_prefixes = ["{}_{}".format(args.output_prefix, os.path.splitext(os.path.basename(model_h5))[0]) for model_h5 in model_h5s]
+    assert(len(set(output_prefixes))==len(output_prefixes)) # models with the same file name, give --output-prefixes
+    return output_prefixes
+
+def predict_on_batch_wrapper(models,test_generator,true_counts=None,profile_probs_predictions=None):
+    """
+    Predicts every batch of test_generator with every model and writes labels and
+    predictions of the batch into preallocated arrays (float32 for the N x outputlen
+    true_counts and the profile_probs_predictions of every model). true_counts and
+    profile_probs_predictions (a list, one per model) can instead be given, e.g. as
+    h5py datasets to stream them to disk. The test regions are extracted once for
+    all models.
+    """
     num_batches=len(test_generator)
-    profile_probs_predictions = []
-    true_counts = []
-    counts_sum_predictions = []
-    true_counts_sum = []
-    coordinates = []
-
+    num_examples=test_generator.cur_is_peak.shape[0]
+    outputlen=test_generator.outputlen
+    if true_counts is None:
+        true_counts = np.empty((num_examples, outputlen), dtype=np.float32)
+    if profile_probs_predictions is None:
+        profile_probs_predictions = [np.empty((num_examples, outputlen), dtype=np.float32) for model in models]
+    counts_sum_predictions = [np.empty(num_examples, dtype=np.float32) for model in models]
+    true_counts_sum = np.empty(num_examples, dtype=np.float64)
+    coordinates = np.empty(num_examples, dtype=data_utils.COORDS_DTYPE)
+
+    start = 0
     for idx in range(num_batches):
         if idx%100==0:
             print(str(idx)+'/'+str(num_batches))
         
         X,y,coords=test_generator[idx]
+        batch = slice(start, start+coords.shape[0])
+        start += coords.shape[0]
 
-        #get the model predictions            
-        preds=model.predict_on_batch(X)
-
-        # get counts predictions
-        true_counts.extend(y[0])
-        profile_probs_predictions.extend(softmax(preds[0]))
+        true_counts[batch] = y[0]
+        true_counts_sum[batch] = y[1][:,0]
+        coordinates[batch] = coords
 
-        # get profile predictions
-        true_counts_sum.extend(y[1][:,0])
-        counts_sum_predictions.extend(preds[1][:,0])
-        coordinates.extend(coords)
+        for i, model in enumerate(models):
+            #get the model predictions            
+            preds=model.predict_on_batch(X)
 
-    return np.array(true_counts), np.array(profile_probs_predictions), np.array(true_counts_sum), np.array(counts_sum_predictions), np.array(coordinates)
+            # get profile predictions
+            profile_probs_predictions[i][batch] = softmax(preds[0])
 
+            # get counts predictions
+            counts_sum_predictions[i][batch] = preds[1][:,0]
 
-def main(args):
-
+    assert(start == num_examples) # generator returned fewer examples than in its epoch
+    return true_counts, profile_probs_predictions, true_counts_sum, counts_sum_predictions, coordinates
 
-    metrics_dictionary = {"counts_metrics":{}, "profile_metrics":{}}
 
-    # get model architecture to load - can load .hdf5 and .weights/.arch
-    model=load_model_wrapper(args)
 
+def write_metrics(args, output_prefix, true_counts, profile_probs_predictions, true_counts_sum, counts_sum_predictions, coordinates, chrom_names, predictions_h5=None):
+    """
+    Writes the predictions, metrics json and plots of one model to output_prefix
+    """
 
-    test_generator = initializers.initialize_generators(args, mode="test", parameters=None, return_coords=True)
-    true_counts, profile_probs_predictions, true_counts_sum, counts_sum_predictions, coordinates = predict_on_batch_wrapper(model, test_generator)
+    metrics_dictionary = {"counts_metrics":{}, "profile_metrics":{}}
 
+    # store regions, their predictions and corresponding pointwise metrics
+    mnll_pw, mnll_norm, jsd_pw, jsd_norm, jsd_rnd, jsd_rnd_norm, mnll_rnd, mnll_rnd_norm =  metrics.profile_metrics(true_counts,profile_probs_predictions,num_threads=args.metrics_threads)
 
     # generate prediction on test set and store metrics
-    write_predictions_h5py(args.output_prefix, profile_probs_predictions, counts_sum_predictions, coordinates)
-
-    # store regions, their predictions and corresponding pointwise metrics
-    mnll_pw, mnll_norm, jsd_pw, jsd_norm, jsd_rnd, jsd_rnd_norm, mnll_rnd, mnll_rnd_norm =  metrics.profile_metrics(true_counts,profile_probs_predictions)
+    write_predictions_h5py(output_prefix, profile_probs_predictions, counts_sum_predictions, coordinates, chrom_names, predictions_h5)
 
     # including both metrics    
     if args.peaks != "None" and args.nonpeaks != "None":
-        spearman_cor, pearson_cor, mse = metrics.counts_metrics(true_counts_sum, counts_sum_predictions,args.output_prefix+"_peaks_and_nonpeaks", "Both peaks and non peaks")
+        spearman_cor, pearson_cor, mse = metrics.counts_metrics(true_counts_sum, counts_sum_predictions,output_prefix+"_peaks_and_nonpeaks", "Both peaks and non peaks")
         metrics_dictionary["counts_metrics"]["peaks_and_nonpeaks"] = {}
         metrics_dictionary["counts_metrics"]["peaks_and_nonpeaks"]["spearmanr"] = spearman_cor
         metrics_dictionary["counts_metrics"]["peaks_and_nonpeaks"]["pearsonr"] = pearson_cor
@@ -123,14 +170,16 @@ def main(args):
         metrics_dictionary["profile_metrics"]["peaks_and_nonpeaks"] = {}
         metrics_dictionary["profile_metrics"]["peaks_and_nonpeaks"]["median_jsd"] = np.nanmedian(jsd_pw)        
         metrics_dictionary["profile_metrics"]["peaks_and_nonpeaks"]["median_norm_jsd"] = np.nanmedian(jsd_norm)
+        metrics_dictionary["profile_metrics"]["peaks_and_nonpeaks"]["median_mnll"] = np.nanmedian(mnll_pw)
+        metrics_dictionary["profile_metrics"]["peaks_and_nonpeaks"]["median_norm_mnll"] = np.nanmedian(mnll_norm)
 
-        metrics.plot_histogram(jsd_pw, jsd_rnd, args.output_prefix+"_peaks_and_nonpeaks", "Both peaks and non peaks")
+        metrics.plot_histogram(jsd_pw, jsd_rnd, output_prefix+"_peaks_and_nonpeaks", "Both peaks and non peaks")
 
 
     # including only nonpeak metrics
     if args.nonpeaks != "None":
-        non_peaks_idx = coordinates[:,3] == '0'
-        spearman_cor, pearson_cor, mse = metrics.counts_metrics(true_counts_sum[non_peaks_idx], counts_sum_predictions[non_peaks_idx],args.output_prefix+"_only_nonpeaks", "Only non peaks")
+        non_peaks_idx = ~coordinates["peak"]
+        spearman_cor, pearson_cor, mse = metrics.counts_metrics(true_counts_sum[non_peaks_idx], counts_sum_predictions[non_peaks_idx],output_prefix+"_only_nonpeaks", "Only non peaks")
         metrics_dictionary["counts_metrics"]["nonpeaks"] = {}
         metrics_dictionary["counts_metrics"]["nonpeaks"]["spearmanr"] = spearman_cor
         metrics_dictionary["counts_metrics"]["nonpeaks"]["pearsonr"] = pearson_cor
@@ -139,13 +188,15 @@ def main(args):
         metrics_dictionary["profile_metrics"]["nonpeaks"] = {}
         metrics_dictionary["profile_metrics"]["nonpeaks"]["median_jsd"] = np.nanmedian(jsd_pw[non_peaks_idx])        
         metrics_dictionary["profile_metrics"]["nonpeaks"]["median_norm_jsd"] = np.nanmedian(jsd_norm[non_peaks_idx])
+        metrics_dictionary["profile_metrics"]["nonpeaks"]["median_mnll"] = np.nanmedian(mnll_pw[non_peaks_idx])
+        metrics_dictionary["profile_metrics"]["nonpeaks"]["median_norm_mnll"] = np.nanmedian(mnll_norm[non_peaks_idx])
 
-        metrics.plot_histogram(jsd_pw[non_peaks_idx], jsd_rnd[non_peaks_idx], args.output_prefix+"_only_nonpeaks", "Only non peaks")
+        metrics.plot_histogram(jsd_pw[non_peaks_idx], jsd_rnd[non_peaks_idx], output_prefix+"_only_nonpeaks", "Only non peaks")
 
     # including only peak metrics
     if args.peaks != "None":
-        peaks_idx = coordinates[:,3] == '1'
-        spearman_cor, pearson_cor, mse = metrics.counts_metrics(true_counts_sum[peaks_idx], counts_sum_predictions[peaks_idx],args.output_prefix+"_only_peaks", "Only peaks")
+        peaks_idx = coordinates["peak"]
+        spearman_cor, pearson_cor, mse = metrics.counts_metrics(true_counts_sum[peaks_idx], counts_sum_predictions[peaks_idx],output_prefix+"_only_peaks", "Only peaks")
         metrics_dictionary["counts_metrics"]["peaks"] = {}
         metrics_dictionary["counts_metrics"]["peaks"]["spearmanr"] = spearman_cor
         metrics_dictionary["counts_metrics"]["peaks"]["pearsonr"] = pearson_cor
@@ -154,19 +205,54 @@ def main(args):
         metrics_dictionary["profile_metrics"]["peaks"] = {}
         metrics_dictionary["profile_metrics"]["peaks"]["median_jsd"] = np.nanmedian(jsd_pw[peaks_idx])        
         metrics_dictionary["profile_metrics"]["peaks"]["median_norm_jsd"] = np.nanmedian(jsd_norm[peaks_idx])
-        metrics.plot_histogram(jsd_pw[peaks_idx], jsd_rnd[peaks_idx], args.output_prefix+"_only_peaks", "Only peaks")
+        metrics_dictionary["profile_metrics"]["peaks"]["median_mnll"] = np.nanmedian(mnll_pw[peaks_idx])
+        metrics_dictionary["profile_metrics"]["peaks"]["median_norm_mnll"] = np.nanmedian(mnll_norm[peaks_idx])
+        metrics.plot_histogram(jsd_pw[peaks_idx], jsd_rnd[peaks_idx], output_prefix+"_only_peaks", "Only peaks")
 
-        #ofile = open(args.output_prefix+"_pearson_cor.txt","w")
+        #ofile = open(output_prefix+"_pearson_cor.txt","w")
         #ofile.write(str(round(pearson_cor,2)))
         #ofile.close()
 
-        #ofile = open(args.output_prefix+"_norm_jsd.txt","w")
+        #ofile = open(output_prefix+"_norm_jsd.txt","w")
         #ofile.write(str(round(metrics_dictionary["profile_metrics"]["peaks"]["median_norm_jsd"],2)))
         #ofile.close()
     # store dictionary
-    with open(args.output_prefix+'_metrics.json', 'w') as fp:
+    with open(output_prefix+'_metrics.json', 'w') as fp:
             json.dump(metrics_dictionary, fp,  indent=4)
 
+def main(args):
+
+    # several models are evaluated on the same test regions in one pass
+    model_h5s = args.model_h5 if isinstance(args.model_h5, list) else [args.model_h5]
+    output_prefixes = get_output_prefixes(args, model_h5s)
+
+    # get model architecture to load - can load .hdf5 and .weights/.arch
+    models = [load_model_wrapper(model_h5) for model_h5 in model_h5s]
+
+
+    test_generator = initializers.initialize_generators(args, mode="test", parameters=None, return_coords=True)
+
+    if args.stream_predictions:
+        # profiles are written to the predictions files and labels to a temporary file batch by batch,
+        # only per region values are held in memory
+        num_examples = test_generator.cur_is_peak.shape[0]
+        predictions_h5s = [create_predictions_h5py(output_prefix, num_examples, args.outputlen, args.batch_size) for output_prefix in output_prefixes]
+        labels_h5 = h5py.File(tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(output_prefixes[0]))), "w")
+        labels = labels_h5.create_dataset("counts", shape=(num_examples, args.outputlen), dtype=np.float32,
+                                          chunks=predictions_h5s[0]["predictions/profs"].chunks)
+        true_counts, profile_probs_predictions, true_counts_sum, counts_sum_predictions, coordinates = predict_on_batch_wrapper(models, test_generator, labels, [predictions_h5["predictions/profs"] for predictions_h5 in predictions_h5s])
+    else:
+        predictions_h5s = [None for model in models]
+        true_counts, profile_probs_predictions, true_counts_sum, counts_sum_predictions, coordinates = predict_on_batch_wrapper(models, test_generator)
+
+    for i, output_prefix in enumerate(output_prefixes):
+        if len(models) > 1:
+            print("metrics of {} written to: {}".format(model_h5s[i], output_prefix))
+        write_metrics(args, output_prefix, true_counts, profile_probs_predictions[i], true_counts_sum, counts_sum_predictions[i], coordinates, test_generator.chrom_names, predictions_h5s[i])
+
+    if args.stream_predictions:
+        labels_h5.close()
+
 if __name__=="__main__":
     # read arguments
     args=argmanager.fetch_predict_args()
@@ -0,0 +1,162 @@
+import chrombpnet.training.utils.argmanager as argmanager
+import pandas as pd
+import numpy as np
+import argparse
+import subprocess
+import time
+import sys
+import os
+
+# columns every job of a manifest needs, all other columns except SCHEDULE_COLUMNS
+# are passed to chrombpnet.training.train as the option of the same name
+MANIFEST_COLUMNS = ["name", "genome", "bigwig", "peaks", "nonpeaks", "chr_fold_path", "params", "architecture_from_file", "output_prefix"]
+
+# per job overrides of --threads-per-job and --memory-per-job
+SCHEDULE_COLUMNS = ["threads", "memory_gb"]
+
+SUMMARY_COLUMNS = ["name", "exit_code", "start_seconds", "wall_seconds", "threads", "cores", "memory_gb", "peak_rss_gb", "steps", "examples_per_sec", "output_prefix"]
+
+def read_manifest(manifest, threads_per_job, memory_per_job):
+    jobs = pd.read_csv(manifest, sep="\t", dtype=str)
+    for column in MANIFEST_COLUMNS:
+        assert(column in jobs.columns) # manifest is missing a required column
+    assert(jobs["name"].is_unique) # job names are not unique
+
+    jobs["threads"] = jobs["threads"].fillna(threads_per_job).astype(int) if "threads" in jobs.columns else threads_per_job
+    jobs["memory_gb"] = jobs["memory_gb"].fillna(memory_per_job).astype(float) if "memory_gb" in jobs.columns else memory_per_job
+    return jobs
+
+def get_train_command(job, inter_op_threads):
+    """
+    chrombpnet.training.train command line of a manifest row. Empty cells use the
+    default of the option, boolean options are given as true/false.
+    """
+    options = {action.dest: action for action in argmanager.get_train_parser()._actions if action.option_strings}
+
+    command = [sys.executable, "-m", "chrombpnet.training.train"]
+    for column, value in job.items():
+        if (column in SCHEDULE_COLUMNS) or (column == "name") or pd.isna(value):
+            continue
+        assert(column in options) # manifest column is not an option of chrombpnet.training.train
+        action = options[column]
+        if isinstance(action, argparse._StoreTrueAction):
+            if value.lower() in ["true", "1", "yes"]:
+                command.append(action.option_strings[-1])
+        elif action.nargs in ["*", "+"]:
+            command += [action.option_strings[-1]] + value.split()
+        else:
+            command += [action.option_strings[-1], value]
+
+    # thread limits of the job, and per step timings for the throughput summary
+    command += ["--intra-op-threads", str(job["threads"]), "--inter-op-threads", str(inter_op_threads), "--profile"]
+    return command
+
+def start_job(job, command, cores):
+    os.makedirs(os.path.dirname(os.path.abspath(job["output_prefix"])), exist_ok=True)
+    log = open(job["output_prefix"]+".train.out", "w")
+    # libraries parallelizing outside of tensorflow's thread pools (e.g. oneDNN/OpenMP) stay within the job's cores
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)))
+    preexec_fn = None
+    if hasattr(os, "sched_setaffinity"):
+        preexec_fn = lambda: os.sched_setaffinity(0, cores)
+    process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env, preexec_fn=preexec_fn)
+    log.close()
+    return process
+
+def get_throughput(output_prefix):
+    # training steps and median examples per second, from the step profile of the job
+    profile_path = output_prefix+".profile.tsv"
+    if not os.path.exists(profile_path):
+        return 0, np.nan
+    profile = pd.read_csv(profile_path, sep="\t")
+    steps = profile[profile["event"]=="step"]
+    if steps.shape[0] == 0:
+        return 0, np.nan
+    return steps.shape[0], steps["examples_per_sec"].astype(float).median()
+
+def get_exit_code(status):
+    # exit code of a wait status as Popen.returncode reports it (os.waitstatus_to_exitcode needs python 3.9)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def run_jobs(jobs, cores, memory_gb, inter_op_threads, summary_path):
+    """
+    Runs the training jobs in parallel processes. Pending jobs are started in manifest
+    order whenever enough cores (threads of the job) and memory (memory_gb of the job)
+    are free, each pinned to cores of its own, and a summary row is written to
+    summary_path as every job finishes. Memory is budgeted by the declared memory_gb,
+    the peak RSS of every job is reported to calibrate it.
+    """
+    assert(jobs["threads"].max() <= len(cores)) # a job needs more threads than there are cores
+    assert(jobs["memory_gb"].max() <= memory_gb) # a job needs more memory than the budget
+
+    summary = open(summary_path, "w")
+    summary.write("\t".join(SUMMARY_COLUMNS)+"\n")
+
+    scheduler_start = time.time()
+    pending = list(range(jobs.shape[0]))
+    running = {}
+    free_cores = list(cores)
+    free_memory = memory_gb
+    exit_codes = []
+    while pending or running:
+        for i in list(pending):
+            job = jobs.iloc[i]
+            if (job["threads"] <= len(free_cores)) and (job["memory_gb"] <= free_memory):
+                job_cores, free_cores = free_cores[:job["threads"]], free_cores[job["threads"]:]
+                free_memory -= job["memory_gb"]
+                process = start_job(job, get_train_command(job, inter_op_threads), job_cores)
+                print("started {} on cores {}".format(job["name"], ",".join(map(str, job_cores))))
+                running[process.pid] = (i, process, job_cores, time.time())
+                pending.remove(i)
+
+        pid, status, rusage = os.wait4(-1, 0)
+        if pid not in running:
+            continue
+        i, process, job_cores, start = running.pop(pid)
+        process.returncode = get_exit_code(status)
+        job = jobs.iloc[i]
+        free_cores += job_cores
+        free_memory += job["memory_gb"]
+        exit_codes.append(process.returncode)
+
+        steps, examples_per_sec = get_throughput(job["output_prefix"])
+        # ru_maxrss is in kilobytes on linux
+        row = [job["name"], process.returncode, start-scheduler_start, time.time()-start, job["threads"],
+               ",".join(map(str, job_cores)), job["memory_gb"], rusage.ru_maxrss/2**20, steps, examples_per_sec, job["output_prefix"]]
+        summary.write("\t".join(map(str, row))+"\n")
+        summary.flush()
+        print("finished {} with exit code {} in {:.1f}s".format(job["name"], process.returncode, row[3]))
+
+    summary.close()
+    return exit_codes
+
+def main(args):
+    jobs = read_manifest(args.manifest, args.threads_per_job, args.memory_per_job)
+
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if args.cores is not None:
+        requested_cores = [int(core) for core in args.cores.split(",")]
+        assert(set(requested_cores) <= set(cores)) # cores not available to the scheduler
+        cores = requested_cores
+
+    memory_gb = args.memory_gb
+    if memory_gb is None:
+        memory_gb = os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")/2**30
+
+    summary_path = args.summary
+    if summary_path is None:
+        summary_path = args.manifest+".summary.tsv"
+
+    exit_codes = run_jobs(jobs, cores, memory_gb, args.inter_op_threads, summary_path)
+    print("{} of {} jobs succeeded, summary written to: {}".format(sum(code == 0 for code in exit_codes), len(exit_codes), summary_path))
+    if any(code != 0 for code in exit_codes):
+        sys.exit(1)
+
+if __name__=="__main__":
+    args = argmanager.fetch_schedule_args()
+    main(args)
@@ -1,18 +1,83 @@
 from __future__ import division, print_function, absolute_import
 import importlib.machinery
+import re
 import tensorflow.keras.callbacks as tfcallbacks 
 import chrombpnet.training.utils.argmanager as argmanager
 import chrombpnet.training.utils.losses as losses
 import chrombpnet.training.utils.callbacks as callbacks
+import chrombpnet.training.utils.optimizer_state as optimizer_state
 import chrombpnet.training.data_generators.initializers as initializers
+import chrombpnet.training.data_generators.tf_dataset as tf_dataset
 import pandas as pd
 import os
 import json
+import tempfile
 import numpy as np
+import tensorflow as tf
 
 NARROWPEAK_SCHEMA = ["chr", "start", "end", "1", "2", "3", "4", "5", "6", "summit"]
 os.environ['PYTHONHASHSEED'] = '0'
 
+# keras dtype policy of every --precision. Variables are float32 under all of them,
+# and the models keep their output heads (and losses) in float32
+PRECISION_POLICIES = {"fp32": "float32", "bf16": "mixed_bfloat16", "mixed": "mixed_float16"}
+
+def get_strategy(args):
+    """
+    tf.distribute strategy of --distribution. mirrored trains on all local GPUs, multi-worker
+    on the cluster in the TF_CONFIG environment variable of every worker process.
+    """
+    if args.distribution == "mirrored":
+        return tf.distribute.MirroredStrategy()
+    if args.distribution == "multi-worker":
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    return tf.distribute.get_strategy()
+
+def is_chief():
+    """
+    Whether this process writes the outputs of training, i.e. it is not part of a
+    TF_CONFIG cluster, or it is the chief (worker 0 if the cluster has no chief).
+    """
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    task = tf_config.get("task", {})
+    if task.get("type") in [None, "chief"]:
+        return True
+    return task["type"] == "worker" and task.get("index", 0) == 0 and "chief" not in tf_config.get("cluster", {})
+
+def get_distributed_input(generator, strategy):
+    """
+    Wraps a batch generator in a DatasetCreator for model.fit under a distribution strategy.
+    Every input pipeline (one per worker) feeds its shard of each epoch to its local replicas,
+    in batches of batch_size/num_replicas so that --batch-size stays the global batch size.
+    Returns the DatasetCreator and the number of steps per epoch.
+    """
+    local_replicas = len(strategy.extended.worker_devices)
+    num_workers = strategy.num_replicas_in_sync // local_replicas
+    assert(generator.batch_size >= strategy.num_replicas_in_sync) # batch size is smaller than the number of replicas
+    generator.batch_size = generator.batch_size // strategy.num_replicas_in_sync
+    generator.shard(num_workers, 0)
+    steps = len(generator) // local_replicas
+    assert(steps > 0) # too few examples per worker for a single step
+
+    # batches are lists of arrays, tf.data needs tuples
+    to_tuples = lambda batch: tuple(to_tuples(b) for b in batch) if isinstance(batch, (list, tuple)) else batch
+    signature = tf.nest.map_structure(lambda a: tf.TensorSpec((None,)+a.shape[1:], dtype=a.dtype), to_tuples(generator[0]))
+
+    def dataset_fn(input_context):
+        generator.shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+        def epochs():
+            while True:
+                for i in range(steps*local_replicas):
+                    yield to_tuples(generator[i])
+                generator.on_epoch_end()
+        dataset = tf.data.Dataset.from_generator(epochs, output_signature=signature)
+        # the generator is already sharded
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        return dataset.with_options(options).prefetch(tf.data.AUTOTUNE)
+
+    return tf.keras.utils.experimental.DatasetCreator(dataset_fn), steps
+
 def get_model(args, parameters):
     """
     Read a model definition from a python file. This function can be used to read any model architecture that takes sequence as input
@@ -25,23 +90,146 @@ def get_model(args, parameters):
     print("got the model")
     return model, architecture_module
 
-def fit_and_evaluate(model,train_gen,valid_gen,args,architecture_module):
+def get_weighted_layers(model):
+    """
+    Layers with weights of a model by name, including the layers of nested models
+    (e.g. the bias and no-bias models of chrombpnet).
+    """
+    layers = {}
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.Model):
+            layers.update(get_weighted_layers(layer))
+        elif len(layer.weights) > 0:
+            layers[layer.name] = layer
+    return layers
+
+def init_from_model(model, init_from):
+    """
+    Warm start: copies the weights of the layers of the model at init_from into the
+    trainable layers of the same name and shapes in model. Frozen layers (e.g. the
+    pretrained bias model of chrombpnet) keep their weights. init_from can be any
+    model trained with the same layer names, e.g. chrombpnet.h5, chrombpnet_nobias.h5
+    (for chrombpnet) or bias.h5 (for bias models).
+    """
+    from tensorflow.keras.utils import get_custom_objects
+    get_custom_objects().update({"multinomial_nll":losses.multinomial_nll, "tf":tf})
+    init_layers = get_weighted_layers(tf.keras.models.load_model(init_from, compile=False))
+
+    copied, skipped = [], []
+    for name, layer in get_weighted_layers(model).items():
+        if not layer.trainable:
+            continue
+        init_weights = init_layers[name].get_weights() if name in init_layers else None
+        if (init_weights is not None) and ([w.shape for w in init_weights] == [tuple(w.shape) for w in layer.weights]):
+            layer.set_weights(init_weights)
+            copied.append(name)
+        else:
+            skipped.append(name)
+    assert(len(copied) > 0) # no layer of the model matches a layer of --init-from
+    print("initialized layers from {}: {}".format(init_from, ", ".join(copied)))
+    if len(skipped) > 0:
+        print("layers without a compatible layer in {} (initialized at random): {}".format(init_from, ", ".join(skipped)))
+
+def freeze_layers(model, num_layers, parameters):
+    """
+    Freezes the first num_layers convolutions of the trainable (no-bias) model: the
+    first (undilated) convolution and the num_layers-1 dilated convolutions after it,
+    and recompiles the model for the freezing to take effect.
+    """
+    layers = [layer for name, layer in get_weighted_layers(model).items() if layer.trainable and
+              (name.endswith("bpnet_1st_conv") or (re.search(r"bpnet_(\d+)conv$", name) and int(re.search(r"bpnet_(\d+)conv$", name).group(1)) < num_layers))]
+    assert(len(layers) == num_layers) # the model has fewer convolutions than --freeze-layers
+    for layer in layers:
+        layer.trainable = False
+    print("froze layers: "+", ".join(layer.name for layer in layers))
+
+    model.compile(optimizer=model.optimizer,
+                    loss=[losses.multinomial_nll,'mse'],
+                    loss_weights=[1,float(parameters['counts_loss_weight'])])
+
+def get_float32_model(model, args, parameters, architecture_module):
+    """
+    Rebuilds a model trained under a mixed precision policy with float32 layers and
+    copies its weights, so that saved models do not depend on the training precision.
+    """
+    tf.keras.mixed_precision.set_global_policy("float32")
+    float32_model=architecture_module.getModelGivenModelOptionsAndWeightInits(args, parameters)
+    if args.freeze_layers > 0:
+        freeze_layers(float32_model, args.freeze_layers, parameters)
+    float32_model.set_weights(model.get_weights())
+
+    # carry over the optimizer state (unwrapping the loss scale optimizer of mixed_float16)
+    optimizer_state.copy_optimizer_state(model.optimizer, float32_model.optimizer, float32_model.trainable_variables)
+    return float32_model
+
+def evaluate_full_valid(model, full_valid_gen, full_validation_steps, output_path):
+    # early stopping decided on the validation subset, the loss on all validation examples is reported once
+    print("evaluating on all validation examples")
+    full_valid_losses = model.evaluate(full_valid_gen, steps=full_validation_steps, verbose=1, return_dict=True)
+    with open(output_path, "w") as f:
+        f.write(",".join("val_"+name for name in full_valid_losses)+"\n")
+        f.write(",".join(str(loss) for loss in full_valid_losses.values())+"\n")
+    print("full validation "+", ".join("val_{}: {:.4f}".format(name, loss) for name, loss in full_valid_losses.items()))
+
+def fit_and_evaluate(model,train_gen,valid_gen,args,architecture_module,parameters,steps_per_epoch=None,validation_steps=None,full_valid_gen=None,full_validation_steps=None):
     model_output_path_h5_name=args.output_prefix+".h5"
     model_output_path_logs_name=args.output_prefix+".log"
 
     checkpointer = tfcallbacks.ModelCheckpoint(filepath=model_output_path_h5_name, monitor="val_loss", mode="min",  verbose=1, save_best_only=True)
     earlystopper = tfcallbacks.EarlyStopping(monitor='val_loss', mode="min", patience=args.early_stop, verbose=1, restore_best_weights=True)
-    history= callbacks.LossHistory(model_output_path_logs_name+".batch",args.trackables)
-    csvlogger = tfcallbacks.CSVLogger(model_output_path_logs_name, append=False)
+
+    # full training state checkpoints, the state of a resumed run is loaded (and its logs truncated) here
+    checkpoint_dir = args.resume if args.resume is not None else args.checkpoint_dir
+    training_state = None
+    resuming = args.resume is not None
+    if checkpoint_dir is not None:
+        training_state = callbacks.TrainingState(checkpoint_dir, checkpointer, earlystopper, [model_output_path_logs_name, model_output_path_logs_name+".batch"], resume=resuming)
+        if resuming and (training_state.state is None):
+            print("no training state in {}, training from scratch".format(args.resume))
+            resuming = False
+
+    history= callbacks.LossHistory(model_output_path_logs_name+".batch",args.trackables,append=resuming)
+    csvlogger = tfcallbacks.CSVLogger(model_output_path_logs_name, append=resuming)
     #reduce_lr = tfcallbacks.ReduceLROnPlateau(monitor='val_loss',factor=0.4, patience=args.early_stop-2, min_lr=0.00000001)
     cur_callbacks=[checkpointer,earlystopper,csvlogger,history]
 
+    if args.profile or (args.profile_steps is not None):
+        trace_steps = None
+        if args.profile_steps is not None:
+            trace_steps = [int(step) for step in args.profile_steps.split(",")]
+            assert(len(trace_steps)==2 and trace_steps[0]<=trace_steps[1]) # --profile-steps takes start,end
+        profiler = callbacks.StepProfiler(args.output_prefix+".profile.tsv", args.batch_size, args.output_prefix+".profile_trace", trace_steps)
+        if isinstance(train_gen, tf.keras.utils.Sequence):
+            # time the batch generator too (tf.data pipelines and distributed inputs are not timed)
+            train_gen = profiler.wrap(train_gen)
+        cur_callbacks.append(profiler)
+
+    initial_epoch = 0
+    if training_state is not None:
+        cur_callbacks.append(training_state)
+        if resuming:
+            initial_epoch = training_state.resume(model, train_gen, args.epochs)
+
     model.fit(train_gen,
               validation_data=valid_gen,
               epochs=args.epochs,
+              initial_epoch=initial_epoch,
+              steps_per_epoch=steps_per_epoch,
+              validation_steps=validation_steps,
               verbose=1,
               callbacks=cur_callbacks)
 
+    if full_valid_gen is not None:
+        evaluate_full_valid(model, full_valid_gen, full_validation_steps, model_output_path_logs_name+".full_valid")
+
+    with model.distribute_strategy.scope():
+        if args.precision != "fp32":
+            model = get_float32_model(model, args, parameters, architecture_module)
+
+        if args.precompute_bias:
+            # the model was fed precomputed bias outputs, save it with the frozen bias model attached back
+            model = architecture_module.attach_bias_model(model, parameters)
+
     print('save model') 
     model.save(model_output_path_h5_name)
 
@@ -72,23 +260,83 @@ def get_model_param_dict(args):
 
     return params 
 
-def main(args):
-
+def main(args, fold_data=None):
+    """
+    Trains a model. fold_data is the data of all folds extracted once by
+    initializers.load_fold_data (see train_folds), None extracts the data of the fold.
+    """
 
     # read tab-seperated parameters file
     parameters = get_model_param_dict(args)
     print(parameters)
     np.random.seed(args.seed)
 
-    # get model architecture to load
-    model, architecture_module=get_model(args, parameters)
+    # thread pools are fixed once tensorflow initializes (e.g. by the previous fold of train_folds)
+    if args.intra_op_threads > 0 and tf.config.threading.get_intra_op_parallelism_threads() != args.intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    if args.inter_op_threads > 0 and tf.config.threading.get_inter_op_parallelism_threads() != args.inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+
+    # the strategy has to exist before any other tensorflow op
+    strategy = get_strategy(args)
+    if not is_chief():
+        # every worker saves models and logs, only the chief's go to the output prefix
+        args.output_prefix = os.path.join(tempfile.mkdtemp(), os.path.basename(args.output_prefix))
+
+    # get model architecture to load, layers compute in the dtype of --precision
+    tf.keras.mixed_precision.set_global_policy(PRECISION_POLICIES[args.precision])
+    with strategy.scope():
+        model, architecture_module=get_model(args, parameters)
+        if args.init_from is not None:
+            init_from_model(model, args.init_from)
+        if args.freeze_layers > 0:
+            freeze_layers(model, args.freeze_layers, parameters)
+    if args.jit:
+        # XLA compile the train/test/predict steps
+        model.jit_compile = True
 
     # initialize generators to load data
-    train_generator = initializers.initialize_generators(args, "train", parameters, return_coords=False)
-    valid_generator = initializers.initialize_generators(args, "valid", parameters, return_coords=False)
+    if fold_data is not None:
+        train_generator = initializers.initialize_fold_generators(args, "train", parameters, fold_data, return_coords=False)
+        valid_generator = initializers.initialize_fold_generators(args, "valid", parameters, fold_data, return_coords=False)
+    elif args.tf_data:
+        tf.random.set_seed(args.seed)
+        train_generator = initializers.initialize_datasets(args, "train", parameters)
+        valid_generator = initializers.initialize_datasets(args, "valid", parameters)
+    else:
+        train_generator = initializers.initialize_generators(args, "train", parameters, return_coords=False)
+        valid_generator = initializers.initialize_generators(args, "valid", parameters, return_coords=False)
+
+    if args.precompute_bias:
+        assert(not (args.tf_data or args.streaming)) # bias outputs are precomputed for the in-memory generator only
+        assert(hasattr(architecture_module, "get_bias_window_model")) # architecture has no frozen bias model to precompute outputs of
+        for generator in [train_generator, valid_generator]:
+            generator.precompute_bias(lambda max_jitter: architecture_module.get_bias_window_model(parameters, max_jitter))
+
+    full_valid_generator, full_validation_steps = None, None
+    if (args.valid_subset is not None) or args.cache_valid:
+        assert(not (args.tf_data or args.streaming)) # validation subsets and caching are built from the in-memory generator
+    if args.valid_subset is not None:
+        full_valid_generator = valid_generator
+        valid_generator = valid_generator.get_subset(args.valid_subset, args.seed)
+        print("validating every epoch on {} of {} validation examples".format(valid_generator.cur_idx.shape[0], full_valid_generator.cur_idx.shape[0]))
+    if args.cache_valid:
+        assert(args.distribution == "none") # distributed training feeds validation through the sharded generator
+        valid_generator = tf_dataset.get_cached_dataset(valid_generator)
+
+    if (args.checkpoint_dir is not None) or (args.resume is not None):
+        assert(args.distribution == "none") # training state checkpoints are not supported for distributed training
+
+    steps_per_epoch, validation_steps = None, None
+    if args.distribution != "none":
+        assert(not (args.tf_data or args.streaming)) # distributed training shards the in-memory generator only
+        train_generator, steps_per_epoch = get_distributed_input(train_generator, strategy)
+        valid_generator, validation_steps = get_distributed_input(valid_generator, strategy)
+        if full_valid_generator is not None:
+            full_valid_generator, full_validation_steps = get_distributed_input(full_valid_generator, strategy)
 
     # train the model using the generators
-    fit_and_evaluate(model, train_generator, valid_generator, args, architecture_module)
+    fit_and_evaluate(model, train_generator, valid_generator, args, architecture_module, parameters, steps_per_epoch, validation_steps, full_valid_generator, full_validation_steps)
 
     # store arguments and and parameters to checkpoint
     with open(args.output_prefix+'.args.json', 'w') as fp:
@@ -0,0 +1,70 @@
+import chrombpnet.training.utils.argmanager as argmanager
+import chrombpnet.training.data_generators.initializers as initializers
+import chrombpnet.training.train as train
+import multiprocessing
+import shutil
+import copy
+import os
+
+def get_fold_args(args):
+    """
+    Arguments of train.main for every fold: the chr_fold_path and params of the fold,
+    with outputs (and training state checkpoints) written per fold.
+    """
+    assert(len(args.chr_fold_paths)==len(args.params)) # expected one params file per fold
+
+    fold_args = []
+    for i, (chr_fold_path, params) in enumerate(zip(args.chr_fold_paths, args.params)):
+        args_copy = copy.deepcopy(args)
+        args_copy.chr_fold_path = chr_fold_path
+        args_copy.params = params
+        args_copy.output_prefix = "{}_fold_{}".format(args.output_prefix, i)
+        if args.checkpoint_dir is not None:
+            args_copy.checkpoint_dir = os.path.join(args.checkpoint_dir, "fold_{}".format(i))
+        if args.resume is not None:
+            args_copy.resume = os.path.join(args.resume, "fold_{}".format(i))
+        fold_args.append(args_copy)
+    return fold_args
+
+def train_fold(args, parameters):
+    # worker process of --concurrent-folds, memory maps the data the parent extracted to the cache
+    fold_data = initializers.load_fold_data(args, parameters)
+    train.main(args, fold_data)
+
+def main(args):
+    assert(not (args.streaming or args.tf_data)) # folds share the data of the in-memory generator
+
+    fold_args = get_fold_args(args)
+    fold_parameters = [train.get_model_param_dict(fold) for fold in fold_args]
+    for key in ["inputlen", "outputlen", "max_jitter"]:
+        assert(len(set(parameters[key] for parameters in fold_parameters))==1) # folds extract data of different widths
+
+    if args.concurrent_folds <= 1:
+        # extract every region once, folds train one after the other on views of the same arrays
+        fold_data = initializers.load_fold_data(args, fold_parameters[0])
+        for fold in fold_args:
+            train.main(fold, fold_data)
+        return
+
+    assert(args.distribution == "none") # concurrent folds run in separate processes, each on one replica
+
+    # the data is extracted once to the cache, which every fold process memory maps
+    cache_dir = args.cache_dir
+    if cache_dir is None:
+        cache_dir = args.output_prefix+"_fold_data_cache"
+    for fold in fold_args:
+        fold.cache_dir = cache_dir
+    initializers.load_fold_data(fold_args[0], fold_parameters[0])
+
+    # let the fold processes share GPUs instead of the first one reserving all memory
+    os.environ.setdefault("TF_FORCE_GPU_ALLOW_GROWTH", "true")
+    with multiprocessing.get_context("spawn").Pool(args.concurrent_folds, maxtasksperchild=1) as pool:
+        pool.starmap(train_fold, zip(fold_args, fold_parameters))
+
+    if args.cache_dir is None:
+        shutil.rmtree(cache_dir)
+
+if __name__=="__main__":
+    # read arguments
+    args=argmanager.fetch_train_folds_args()
+    main(args)
@@ -1,45 +1,102 @@
 import argparse
 
-def update_data_args(parser):
+def update_data_args(parser, multiple_folds=False):
     parser.add_argument("-g", "--genome", type=str, required=True, help="Genome fasta")
     parser.add_argument("-b", "--bigwig", type=str, required=False, help="Bigwig of tn5 insertions. Ensure it is +4/-4 shifted")
     parser.add_argument("-p", "--peaks", type=str, default="None", help="10 column bed file of peaks. Sequences and labels will be extracted centered at start (2nd col) + summit (10th col).")
     parser.add_argument("-n", "--nonpeaks", type=str, default="None" ,help="10 column bed file of non-peak regions, centered at summit (10th column)")
     parser.add_argument("-o", "--output_prefix", type=str, required=True, help="Output prefix")
-    parser.add_argument("-fl", "--chr_fold_path", type=str, required=True, help="Fold information - see splits.py to set folds")
+    if multiple_folds:
+        parser.add_argument("-fl", "--chr_fold_paths", type=str, nargs="+", required=True, help="Fold information of every fold to train - see splits.py to set folds")
+    else:
+        parser.add_argument("-fl", "--chr_fold_path", type=str, required=True, help="Fold information - see splits.py to set folds")
+    parser.add_argument("--cache-dir", type=str, default=None, help="Directory to cache extracted sequences and counts in. Repeated runs on the same regions, genome and bigwig memory map the cached arrays instead of re-extracting them")
+    parser.add_argument("--streaming", action="store_true", default=False, help="Keep only region co-ordinates in memory and read the sequences and counts of every batch from the genome and bigwig. Use when the extracted data does not fit in memory")
+    parser.add_argument("--pack-seqs", action="store_true", default=False, help="Keep training sequences packed at 2 bits per base (instead of 1 byte per base) and unpack them per batch")
 
 
-def update_train_args(parser):
+def update_train_args(parser, multiple_folds=False):
     parser.add_argument("-e", "--epochs", type=int, default=50, help="Maximum epochs to train")
     parser.add_argument("-es", "--early-stop", type=int, default=5, help="Early stop limit, corresponds to 'patience' in callback")
     parser.add_argument("-bs", "--batch_size", type=int, default=64)
     parser.add_argument("-l", "--learning-rate", type=float, default=0.001)
-    parser.add_argument("-pf", "--params", type=str, required=True, default=None)
+    parser.add_argument("--tf-data", action="store_true", default=False, help="Feed training with a tf.data pipeline that jitters, revcomps and batches examples in parallel and prefetches batches, instead of a keras Sequence")
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16", "mixed"], help="Training precision: fp32, bf16 (bfloat16 compute, e.g. CPUs with AMX/AVX512-BF16) or mixed (float16 compute with loss scaling, GPUs). Variables, output heads and losses stay float32, and the saved model is float32")
+    parser.add_argument("--jit", action="store_true", default=False, help="XLA compile the training step")
+    parser.add_argument("--precompute-bias", action="store_true", default=False, help="Run the frozen bias model once per region (over the jitter window, both strands) and feed its outputs to the model instead of running it on every batch. The outputs are held in memory as float32, (outputlen+4*max_jitter+1) values per peak and strand, e.g. ~5.6GB for 250k peaks at the defaults (outputlen 1000, max_jitter 500). Only for architectures with a frozen bias model")
+    parser.add_argument("--distribution", type=str, default="none", choices=["none", "mirrored", "multi-worker"], help="Data parallel training with tf.distribute: mirrored (all local GPUs) or multi-worker (one process per worker, cluster given by the TF_CONFIG environment variable, only the chief writes outputs). Every worker trains on its shard of each epoch and --batch-size is the global batch size")
+    parser.add_argument("--checkpoint-dir", type=str, default=None, help="Save the full training state (model weights, optimizer state, epoch, early stopping and checkpoint callbacks, log sizes, random states) to this directory at the end of every epoch, for --resume. The directory must not hold the state of another run (continue that run with --resume instead)")
+    parser.add_argument("--resume", type=str, default=None, help="Continue an interrupted run from the last training state saved to this --checkpoint-dir (and keep saving to it), with the same results as an uninterrupted run. Trains from scratch if the directory has no saved state yet. Augmentations drawn by --tf-data pipelines are not restored")
+    parser.add_argument("--profile", action="store_true", default=False, help="Write per step timings (model step, batch generator __getitem__, examples/sec, host RSS) and the time of the generator rebuild at every epoch end to <output prefix>.profile.tsv, to tell whether training is bound by the input pipeline or by compute")
+    parser.add_argument("--profile-steps", type=str, default=None, help="Write a tensorflow profiler trace (for tensorboard) of the training steps start,end (e.g. 10,20, counted over all epochs) to <output prefix>.profile_trace. Implies --profile")
+    parser.add_argument("--intra-op-threads", type=int, default=0, help="Threads tensorflow runs a single op with (0 lets tensorflow decide)")
+    parser.add_argument("--inter-op-threads", type=int, default=0, help="Threads tensorflow runs independent ops in parallel with (0 lets tensorflow decide)")
+    parser.add_argument("--init-from", type=str, default=None, help="Warm start from a trained model .h5 (e.g. chrombpnet.h5 or chrombpnet_nobias.h5 of another replicate, or bias.h5 for bias models): trainable layers of the same name and shape start from its weights, frozen bias model layers are kept")
+    parser.add_argument("--freeze-layers", type=int, default=0, help="Freeze the first convolution and the following (N-1) dilated convolutions of the trained model, e.g. when fine-tuning with --init-from")
+    parser.add_argument("--cache-valid", action="store_true", default=False, help="Extract the validation examples once into tensors and validate every epoch on a tf.data pipeline of them, instead of the batch generator")
+    parser.add_argument("--valid-subset", type=int, default=None, help="Validate every epoch (val_loss for checkpointing and early stopping) on a fixed sample of this many validation examples, stratified by peak/nonpeak and total counts, and on all validation examples once after training")
+    if multiple_folds:
+        parser.add_argument("-pf", "--params", type=str, nargs="+", required=True, default=None, help="Model params file of every fold, in the order of --chr_fold_paths")
+        parser.add_argument("--concurrent-folds", type=int, default=1, help="Number of folds to train at the same time, in separate processes that memory map the data extracted once for all folds")
+    else:
+        parser.add_argument("-pf", "--params", type=str, required=True, default=None)
     parser.add_argument("--trackables",nargs="*",default=['loss','val_loss'], help="list of things to track per batch, such as logcount_predictions_loss,loss,profile_predictions_loss,val_logcount_predictions_loss,val_loss,val_profile_predictions_loss")
 
 def update_model_args(parser):
     parser.add_argument("-s", "--seed", type=int, default=1234, help="seed to use for model training")
     parser.add_argument("-a","--architecture_from_file",type=str,required=True, default=None, help="Model to use for training")
 
-def fetch_train_args():
+def get_train_parser():
     parser = argparse.ArgumentParser()
     update_data_args(parser)
     update_train_args(parser)
     update_model_args(parser)
+    return parser
+
+def fetch_train_args():
+    parser = get_train_parser()
+    args = parser.parse_args()
+
+    assert((args.peaks.lower() != "none") or (args.nonpeaks.lower() != "none")) #Both peaks and nonpeaks are empty" 
+
+    return args
+
+def fetch_train_folds_args():
+    parser = argparse.ArgumentParser()
+    update_data_args(parser, multiple_folds=True)
+    update_train_args(parser, multiple_folds=True)
+    update_model_args(parser)
     args = parser.parse_args()
 
     assert((args.peaks.lower() != "none") or (args.nonpeaks.lower() != "none")) #Both peaks and nonpeaks are empty" 
 
     return args
 
+def update_schedule_args(parser):
+    parser.add_argument("-m", "--manifest", type=str, required=True, help="TSV of training jobs with a header. Required columns: name, genome, bigwig, peaks, nonpeaks, chr_fold_path, params, architecture_from_file, output_prefix. Optional columns threads and memory_gb override --threads-per-job and --memory-per-job, any other column is passed as the option of the same name to chrombpnet.training.train (e.g. epochs, batch_size, precompute_bias)")
+    parser.add_argument("--summary", type=str, default=None, help="TSV to write the wall time, peak memory and throughput of every job to. Defaults to <manifest>.summary.tsv")
+    parser.add_argument("--cores", type=str, default=None, help="Comma separated cores to run jobs on, every job is pinned to cores of its own. Defaults to all cores available to the scheduler")
+    parser.add_argument("--memory-gb", type=float, default=None, help="Memory budget in GB, jobs are started only while the memory_gb of the running jobs fits in it. Defaults to the physical memory")
+    parser.add_argument("--threads-per-job", type=int, default=8, help="Cores (and tensorflow intra op threads) of every job")
+    parser.add_argument("--inter-op-threads", type=int, default=2, help="Tensorflow inter op threads of every job")
+    parser.add_argument("--memory-per-job", type=float, default=16, help="Memory in GB budgeted for every job")
+
+def fetch_schedule_args():
+    parser = argparse.ArgumentParser()
+    update_schedule_args(parser)
+    return parser.parse_args()
+
 def fetch_predict_args():
     parser = argparse.ArgumentParser()
     update_data_args(parser)
-    parser.add_argument("-m", "--model_h5", type=str, required=True, help="Path to model hdf5")
+    parser.add_argument("-m", "--model_h5", type=str, nargs="+", required=True, help="Path to model hdf5, several models are evaluated on the test regions in one pass")
+    parser.add_argument("--output-prefixes", type=str, nargs="+", default=None, help="Output prefix of every model in --model_h5, defaults to the output prefix for one model and to <output prefix>_<model file name> for several")
     parser.add_argument("-bs", "--batch_size", type=int, default=512)
     parser.add_argument("-s", "--seed", type=int, default=1234, help="seed to use for model training")
     parser.add_argument("-il", "--inputlen", type=int, default=2114, help="Sequence input length")
     parser.add_argument("-ol", "--outputlen", type=int, default=1000, help="Prediction output length")
+    parser.add_argument("--metrics-threads", type=int, default=1, help="Threads to compute profile metrics with")
+    parser.add_argument("--stream-predictions", action="store_true", default=False, help="Write predicted profiles to the predictions .h5 (and labels to a temporary .h5) batch by batch and compute metrics from them in chunks, instead of holding all profiles in memory")
     args = parser.parse_args()
 
     assert((args.peaks.lower() != "none") or (args.nonpeaks.lower() != "none")) #Both peaks and nonpeaks are empty" 
@@ -1,4 +1,5 @@
 import numpy as np
+from chrombpnet.training.utils import one_hot
 
 # https://stackoverflow.com/questions/46091111/python-slice-array-at-different-position-on-every-row
 def take_per_row(A, indx, num_elem):
@@ -31,7 +32,7 @@ def random_crop(seqs, labels, seq_crop_width, label_crop_width, coords):
     starts = np.random.choice(range(max_start+1), size=seqs.shape[0], replace=True)
 
     new_coords = coords.copy()
-    new_coords[:,1] = new_coords[:,1].astype(int) - (seqs.shape[1]//2) + starts
+    new_coords["pos"] = new_coords["pos"] - (seqs.shape[1]//2) + starts
 
     return take_per_row(seqs, starts, seq_crop_width), take_per_row(labels, starts, label_crop_width), new_coords
 
@@ -41,6 +42,8 @@ def random_rev_comp(seqs, labels, coords, frac=0.5):
     sequences and labels.
 
     Assumes seqs are arranged in ACGT. Then ::-1 gives TGCA which is revcomp.
+    seqs can also be an N x L array of base codes (see one_hot.BASE_CODES), which
+    are reverse complemented by lookup.
 
     NOTE: Performs in-place modification.
     """
@@ -49,15 +52,18 @@ def random_rev_comp(seqs, labels, coords, frac=0.5):
             size=int(seqs.shape[0]*frac),
             replace=False)
 
-    seqs[pos_to_rc] = seqs[pos_to_rc, ::-1, ::-1]
+    if seqs.ndim == 2:
+        seqs[pos_to_rc] = one_hot.revcomp_codes(seqs[pos_to_rc])
+    else:
+        seqs[pos_to_rc] = seqs[pos_to_rc, ::-1, ::-1]
     labels[pos_to_rc] = labels[pos_to_rc, ::-1]
-    coords[pos_to_rc,2] =  "r"
+    coords["rc"][pos_to_rc] = True
 	
     return seqs, labels, coords
 
 def crop_revcomp_augment(seqs, labels, coords, seq_crop_width, label_crop_width, add_revcomp, rc_frac=0.5, shuffle=False):
     """
-    seqs: B x IL x 4
+    seqs: B x IL x 4 (or B x IL base codes)
     labels: B x OL
 
     Applies random crop to seqs and labels and reverse complements rc_frac. 
@@ -82,3 +88,49 @@ def crop_revcomp_augment(seqs, labels, coords, seq_crop_width, label_crop_width,
 
 
     return mod_seqs, mod_labels, mod_coords
+
+def get_epoch_indices(num_peaks, num_nonpeaks, max_start, negative_sampling_ratio, add_revcomp, rc_frac=0.5, shuffle=False):
+    """
+    Index-based version of random_crop, subsampling of nonpeaks and crop_revcomp_augment.
+    Instead of copying the data of an epoch, returns for every example of the
+    epoch (in order):
+
+    is_peak: bool, whether the example is a peak or a nonpeak
+    idx: index of the example in the peak or nonpeak arrays
+    starts: crop start of the example (always 0 for nonpeaks, which are not jittered)
+    rc: bool, whether the example is reverse complemented
+
+    Random numbers are drawn in the same order as the array based functions,
+    so the same seed selects the same examples, crops and revcomps.
+    """
+
+    is_peak = np.zeros(0, dtype=bool)
+    idx = np.zeros(0, dtype=np.int64)
+    starts = np.zeros(0, dtype=np.int64)
+
+    if num_peaks > 0:
+        peak_starts = np.random.choice(range(max_start+1), size=num_peaks, replace=True)
+        is_peak = np.ones(num_peaks, dtype=bool)
+        idx = np.arange(num_peaks)
+        starts = peak_starts
+
+    if num_nonpeaks > 0:
+        nonpeak_idx = np.arange(num_nonpeaks)
+        if (num_peaks > 0) and (negative_sampling_ratio < 1.0):
+            #Randomly samples a portion of the non-peak data to use in training
+            num_nonpeak_samples = int(negative_sampling_ratio * num_peaks)
+            nonpeak_idx = np.random.choice(num_nonpeaks, size=num_nonpeak_samples, replace=False)
+        is_peak = np.concatenate([is_peak, np.zeros(nonpeak_idx.shape[0], dtype=bool)])
+        idx = np.concatenate([idx, nonpeak_idx])
+        starts = np.concatenate([starts, np.zeros(nonpeak_idx.shape[0], dtype=np.int64)])
+
+    rc = np.zeros(idx.shape[0], dtype=bool)
+    if add_revcomp:
+        pos_to_rc = np.random.choice(range(idx.shape[0]), size=int(idx.shape[0]*rc_frac), replace=False)
+        rc[pos_to_rc] = True
+
+    if shuffle:
+        perm = np.random.permutation(idx.shape[0])
+        is_peak, idx, starts, rc = is_peak[perm], idx[perm], starts[perm], rc[perm]
+
+    return is_peak, idx, starts, rc
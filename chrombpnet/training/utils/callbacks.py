@@ -1,4 +1,26 @@
 import tensorflow.keras as keras
+import tensorflow as tf
+import chrombpnet.training.utils.optimizer_state as optimizer_state
+import numpy as np
+import random
+import pickle
+import resource
+import time
+import os
+
+# training state saved next to the tf.train.Checkpoint files of a checkpoint directory
+STATE_FILE = "training_state.pkl"
+
+# columns of the StepProfiler log
+PROFILE_COLUMNS = ["event", "epoch", "batch", "seconds", "getitem_seconds", "getitem_calls", "examples_per_sec", "rss_mb"]
+
+def get_rss_mb():
+    # current resident set size on linux, peak resident set size elsewhere
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1])*os.sysconf("SC_PAGE_SIZE")/2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
 
 class LossHistory(keras.callbacks.Callback):
     """
@@ -6,11 +28,15 @@ class LossHistory(keras.callbacks.Callback):
     You can also track the counts loss and profile loss seperatley using the callbacks provided.
     """
     
-    def __init__(self,model_output_path_logs_name,to_track):
+    def __init__(self,model_output_path_logs_name,to_track,append=False):
         self.model_output_path_logs_name=model_output_path_logs_name
         self.to_track=to_track
-        self.outf=open(self.model_output_path_logs_name,'w')
-        self.outf.write('Epoch\tBatch\t'+'\t'.join(self.to_track)+'\n')
+        if append:
+            # continue the log of a resumed run
+            self.outf=open(self.model_output_path_logs_name,'a')
+        else:
+            self.outf=open(self.model_output_path_logs_name,'w')
+            self.outf.write('Epoch\tBatch\t'+'\t'.join(self.to_track)+'\n')
         keras.callbacks.Callback.__init__(self)
 
     def on_train_begin(self, logs={}):
@@ -34,7 +60,180 @@ class LossHistory(keras.callbacks.Callback):
             for trackable in self.to_track:
                 self.outf.write('\t'+str(self.losses[epoch][trackable][i]))
             self.outf.write('\n')
+        self.outf.flush()
 
         
     def on_train_end(self,logs={}):
         self.outf.close()
+
+
+class TrainingState(keras.callbacks.Callback):
+    """
+    Saves the full state of training to checkpoint_dir at the end of every epoch: model
+    weights and optimizer slots (as a tf.train.Checkpoint), the epoch, the state of the
+    ModelCheckpoint and EarlyStopping callbacks, the sizes of the log files and the numpy
+    and python random states that the batch generators and keras draw epochs from.
+
+    With resume, the state saved in checkpoint_dir (if any) is loaded and the logs are
+    truncated to the last saved epoch when this callback is created, and resume()
+    restores the model and random states, so that fit(initial_epoch=resume(...))
+    continues where the run left off. Without resume, checkpoint_dir must not hold the
+    state of another run.
+    Must be the last callback, so that it sees the other callbacks after their epoch end.
+    """
+
+    def __init__(self,checkpoint_dir,checkpointer,earlystopper,log_paths,resume=False):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.checkpoint_dir=checkpoint_dir
+        self.checkpointer=checkpointer
+        self.earlystopper=earlystopper
+        self.log_paths=log_paths
+        self.state=None
+        self.manager=None
+        state_path=os.path.join(checkpoint_dir, STATE_FILE)
+        if not resume:
+            assert(not os.path.exists(state_path)) # checkpoint directory holds the training state of another run, continue it with --resume or use another directory
+        elif os.path.exists(state_path):
+            self.state=pickle.load(open(state_path,'rb'))
+            # drop anything logged after the saved epoch
+            for path, size in self.state["log_sizes"].items():
+                if os.path.exists(path):
+                    os.truncate(path, size)
+        keras.callbacks.Callback.__init__(self)
+
+    def get_manager(self, model):
+        if self.manager is None:
+            checkpoint=tf.train.Checkpoint(model=model, optimizer=model.optimizer)
+            # keep the previous checkpoint until the state pointing to the new one is written
+            self.manager=tf.train.CheckpointManager(checkpoint, self.checkpoint_dir, max_to_keep=2)
+        return self.manager
+
+    def resume(self, model, train_gen, epochs):
+        """
+        Restores model weights, optimizer slots and random states from the saved state and
+        draws the next epoch of train_gen. Returns the epoch to continue training from.
+        """
+        if self.state is None:
+            return 0
+        print("resuming training after epoch {} from {}".format(self.state["epoch"]+1, self.checkpoint_dir))
+        # create the optimizer slots so that they are restored right away
+        optimizer_state.build_optimizer(getattr(model.optimizer, "inner_optimizer", model.optimizer), model.trainable_variables)
+        self.get_manager(model).checkpoint.restore(self.state["checkpoint"]).assert_existing_objects_matched()
+        np.random.set_state(self.state["numpy_random"])
+        random.setstate(self.state["python_random"])
+        # keras calls on_epoch_end of the generator after the callbacks of an epoch
+        train_gen.on_epoch_end()
+        if self.state["stop_training"]:
+            return epochs
+        return self.state["epoch"]+1
+
+    def on_train_begin(self, logs={}):
+        # the callbacks reset their state at the start of training
+        if self.state is None:
+            return
+        self.checkpointer.best=self.state["checkpointer_best"]
+        for key, value in self.state["earlystopper"].items():
+            setattr(self.earlystopper, key, value)
+
+    def on_epoch_end(self, epoch, logs={}):
+        checkpoint_path=self.get_manager(self.model).save(checkpoint_number=epoch)
+        state={"epoch": epoch,
+               "checkpoint": checkpoint_path,
+               "stop_training": self.model.stop_training,
+               "checkpointer_best": self.checkpointer.best,
+               "earlystopper": {key: getattr(self.earlystopper, key) for key in ["wait", "stopped_epoch", "best", "best_weights", "best_epoch"]},
+               "log_sizes": {path: os.path.getsize(path) for path in self.log_paths},
+               "numpy_random": np.random.get_state(),
+               "python_random": random.getstate()}
+        state_path=os.path.join(self.checkpoint_dir, STATE_FILE)
+        with open(state_path+".tmp",'wb') as fp:
+            pickle.dump(state, fp)
+        os.replace(state_path+".tmp", state_path)
+
+
+class ProfiledSequence(keras.utils.Sequence):
+    """
+    Wraps a batch generator to time its __getitem__ and on_epoch_end calls for a StepProfiler.
+    """
+
+    def __init__(self,sequence,profiler):
+        self.sequence=sequence
+        self.profiler=profiler
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getitem__(self, idx):
+        start=time.perf_counter()
+        batch=self.sequence[idx]
+        # keras may fetch batches in a background thread, list appends are thread safe
+        self.profiler.getitem_times.append(time.perf_counter()-start)
+        return batch
+
+    def on_epoch_end(self):
+        start=time.perf_counter()
+        self.sequence.on_epoch_end()
+        self.profiler.log_generator_epoch_end(time.perf_counter()-start)
+
+
+class StepProfiler(keras.callbacks.Callback):
+    """
+    Streams per step timings to a tsv (flushed every line) to tell whether training is
+    bound by the input pipeline or by compute. For every training step ("step" rows):
+    the model step time (which includes waiting for the next batch), the time spent in
+    __getitem__ of the batch generator since the previous step and how many batches it
+    produced, examples per second (over the time between step ends) and the host RSS.
+    "generator_epoch_end" rows time the crop/revcomp rebuild of the generator at the end
+    of every epoch. Getitem times need the generator to be wrapped with wrap().
+    With trace_steps=(start, end), a tensorflow profiler trace of training steps start
+    to end (counted over all epochs) is written to trace_dir for tensorboard.
+    """
+
+    def __init__(self,profile_path,batch_size,trace_dir=None,trace_steps=None):
+        self.batch_size=batch_size
+        self.trace_dir=trace_dir
+        self.trace_steps=trace_steps
+        self.tracing=False
+        self.global_step=0
+        self.getitem_times=[]
+        self.cur_epoch=0
+        self.outf=open(profile_path,'w')
+        self.outf.write('\t'.join(PROFILE_COLUMNS)+'\n')
+        keras.callbacks.Callback.__init__(self)
+
+    def wrap(self, sequence):
+        return ProfiledSequence(sequence, self)
+
+    def write_row(self, values):
+        self.outf.write('\t'.join(str(v) for v in values)+'\n')
+        self.outf.flush()
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self.cur_epoch=epoch
+        self.last_step_end=time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs={}):
+        if (self.trace_steps is not None) and (self.global_step == self.trace_steps[0]):
+            tf.profiler.experimental.start(self.trace_dir)
+            self.tracing=True
+        self.step_start=time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs={}):
+        step_end=time.perf_counter()
+        getitem_times, self.getitem_times=self.getitem_times, []
+        self.write_row(["step", self.cur_epoch, batch, step_end-self.step_start, sum(getitem_times), len(getitem_times),
+                        self.batch_size/(step_end-self.last_step_end), get_rss_mb()])
+        self.last_step_end=step_end
+        if self.tracing and (self.global_step == self.trace_steps[1]):
+            tf.profiler.experimental.stop()
+            self.tracing=False
+        self.global_step+=1
+
+    def log_generator_epoch_end(self, seconds):
+        self.write_row(["generator_epoch_end", self.cur_epoch, "NA", seconds, "NA", "NA", "NA", get_rss_mb()])
+
+    def on_train_end(self, logs={}):
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing=False
+        self.outf.close()
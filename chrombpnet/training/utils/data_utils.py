@@ -1,22 +1,123 @@
 import numpy as np
 import pandas as pd
 import pyBigWig
-import pyfaidx
+import hashlib
+import shutil
+import json
+import os
 from chrombpnet.training.utils import one_hot
+from chrombpnet.training.utils import genome_index
+from chrombpnet.training.utils import signal_index
 
+# regions on a chromosome are read in blocks spanning at most this many bases,
+# so that sparse region sets on long chromosomes do not pull the whole chromosome
+# into memory at once
+MAX_BLOCK_LEN = 2**24
 
-def get_seq(peaks_df, genome, width):
+# bump whenever the layout of the arrays returned by load_data changes, so that
+# stale cache entries are not picked up
+CACHE_VERSION = 3
+CACHE_ARRAYS = ["peak_seqs", "peak_cts", "peak_coords", "nonpeak_seqs", "nonpeak_cts", "nonpeak_coords"]
+
+# co-ordinates of examples: index of the chromosome in the chromosome table (see
+# get_chrom_table), position, whether the example is reverse complemented and
+# whether it is a peak
+COORDS_DTYPE = np.dtype([("chrom", np.int32), ("pos", np.int64), ("rc", np.bool_), ("peak", np.bool_)])
+
+def get_window_starts(peaks_df, width):
     """
-    Same as get_cts, but fetches sequence from a given genome.
+    Returns the chromosome and the start of the window of given width centered
+    at the summit (start + summit) for every region in peaks_df.
+    """
+    chroms = peaks_df['chr'].values
+    starts = (peaks_df['start'].values + peaks_df['summit'].values - width//2).astype(np.int64)
+    return chroms, starts
+
+def get_region_blocks(chroms, starts, width, max_block_len=MAX_BLOCK_LEN):
+    """
+    Groups windows [start, start+width) by chromosome and splits them into blocks
+    of nearby windows. Yields (chrom, block_start, block_end, idx) where idx are
+    the indices of the windows covered by [block_start, block_end).
+
+    Every chromosome is visited once, and each block is read with a single call,
+    after which windows are gathered from the block with fancy indexing.
+    """
+    chrom_codes, chrom_names = pd.factorize(chroms)
+    order = np.lexsort((starts, chrom_codes))
+    chrom_bounds = np.searchsorted(chrom_codes[order], np.arange(len(chrom_names)+1))
+
+    for k, chrom in enumerate(chrom_names):
+        chrom_idx = order[chrom_bounds[k]:chrom_bounds[k+1]]
+        chrom_starts = starts[chrom_idx]
+
+        block_first = 0
+        for i in range(1, len(chrom_idx)+1):
+            if i == len(chrom_idx) or chrom_starts[i] + width - chrom_starts[block_first] > max_block_len:
+                block_idx = chrom_idx[block_first:i]
+                yield chrom, int(chrom_starts[block_first]), int(chrom_starts[i-1]) + width, block_idx
+                block_first = i
+
+def fetch_codes(genome, chroms, starts, width):
+    """
+    Fetches sequences of the windows [start, start+width) on the given chromosomes
+    from genome (see genome_index.open_genome) as an N x width array of base codes
+    (see one_hot.BASE_CODES).
+    """
+    vals = np.empty((len(starts), width), dtype=np.uint8)
+
+    for chrom, lo, hi, idx in get_region_blocks(chroms, starts, width):
+        assert(lo >= 0) # region extends beyond the start of the chromosome
+        block = genome.fetch_codes(chrom, lo, hi)
+        assert(len(block) == hi - lo) # region extends beyond the end of the chromosome
+
+        vals[idx] = np.lib.stride_tricks.sliding_window_view(block, width)[starts[idx] - lo]
+
+    return vals
+
+def get_in_bounds(genome, chroms, starts, width):
+    """
+    Boolean mask of the windows [start, start+width) that lie within their chromosome.
     """
-    vals = []
+    chrom_lens = pd.Series(chroms).map({c: genome.chrom_len(c) for c in pd.unique(chroms)}).values
+    return (starts >= 0) & (starts + width <= chrom_lens)
 
-    for i, r in peaks_df.iterrows():
-        sequence = str(genome[r['chr']][(r['start']+r['summit'] - width//2):(r['start'] + r['summit'] + width//2)])
-        vals.append(sequence)
+def fetch_seqs(genome, chroms, starts, width):
+    """
+    Same as fetch_codes, but returns one-hot encoded sequences.
+    """
+    return one_hot.codes_to_one_hot(fetch_codes(genome, chroms, starts, width))
 
-    return one_hot.dna_to_one_hot(vals)
+def fetch_cts(bw, chroms, starts, width):
+    """
+    Fetches per base values of the windows [start, start+width) on the given
+    chromosomes from a bigwig bw (see signal_index.open_signal). Missing values
+    are returned as 0.
+    """
+    vals = np.empty((len(starts), width), dtype=np.float64)
+
+    for chrom, lo, hi, idx in get_region_blocks(chroms, starts, width):
+        if pyBigWig.numpy:
+            block = bw.values(chrom, lo, hi, numpy=True)
+        else:
+            block = np.array(bw.values(chrom, lo, hi))
+        block = np.nan_to_num(block)
+        vals[idx] = np.lib.stride_tricks.sliding_window_view(block, width)[starts[idx] - lo]
 
+    return vals
+
+def get_seq(peaks_df, genome, width):
+    """
+    Same as get_cts, but fetches sequence from a given genome.
+    """
+    chroms, starts = get_window_starts(peaks_df, width)
+    return fetch_seqs(genome, chroms, starts, width)
+
+def get_seq_codes(peaks_df, genome, width):
+    """
+    Same as get_seq, but returns base codes instead of one-hot encoded sequences.
+    """
+    chroms, starts = get_window_starts(peaks_df, width)
+    return fetch_codes(genome, chroms, starts, width)
 
 def get_cts(peaks_df, bw, width):
     """
@@ -26,33 +127,116 @@ def get_cts(peaks_df, bw, width):
 
     "cts" = per base counts across a region
     """
-    vals = []
-    for i, r in peaks_df.iterrows():
-        vals.append(np.nan_to_num(bw.values(r['chr'], 
-                                            r['start'] + r['summit'] - width//2,
-                                            r['start'] + r['summit'] + width//2)))
-        
-    return np.array(vals)
+    chroms, starts = get_window_starts(peaks_df, width)
+    return fetch_cts(bw, chroms, starts, width)
 
-def get_coords(peaks_df, peaks_bool):
+def get_chrom_table(*regions):
+    """
+    Sorted array of the names of the chromosomes in the given region dataframes
+    (None entries are skipped). Chromosomes of co-ordinates are stored as indices
+    into this table.
+    """
+    chroms = [r['chr'].values for r in regions if r is not None]
+    if len(chroms) == 0:
+        return np.array([], dtype=str)
+    return np.unique(np.concatenate(chroms).astype(str))
+
+def get_chrom_ids(chroms, chrom_names):
+    """
+    Indices of the chromosomes chroms in the chromosome table chrom_names.
+    """
+    ids = pd.Index(chrom_names).get_indexer(chroms)
+    assert(np.all(ids >= 0)) # chromosome missing in the chromosome table
+    return ids.astype(np.int32)
+
+def get_coords(peaks_df, peaks_bool, chrom_names):
     """
     Fetch the co-ordinates of the regions in bed file
-    returns a list of tuples with (chrom, summit)
+    returns a structured array (see COORDS_DTYPE) with the chromosome index
+    into chrom_names and the summit of every region
     """
-    vals = []
-    for i, r in peaks_df.iterrows():
-        vals.append([r['chr'], r['start']+r['summit'], "f", peaks_bool])
+    vals = np.zeros(peaks_df.shape[0], dtype=COORDS_DTYPE)
+    vals["chrom"] = get_chrom_ids(peaks_df['chr'].values, chrom_names)
+    vals["pos"] = peaks_df['start'].values + peaks_df['summit'].values
+    vals["rc"] = False
+    vals["peak"] = peaks_bool
 
-    return np.array(vals)
+    return vals
 
-def get_seq_cts_coords(peaks_df, genome, bw, input_width, output_width, peaks_bool):
+def get_seq_cts_coords(peaks_df, genome, bw, input_width, output_width, peaks_bool, chrom_names):
 
-    seq = get_seq(peaks_df, genome, input_width)
+    seq = get_seq_codes(peaks_df, genome, input_width)
     cts = get_cts(peaks_df, bw, output_width)
-    coords = get_coords(peaks_df, peaks_bool)
+    coords = get_coords(peaks_df, peaks_bool, chrom_names)
     return seq, cts, coords
 
-def load_data(bed_regions, nonpeak_regions, genome_fasta, cts_bw_file, inputlen, outputlen, max_jitter):
+def get_file_signature(fname):
+    """
+    Identifies a (possibly very large) input file by its path, size and modification
+    time instead of hashing its contents.
+    """
+    stat = os.stat(fname)
+    return "{}:{}:{}".format(os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+
+def get_cache_key(bed_regions, nonpeak_regions, genome_fasta, cts_bw_file, inputlen, outputlen, max_jitter):
+    """
+    Content-addressed key of the arrays returned by load_data. Regions are hashed by
+    the columns used for extraction, so that any change in the peaks/nonpeaks (or in
+    the fold/mode based selection of them) results in a new key.
+    """
+    hasher = hashlib.sha256()
+    hasher.update("version={}".format(CACHE_VERSION).encode())
+    for regions in [bed_regions, nonpeak_regions]:
+        if regions is None:
+            hasher.update(b"none")
+        else:
+            hasher.update(pd.util.hash_pandas_object(regions[['chr', 'start', 'summit']], index=False).values.tobytes())
+    hasher.update(get_file_signature(genome_fasta).encode())
+    hasher.update(get_file_signature(cts_bw_file).encode())
+    hasher.update("inputlen={},outputlen={},max_jitter={}".format(inputlen, outputlen, max_jitter).encode())
+    return hasher.hexdigest()
+
+def read_data_cache(cache_path):
+    """
+    Opens cached arrays as copy-on-write memory maps, returns None if the cache
+    entry does not exist (or was not completely written).
+    """
+    manifest_file = os.path.join(cache_path, "manifest.json")
+    if not os.path.exists(manifest_file):
+        return None
+
+    manifest = json.load(open(manifest_file))
+    data = []
+    for name in CACHE_ARRAYS:
+        if manifest[name]:
+            data.append(np.load(os.path.join(cache_path, name+".npy"), mmap_mode="c"))
+        else:
+            data.append(None)
+    return tuple(data)
+
+def write_data_cache(cache_path, data):
+    """
+    Writes the arrays returned by load_data to cache_path. Arrays are first written
+    to a temporary directory which is then renamed, so that readers never see a
+    partially written cache entry.
+    """
+    tmp_path = "{}.tmp{}".format(cache_path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    manifest = {}
+    for name, arr in zip(CACHE_ARRAYS, data):
+        manifest[name] = arr is not None
+        if arr is not None:
+            np.save(os.path.join(tmp_path, name+".npy"), arr)
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as fp:
+        json.dump(manifest, fp, indent=4)
+
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another process wrote the same entry in the meantime
+        shutil.rmtree(tmp_path)
+
+def load_data(bed_regions, nonpeak_regions, genome_fasta, cts_bw_file, inputlen, outputlen, max_jitter, cache_dir=None):
     """
     Load sequences and corresponding base resolution counts for training, 
     validation regions in peaks and nonpeaks (2 x 2 x 2 = 8 matrices).
@@ -62,11 +246,27 @@ def load_data(bed_regions, nonpeak_regions, genome_fasta, cts_bw_file, inputlen,
     cropping. Data of width inputlen/outputlen is returned for validation
     data.
 
+    Sequences are returned as uint8 base codes (see one_hot.BASE_CODES) of shape
+    N x width, to be expanded to one-hot per batch with one_hot.codes_to_one_hot.
+    Co-ordinates are returned as structured arrays (see COORDS_DTYPE), with
+    chromosomes indexing get_chrom_table(bed_regions, nonpeak_regions).
+
     If outliers is not None, removes training examples with counts > outlier%ile
+
+    If cache_dir is not None, the extracted arrays are stored in cache_dir under a key
+    derived from all the inputs, and are memory mapped from there on subsequent calls.
     """
 
-    cts_bw = pyBigWig.open(cts_bw_file)
-    genome = pyfaidx.Fasta(genome_fasta)
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, get_cache_key(bed_regions, nonpeak_regions, genome_fasta, cts_bw_file, inputlen, outputlen, max_jitter))
+        data = read_data_cache(cache_path)
+        if data is not None:
+            print("loaded cached data from: "+cache_path)
+            return data
+
+    cts_bw = signal_index.open_signal(cts_bw_file)
+    genome = genome_index.open_genome(genome_fasta)
+    chrom_names = get_chrom_table(bed_regions, nonpeak_regions)
 
     train_peaks_seqs=None
     train_peaks_cts=None
@@ -81,7 +281,8 @@ def load_data(bed_regions, nonpeak_regions, genome_fasta, cts_bw_file, inputlen,
                                               cts_bw,
                                               inputlen+2*max_jitter,
                                               outputlen+2*max_jitter,
-                                              peaks_bool=1)
+                                              peaks_bool=1,
+                                              chrom_names=chrom_names)
     
     if nonpeak_regions is not None:
         train_nonpeaks_seqs, train_nonpeaks_cts, train_nonpeaks_coords = get_seq_cts_coords(nonpeak_regions,
@@ -89,12 +290,66 @@ def load_data(bed_regions, nonpeak_regions, genome_fasta, cts_bw_file, inputlen,
                                               cts_bw,
                                               inputlen,
                                               outputlen,
-                                              peaks_bool=0)
+                                              peaks_bool=0,
+                                              chrom_names=chrom_names)
 
 
 
     cts_bw.close()
     genome.close()
 
-    return (train_peaks_seqs, train_peaks_cts, train_peaks_coords,
+    data = (train_peaks_seqs, train_peaks_cts, train_peaks_coords,
             train_nonpeaks_seqs, train_nonpeaks_cts, train_nonpeaks_coords)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_data_cache(cache_path, data)
+        print("cached data at: "+cache_path)
+
+    return data
+
+class RowView():
+    """
+    Subset of the rows of an array extracted once for many regions, cropped by crop
+    columns on either side (e.g. to the unjittered window of jittered peaks), and
+    indexed like an array of those rows: view[rows] == array[row_ids[rows], crop:-crop].
+    Lets generators of different folds share the same extracted arrays (see
+    get_region_views) instead of extracting or copying the data of every fold.
+    """
+    def __init__(self, array, row_ids, crop=0):
+        self.array = array
+        self.row_ids = row_ids
+        self.crop = crop
+        self.shape = (row_ids.shape[0], array.shape[1]-2*crop) + array.shape[2:]
+        self.dtype = array.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        return self.array[self.row_ids[rows], self.crop:self.array.shape[1]-self.crop]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[np.arange(self.shape[0])], dtype=dtype)
+
+def get_region_views(data, chrom_names, peak_rows, nonpeak_rows, max_jitter, view_max_jitter, view_chrom_names):
+    """
+    Returns the arrays of load_data for a subset of the regions it was called on:
+    the peaks and nonpeaks at rows peak_rows and nonpeak_rows (None for no peaks or
+    nonpeaks), with peaks cropped from the max_jitter they were extracted with to
+    view_max_jitter. Sequences and counts are RowViews of data, co-ordinates are
+    copied with their chromosomes re-indexed from chrom_names into view_chrom_names.
+    """
+    peak_seqs, peak_cts, peak_coords, nonpeak_seqs, nonpeak_cts, nonpeak_coords = data
+    assert(view_max_jitter <= max_jitter) # peaks were extracted with less jitter than requested
+
+    views = []
+    for seqs, cts, coords, rows, crop in [(peak_seqs, peak_cts, peak_coords, peak_rows, max_jitter-view_max_jitter),
+                                          (nonpeak_seqs, nonpeak_cts, nonpeak_coords, nonpeak_rows, 0)]:
+        if rows is None:
+            views += [None, None, None]
+            continue
+        view_coords = coords[rows]
+        view_coords["chrom"] = get_chrom_ids(chrom_names[view_coords["chrom"]], view_chrom_names)
+        views += [RowView(seqs, rows, crop), RowView(cts, rows, crop), view_coords]
+    return tuple(views)
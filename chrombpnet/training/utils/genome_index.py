@@ -0,0 +1,157 @@
+import numpy as np
+import pyfaidx
+import argparse
+import json
+import os
+from chrombpnet.training.utils import one_hot
+
+# a genome index is a directory with the base codes (see one_hot.BASE_CODES) of all
+# chromosomes concatenated in a single uint8 file, and a table of the offset and
+# length of every chromosome in it
+INDEX_FILE = "index.json"
+CODES_FILE = "codes.u8"
+
+# chromosomes are converted in chunks of this many bases
+CHUNK_LEN = 2**24
+
+def get_default_index_dir(genome_fasta):
+    # prep genome-index writes next to the fasta by default, where open_genome looks for it
+    return genome_fasta + ".index"
+
+def get_source_signature(genome_fasta):
+    stat = os.stat(genome_fasta)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def build_genome_index(genome_fasta, index_dir, chunk_len=CHUNK_LEN):
+    """
+    Converts genome_fasta once into a genome index at index_dir (see GenomeIndex).
+    Files are written to a temporary directory which is then renamed.
+    """
+    genome = pyfaidx.Fasta(genome_fasta)
+    chroms = []
+    offset = 0
+    for chrom in genome.keys():
+        chroms.append({"name": chrom, "offset": offset, "length": len(genome[chrom])})
+        offset += len(genome[chrom])
+
+    tmp_dir = "{}.tmp{}".format(index_dir.rstrip("/"), os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    codes = np.memmap(os.path.join(tmp_dir, CODES_FILE), dtype=np.uint8, mode="w+", shape=(max(offset, 1),))
+    for entry in chroms:
+        print("indexing "+entry["name"])
+        for start in range(0, entry["length"], chunk_len):
+            end = min(start+chunk_len, entry["length"])
+            sequence = str(genome[entry["name"]][start:end])
+            codes[entry["offset"]+start:entry["offset"]+end] = one_hot.ascii_to_codes(np.frombuffer(sequence.encode("ascii"), dtype=np.uint8))
+    codes.flush()
+    del codes
+    genome.close()
+
+    with open(os.path.join(tmp_dir, INDEX_FILE), "w") as fp:
+        json.dump({"source": os.path.abspath(genome_fasta),
+                   "source_signature": get_source_signature(genome_fasta),
+                   "chroms": chroms}, fp, indent=4)
+
+    os.rename(tmp_dir, index_dir)
+
+class GenomeIndex():
+    """
+    Memory mapped genome index built by build_genome_index. Windows are returned
+    as slices of the memory map, without reading or parsing the fasta.
+    """
+    def __init__(self, index_dir):
+        index = json.load(open(os.path.join(index_dir, INDEX_FILE)))
+        self.source_signature = index["source_signature"]
+        self.offsets = {c["name"]: c["offset"] for c in index["chroms"]}
+        self.lengths = {c["name"]: c["length"] for c in index["chroms"]}
+        self.codes = np.memmap(os.path.join(index_dir, CODES_FILE), dtype=np.uint8, mode="r")
+
+    def keys(self):
+        return self.lengths.keys()
+
+    def chrom_len(self, chrom):
+        return self.lengths[chrom]
+
+    def fetch_codes(self, chrom, start, end):
+        # like slicing a fasta record, the window is truncated at the chromosome ends
+        start = max(start, 0)
+        end = min(end, self.lengths[chrom])
+        return self.codes[self.offsets[chrom]+start:self.offsets[chrom]+max(start, end)]
+
+    def fetch_seq(self, chrom, start, end):
+        return one_hot.codes_to_dna(self.fetch_codes(chrom, start, end)[None])[0]
+
+    def close(self):
+        self.codes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class FastaGenome():
+    """
+    Same interface as GenomeIndex, reading from the fasta with pyfaidx.
+    """
+    def __init__(self, genome_fasta):
+        self.genome = pyfaidx.Fasta(genome_fasta)
+
+    def keys(self):
+        return self.genome.keys()
+
+    def chrom_len(self, chrom):
+        return len(self.genome[chrom])
+
+    def fetch_codes(self, chrom, start, end):
+        sequence = str(self.genome[chrom][max(start, 0):max(start, end, 0)])
+        return one_hot.ascii_to_codes(np.frombuffer(sequence.encode("ascii"), dtype=np.uint8))
+
+    def fetch_seq(self, chrom, start, end):
+        return str(self.genome[chrom][max(start, 0):max(start, end, 0)])
+
+    def close(self):
+        self.genome.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_genome(genome):
+    """
+    Opens a genome given either a genome index directory or a fasta. For a fasta,
+    the index written next to it by prep genome-index is used if it is up to date,
+    otherwise the fasta is read directly.
+    """
+    if os.path.isdir(genome):
+        return GenomeIndex(genome)
+
+    index_dir = get_default_index_dir(genome)
+    if os.path.exists(os.path.join(index_dir, INDEX_FILE)):
+        index = GenomeIndex(index_dir)
+        if index.source_signature == get_source_signature(genome):
+            return index
+        print("genome index at {} is older than {}, reading the fasta instead".format(index_dir, genome))
+
+    return FastaGenome(genome)
+
+def get_parsers():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-g", "--genome", type=str, required=True, help="reference genome fasta file")
+    parser.add_argument("-o", "--output-dir", type=str, default=None, help="Directory to write the genome index to. Defaults to <genome>.index, where it is picked up automatically whenever the fasta is passed as genome")
+    return parser
+
+def main(args):
+    index_dir = args.output_dir
+    if index_dir is None:
+        index_dir = get_default_index_dir(args.genome)
+    assert(not os.path.exists(index_dir)) # genome index already exists
+
+    build_genome_index(args.genome, index_dir)
+    print("genome index written to: "+index_dir)
+
+if __name__=="__main__":
+    args = get_parsers().parse_args()
+    main(args)
@@ -1,5 +1,4 @@
 import tensorflow as tf
-import tensorflow_probability as tfp
 
 
 #from https://github.com/kundajelab/basepair/blob/cda0875571066343cdf90aed031f7c51714d991a/basepair/losses.py#L87
@@ -8,13 +7,17 @@ def multinomial_nll(true_counts, logits):
     Args:
       true_counts: observed count values
       logits: predicted logit values
+
+    Closed form of -tfp.distributions.Multinomial(total_count=n, logits=logits).log_prob(true_counts),
+    averaged over the batch:
+      log_prob = lgamma(n+1) - sum(lgamma(true_counts+1)) + sum(true_counts * log_softmax(logits))
     """
+    # computed in float32 whatever the compute dtype of the model
+    true_counts = tf.cast(true_counts, tf.float32)
+    logits = tf.cast(logits, tf.float32)
     counts_per_example = tf.reduce_sum(true_counts, axis=-1)
-    dist = tfp.distributions.Multinomial(total_count=counts_per_example,
-                                         logits=logits)
-    return (-tf.reduce_sum(dist.log_prob(true_counts)) / 
+    log_prob = (tf.math.lgamma(counts_per_example + 1)
+                - tf.reduce_sum(tf.math.lgamma(true_counts + 1), axis=-1)
+                + tf.reduce_sum(true_counts * tf.nn.log_softmax(logits, axis=-1), axis=-1))
+    return (-tf.reduce_sum(log_prob) /
             tf.cast(tf.shape(true_counts)[0], dtype=tf.float32))
-
-
-
-
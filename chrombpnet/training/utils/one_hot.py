@@ -6,35 +6,147 @@ https://gist.github.com/amtseng/010dd522daaabc92b014f075a34a0a0b
 
 import numpy as np
 
-def dna_to_one_hot(seqs):
+def dna_to_one_hot(seqs, out=None):
     """
     Converts a list of DNA ("ACGT") sequences to one-hot encodings, where the
     position of 1s is ordered alphabetically by "ACGT". `seqs` must be a list
-    of N strings, where every string is the same length L. Returns an N x L x 4
-    NumPy array of one-hot encodings, in the same order as the input sequences.
-    All bases will be converted to upper-case prior to performing the encoding.
+    of N strings (or bytes), where every string is the same length L. Returns an
+    N x L x 4 NumPy array of one-hot encodings, in the same order as the input
+    sequences. Lower-case bases are encoded the same as upper-case bases.
     Any bases that are not "ACGT" will be given an encoding of all 0s.
+    If `out` is given, the encoding is written into it and it is returned.
     """
     seq_len = len(seqs[0])
     assert np.all(np.array([len(s) for s in seqs]) == seq_len)
 
-    # Join all sequences together into one long string, all uppercase
-    seq_concat = "".join(seqs).upper() + "ACGT"
-    # Add one example of each base, so np.unique doesn't miss indices later
+    # Join all sequences together into one long string, and view it as an
+    # array of ASCII character codes
+    if isinstance(seqs[0], str):
+        seq_concat = "".join(seqs).encode("ascii", errors="replace")
+    else:
+        seq_concat = b"".join(seqs)
+    base_vals = np.frombuffer(seq_concat, dtype=np.uint8)
 
-    one_hot_map = np.identity(5)[:, :-1].astype(np.int8)
+    return ascii_to_one_hot(base_vals.reshape((len(seqs), seq_len)), out=out)
 
-    # Convert string into array of ASCII character codes;
-    base_vals = np.frombuffer(bytearray(seq_concat, "utf8"), dtype=np.int8)
 
-    # Anything that's not an A, C, G, or T gets assigned a higher code
-    base_vals[~np.isin(base_vals, np.array([65, 67, 71, 84]))] = 85
+# base codes used to store sequences compactly: A, C, G, T -> 0, 1, 2, 3 and
+# anything else (N, IUPAC codes, ...) -> 4. Lower-case bases get the same codes.
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, bases in enumerate(["Aa", "Cc", "Gg", "Tt"]):
+    BASE_CODES[[ord(b) for b in bases]] = code
 
-    # Convert the codes into indices in [0, 4], in ascending order by code
-    _, base_inds = np.unique(base_vals, return_inverse=True)
+# complement of every code, N stays N
+RC_CODES = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
 
-    # Get the one-hot encoding for those indices, and reshape back to separate
-    return one_hot_map[base_inds[:-4]].reshape((len(seqs), seq_len, 4))
+# one-hot encoding of every code, N is all 0s
+CODE_ONE_HOT = np.identity(5)[:, :-1].astype(np.int8)
+
+# ASCII character of every code
+CODE_BASES = np.frombuffer(b"ACGTN", dtype=np.uint8)
+
+# code of every 4 bit pattern of a one-hot position (A = 1, C = 2, G = 4, T = 8),
+# all 0s and invalid patterns get the N code
+PATTERN_CODES = np.full(16, 4, dtype=np.uint8)
+PATTERN_CODES[[1, 2, 4, 8]] = [0, 1, 2, 3]
+
+# rows of an N x L input encoded at a time by ascii_to_one_hot_batched
+BATCH_ROWS = 4096
+
+
+def ascii_to_one_hot(base_vals, out=None):
+    """
+    Same as dna_to_one_hot, but takes an N x L array of ASCII character codes
+    (e.g. bytes sliced straight out of a FASTA record) instead of a list of
+    strings. Lower-case bases are treated as upper-case. Returns an N x L x 4
+    NumPy array of one-hot encodings, written into `out` if given.
+    """
+    return codes_to_one_hot(ascii_to_codes(base_vals), out=out)
+
+
+def ascii_to_one_hot_batched(base_vals, out=None, batch_rows=BATCH_ROWS):
+    """
+    Same as ascii_to_one_hot, but encodes `batch_rows` rows at a time, so that
+    `base_vals` (and `out`) can be memory mapped arrays larger than memory.
+    """
+    if out is None:
+        out = np.empty(base_vals.shape + (4,), dtype=CODE_ONE_HOT.dtype)
+    for start in range(0, base_vals.shape[0], batch_rows):
+        end = min(start + batch_rows, base_vals.shape[0])
+        ascii_to_one_hot(np.asarray(base_vals[start:end]), out=out[start:end])
+    return out
+
+
+def ascii_to_codes(base_vals, out=None):
+    """
+    Converts an array of ASCII character codes into base codes (see BASE_CODES),
+    1 byte per base instead of the 4 of a one-hot encoding.
+    """
+    return np.take(BASE_CODES, base_vals, out=out)
+
+
+def codes_to_one_hot(codes, out=None):
+    """
+    Expands an N x L array of base codes into an N x L x 4 int8 one-hot encoding,
+    ordered "ACGT". N bases are encoded as all 0s.
+    """
+    return np.take(CODE_ONE_HOT, codes, axis=0, out=out)
+
+
+def one_hot_to_codes(one_hot):
+    """
+    Inverse of codes_to_one_hot. Positions that are all 0s get the N code.
+    """
+    one_hot = np.asarray(one_hot)
+    if one_hot.dtype.itemsize == 1:
+        # the 4 bytes of a position read as one little-endian integer, whose
+        # bits 0, 8, 16 and 24 are folded into a 4 bit pattern
+        vals = np.ascontiguousarray(one_hot).view("<u4")[..., 0]
+        return PATTERN_CODES[(vals | (vals >> 7) | (vals >> 14) | (vals >> 21)) & 15]
+
+    codes = np.argmax(one_hot, axis=-1).astype(np.uint8)
+    codes[~np.any(one_hot, axis=-1)] = 4
+    return codes
+
+
+def revcomp_codes(codes):
+    """
+    Reverse complements an N x L array of base codes.
+    """
+    return RC_CODES[codes[..., ::-1]]
+
+
+def codes_to_dna(codes):
+    """
+    Converts an N x L array of base codes into a list of N "ACGTN" strings.
+    """
+    bases = CODE_BASES[codes]
+    return [row.tobytes().decode("ascii") for row in bases]
+
+
+def pack_codes(codes):
+    """
+    Packs an N x L array of base codes into 2 bits per base. Returns an
+    N x ceil(L/4) uint8 array of packed ACGT codes (4 bases per byte, first
+    base in the lowest bits) and an N x ceil(L/8) bit mask of the N bases,
+    as N can not be represented in 2 bits. Use unpack_codes to get the codes back.
+    """
+    num_seqs, seq_len = codes.shape
+    padded = np.zeros((num_seqs, -(-seq_len//4)*4), dtype=np.uint8)
+    padded[:, :seq_len] = codes & 3
+    padded = padded.reshape(num_seqs, -1, 4)
+    packed = padded[:, :, 0] | (padded[:, :, 1] << 2) | (padded[:, :, 2] << 4) | (padded[:, :, 3] << 6)
+    return packed, np.packbits(codes == 4, axis=-1)
+
+
+def unpack_codes(packed, n_mask, seq_len):
+    """
+    Inverse of pack_codes, returns an N x seq_len array of base codes.
+    """
+    codes = (packed[:, :, None] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3
+    codes = codes.reshape(packed.shape[0], -1)[:, :seq_len]
+    codes[np.unpackbits(n_mask, axis=-1, count=seq_len).astype(bool)] = 4
+    return codes
 
 
 def one_hot_to_dna(one_hot):
@@ -46,16 +158,4 @@ def one_hot_to_dna(one_hot):
     sequences will only consist of letters "A", "C", "G", "T", or "N" (all
     upper-case). Any encodings that are all 0s will be translated to "N".
     """
-    bases = np.array(["A", "C", "G", "T", "N"])
-    # Create N x L array of all 5s
-    one_hot_inds = np.tile(one_hot.shape[2], one_hot.shape[:2])
-
-    # Get indices of where the 1s are
-    batch_inds, seq_inds, base_inds = np.where(one_hot)
-
-    # In each of the locations in the N x L array, fill in the location of the 1
-    one_hot_inds[batch_inds, seq_inds] = base_inds
-
-    # Fetch the corresponding base for each position using indexing
-    seq_array = bases[one_hot_inds]
-    return ["".join(seq) for seq in seq_array]
+    return codes_to_dna(one_hot_to_codes(one_hot))
@@ -0,0 +1,28 @@
+def build_optimizer(optimizer, var_list):
+    """
+    Creates the state (iterations and slots) of optimizer for var_list without
+    applying gradients, with the OptimizerV2 API of tensorflow 2.8 or the build
+    of the optimizers of tensorflow >= 2.11.
+    """
+    if hasattr(optimizer, "_create_all_weights"):
+        optimizer._create_all_weights(var_list)
+    else:
+        optimizer.build(var_list)
+
+def get_optimizer_variables(optimizer):
+    # a method of OptimizerV2, a (callable) list property of the newer optimizers
+    return list(optimizer.variables())
+
+def copy_optimizer_state(optimizer, new_optimizer, var_list):
+    """
+    Builds new_optimizer for var_list and assigns it the state of optimizer (the
+    inner optimizer of a loss scale optimizer), e.g. for a rebuilt model.
+    """
+    optimizer = getattr(optimizer, "inner_optimizer", optimizer)
+    new_optimizer = getattr(new_optimizer, "inner_optimizer", new_optimizer)
+    build_optimizer(new_optimizer, var_list)
+    variables = get_optimizer_variables(optimizer)
+    new_variables = get_optimizer_variables(new_optimizer)
+    assert(len(new_variables)==len(variables)) # optimizer state does not match the rebuilt model
+    for new_var, var in zip(new_variables, variables):
+        new_var.assign(var)
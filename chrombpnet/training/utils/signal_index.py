@@ -0,0 +1,124 @@
+import numpy as np
+import pyBigWig
+import argparse
+import json
+import os
+from chrombpnet.training.utils import genome_index
+
+# a signal index is a directory with the per base values of a bigwig expanded into
+# one flat memory mapped file per chromosome (missing values stored as 0), and a
+# table of the file, length and dtype of every chromosome
+INDEX_FILE = "index.json"
+
+# values are converted in chunks of this many bases
+CHUNK_LEN = 2**24
+
+# uint16 halves the size of the index, and is exact for the integer counts
+# of the unstranded bigwigs written by chrombpnet prep
+DTYPES = ["float32", "uint16"]
+
+def get_default_index_dir(bigwig):
+    # prep signal-index writes next to the bigwig by default, where open_signal looks for it
+    return bigwig + ".index"
+
+def build_signal_index(bigwig, index_dir, dtype="float32", chunk_len=CHUNK_LEN):
+    """
+    Converts bigwig once into a signal index at index_dir (see SignalIndex).
+    Files are written to a temporary directory which is then renamed.
+    """
+    assert(dtype in DTYPES) # unsupported dtype
+    bw = pyBigWig.open(bigwig)
+    tmp_dir = "{}.tmp{}".format(index_dir.rstrip("/"), os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    chroms = []
+    for i, (chrom, length) in enumerate(bw.chroms().items()):
+        print("indexing "+chrom)
+        entry = {"name": chrom, "file": "chrom{}.bin".format(i), "length": length}
+        vals = np.memmap(os.path.join(tmp_dir, entry["file"]), dtype=dtype, mode="w+", shape=(max(length, 1),))
+        for start in range(0, length, chunk_len):
+            end = min(start+chunk_len, length)
+            if pyBigWig.numpy:
+                block = np.nan_to_num(bw.values(chrom, start, end, numpy=True))
+            else:
+                block = np.nan_to_num(np.array(bw.values(chrom, start, end)))
+            if dtype == "uint16":
+                assert(np.all((block >= 0) & (block <= np.iinfo(np.uint16).max) & (block == np.round(block)))) # values are not counts, use float32
+            vals[start:end] = block
+        vals.flush()
+        del vals
+        chroms.append(entry)
+    bw.close()
+
+    with open(os.path.join(tmp_dir, INDEX_FILE), "w") as fp:
+        json.dump({"source": os.path.abspath(bigwig),
+                   "source_signature": genome_index.get_source_signature(bigwig),
+                   "dtype": dtype,
+                   "chroms": chroms}, fp, indent=4)
+
+    os.rename(tmp_dir, index_dir)
+
+class SignalIndex():
+    """
+    Memory mapped signal index built by build_signal_index. Implements the parts of
+    the pyBigWig interface used for reading labels (chroms and values), with windows
+    returned as slices of the memory maps instead of decompressing bigwig blocks.
+    """
+    def __init__(self, index_dir):
+        index = json.load(open(os.path.join(index_dir, INDEX_FILE)))
+        self.source_signature = index["source_signature"]
+        self.lengths = {c["name"]: c["length"] for c in index["chroms"]}
+        self.vals = {c["name"]: np.memmap(os.path.join(index_dir, c["file"]), dtype=index["dtype"], mode="r")
+                     for c in index["chroms"]}
+
+    def chroms(self, chrom=None):
+        if chrom is None:
+            return dict(self.lengths)
+        return self.lengths.get(chrom)
+
+    def values(self, chrom, start, end, numpy=True):
+        # same bounds check as pyBigWig
+        if (start < 0) or (end > self.lengths[chrom]) or (start >= end):
+            raise RuntimeError("Invalid interval bounds!")
+        return self.vals[chrom][start:end]
+
+    def close(self):
+        self.vals = None
+
+def open_signal(bigwig):
+    """
+    Opens a signal given either a signal index directory or a bigwig. For a bigwig,
+    the index written next to it by prep signal-index is used if it is up to date,
+    otherwise the bigwig is opened with pyBigWig.
+    """
+    if os.path.isdir(bigwig):
+        return SignalIndex(bigwig)
+
+    index_dir = get_default_index_dir(bigwig)
+    if os.path.exists(os.path.join(index_dir, INDEX_FILE)):
+        index = SignalIndex(index_dir)
+        if index.source_signature == genome_index.get_source_signature(bigwig):
+            return index
+        print("signal index at {} is older than {}, reading the bigwig instead".format(index_dir, bigwig))
+
+    return pyBigWig.open(bigwig)
+
+def get_parsers():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--bigwig", type=str, required=True, help="unstranded bigwig of counts")
+    parser.add_argument("-o", "--output-dir", type=str, default=None, help="Directory to write the signal index to. Defaults to <bigwig>.index, where it is picked up automatically whenever the bigwig is passed")
+    parser.add_argument("--dtype", type=str, default="float32", choices=DTYPES, help="dtype to store values as, uint16 requires integer counts")
+    return parser
+
+def main(args):
+    index_dir = args.output_dir
+    if index_dir is None:
+        index_dir = get_default_index_dir(args.bigwig)
+    assert(not os.path.exists(index_dir)) # signal index already exists
+
+    build_signal_index(args.bigwig, index_dir, args.dtype)
+    print("signal index written to: "+index_dir)
+
+if __name__=="__main__":
+    args = get_parsers().parse_args()
+    main(args)
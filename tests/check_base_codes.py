@@ -0,0 +1,55 @@
+"""
+Self-check of the base code helpers of chrombpnet.training.utils.one_hot used
+to store training sequences: 2-bit packing round-trips (with N bases and
+lengths that are not multiples of 4) and revcomp_codes against the reverse
+complement of the one-hot encoding. Exits with an AssertionError on mismatch.
+
+python tests/check_base_codes.py --num-seqs 100
+"""
+
+import argparse
+import numpy as np
+from chrombpnet.training.utils import one_hot
+
+def get_random_codes(rng, num_seqs, seq_len, n_frac):
+    codes = rng.integers(0, 4, size=(num_seqs, seq_len), dtype=np.uint8)
+    codes[rng.random((num_seqs, seq_len)) < n_frac] = 4
+    return codes
+
+def check_pack_round_trip(codes):
+    packed, n_mask = one_hot.pack_codes(codes)
+    num_seqs, seq_len = codes.shape
+    assert(packed.shape == (num_seqs, -(-seq_len//4)))
+    assert(n_mask.shape == (num_seqs, -(-seq_len//8)))
+    unpacked = one_hot.unpack_codes(packed, n_mask, seq_len)
+    assert(unpacked.dtype == codes.dtype)
+    np.testing.assert_array_equal(unpacked, codes)
+
+def check_revcomp(codes):
+    expected = one_hot.codes_to_one_hot(codes)[:, ::-1, ::-1]
+    np.testing.assert_array_equal(one_hot.codes_to_one_hot(one_hot.revcomp_codes(codes)), expected)
+    # the reverse complement of the reverse complement is the sequence itself
+    np.testing.assert_array_equal(one_hot.revcomp_codes(one_hot.revcomp_codes(codes)), codes)
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    # every remainder mod 4 and mod 8, plus a typical input length
+    seq_lens = list(range(1, 18)) + [2114]
+    for seq_len in seq_lens:
+        for n_frac in [0.0, 0.1, 1.0]:
+            codes = get_random_codes(rng, args.num_seqs, seq_len, n_frac)
+            check_pack_round_trip(codes)
+            check_revcomp(codes)
+    # codes from sequences with lower-case and non ACGT characters
+    seqs = ["ACGTNacgtnRYK", "nnnnACGTTGCAa"]
+    codes = one_hot.ascii_to_codes(np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8).reshape(len(seqs), -1))
+    check_pack_round_trip(codes)
+    check_revcomp(codes)
+    assert(one_hot.codes_to_dna(one_hot.revcomp_codes(codes)) == ["NNNNACGTNACGT", "TTGCAACGTNNNN"])
+    print("pack/unpack and revcomp_codes checked on {} sequence lengths".format(len(seq_lens)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-seqs", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1234)
+    main(parser.parse_args())
@@ -0,0 +1,92 @@
+"""
+Self-check of augment.get_epoch_indices: for a fixed seed, the examples, crop
+starts, revcomps and order it draws must give the same epoch as the previous
+array based augmentation (augment.random_crop, nonpeak subsampling and
+augment.crop_revcomp_augment). Exits with an AssertionError on mismatch.
+
+python tests/check_epoch_indices.py --num-peaks 1000 --num-nonpeaks 3000
+"""
+
+import argparse
+import numpy as np
+from chrombpnet.training.utils import augment
+from chrombpnet.training.utils import data_utils
+from chrombpnet.training.utils import one_hot
+
+def get_random_data(rng, num_examples, seq_len, label_len, peak):
+    seqs = rng.integers(0, 5, size=(num_examples, seq_len), dtype=np.uint8)
+    cts = rng.poisson(1.0, size=(num_examples, label_len)).astype(np.float32)
+    coords = np.zeros(num_examples, dtype=data_utils.COORDS_DTYPE)
+    coords["chrom"] = rng.integers(0, 3, size=num_examples)
+    coords["pos"] = rng.integers(10**5, 10**8, size=num_examples)
+    coords["peak"] = peak
+    return seqs, cts, coords
+
+def get_epoch_arrays(peaks, nonpeaks, inputlen, outputlen, negative_sampling_ratio, add_revcomp, shuffle):
+    # previous ChromBPNetBatchGenerator.crop_revcomp_data, with copies of the data
+    parts = []
+    if peaks is not None:
+        parts.append(augment.random_crop(*peaks[:2], inputlen, outputlen, peaks[2]))
+    if nonpeaks is not None:
+        seqs, cts, coords = nonpeaks
+        if (peaks is not None) and (negative_sampling_ratio < 1.0):
+            keep = np.random.choice(len(seqs), size=int(negative_sampling_ratio * len(peaks[0])), replace=False)
+            seqs, cts, coords = seqs[keep], cts[keep], coords[keep]
+        parts.append((seqs, cts, coords))
+    seqs, cts, coords = [np.concatenate([part[i] for part in parts]) for i in range(3)]
+    return augment.crop_revcomp_augment(seqs, cts, coords, inputlen, outputlen, add_revcomp, shuffle=shuffle)
+
+def get_epoch_from_indices(peaks, nonpeaks, inputlen, outputlen, negative_sampling_ratio, add_revcomp, shuffle):
+    # epoch gathered from the drawn indices, as ChromBPNetBatchGenerator.get_examples does
+    num_peaks = 0 if peaks is None else len(peaks[0])
+    num_nonpeaks = 0 if nonpeaks is None else len(nonpeaks[0])
+    max_start = 0 if peaks is None else peaks[0].shape[1] - inputlen
+    is_peak, idx, starts, rc = augment.get_epoch_indices(num_peaks, num_nonpeaks, max_start, negative_sampling_ratio, add_revcomp, shuffle=shuffle)
+
+    seqs = np.zeros((idx.shape[0], inputlen), dtype=np.uint8)
+    cts = np.zeros((idx.shape[0], outputlen), dtype=np.float32)
+    coords = np.zeros(idx.shape[0], dtype=data_utils.COORDS_DTYPE)
+    if num_peaks > 0:
+        rows = idx[is_peak]
+        seqs[is_peak] = augment.take_per_row(peaks[0][rows], starts[is_peak], inputlen)
+        cts[is_peak] = augment.take_per_row(peaks[1][rows], starts[is_peak], outputlen)
+        coords[is_peak] = peaks[2][rows]
+        coords["pos"][is_peak] += starts[is_peak] - peaks[0].shape[1]//2
+    if num_nonpeaks > 0:
+        rows = idx[~is_peak]
+        seqs[~is_peak], cts[~is_peak], coords[~is_peak] = nonpeaks[0][rows], nonpeaks[1][rows], nonpeaks[2][rows]
+    seqs[rc] = one_hot.revcomp_codes(seqs[rc])
+    cts[rc] = cts[rc, ::-1]
+    coords["rc"] = rc
+    return seqs, cts, coords
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    inputlen, outputlen = 20, 8
+    peaks = get_random_data(rng, args.num_peaks, inputlen+2*args.max_jitter, outputlen+2*args.max_jitter, True)
+    nonpeaks = get_random_data(rng, args.num_nonpeaks, inputlen, outputlen, False)
+
+    num_checks = 0
+    for data in [(peaks, nonpeaks), (peaks, None), (None, nonpeaks)]:
+        for negative_sampling_ratio in [0.1, 1.0]:
+            for add_revcomp in [True, False]:
+                for shuffle in [True, False]:
+                    config = data + (inputlen, outputlen, negative_sampling_ratio, add_revcomp, shuffle)
+                    for epoch in range(args.num_epochs):
+                        np.random.seed(args.seed + epoch)
+                        expected = get_epoch_arrays(*config)
+                        np.random.seed(args.seed + epoch)
+                        epoch_data = get_epoch_from_indices(*config)
+                        for a, b in zip(epoch_data, expected):
+                            np.testing.assert_array_equal(a, b)
+                        num_checks += 1
+    print("get_epoch_indices matches the array based augmentation on {} epochs".format(num_checks))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-peaks", type=int, default=1000)
+    parser.add_argument("--num-nonpeaks", type=int, default=3000)
+    parser.add_argument("--max-jitter", type=int, default=5)
+    parser.add_argument("--num-epochs", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1234)
+    main(parser.parse_args())
@@ -0,0 +1,37 @@
+#!/bin/bash
+
+# trains a model with --distribution multi-worker on N local worker processes,
+# each given its own TF_CONFIG on a localhost port. The chief (worker 0) writes
+# the model and logs to the output prefix, the other workers to temporary directories.
+# usage: bash multi_worker_train.sh <num workers> <first port> <chrombpnet.training.train arguments...>
+# e.g. bash multi_worker_train.sh 2 12345 -g genome.fa -b signal.bw -p peaks.bed -n nonpeaks.bed \
+#	-o outputs/model -fl fold_0.json --params params.tsv -a chrombpnet/training/models/bpnet_model.py
+
+# exit when any command fails
+set -e
+
+num_workers=$1
+port=$2
+shift 2
+
+workers=""
+for ((i=0; i<num_workers; i++))
+do
+    workers="$workers\"localhost:$((port+i))\","
+done
+workers="[${workers%,}]"
+
+pids=()
+for ((i=0; i<num_workers; i++))
+do
+    TF_CONFIG="{\"cluster\": {\"worker\": $workers}, \"task\": {\"type\": \"worker\", \"index\": $i}}" \
+        python -m chrombpnet.training.train --distribution multi-worker "$@" > worker_$i.log 2>&1 &
+    pids+=($!)
+done
+
+# fail if any worker failed
+for pid in "${pids[@]}"
+do
+    wait $pid
+done
+echo "trained on $num_workers workers, logs in worker_*.log"